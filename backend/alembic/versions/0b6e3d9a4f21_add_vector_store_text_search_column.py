@@ -0,0 +1,119 @@
+"""add vector store text search column
+
+Revision ID: 0b6e3d9a4f21
+Revises: f2a7c93e5d18
+Create Date: 2026-10-18 21:05:37.948120
+
+"""
+from typing import List
+from alembic import op
+import sqlalchemy as sa
+from app.core.config import settings
+
+# revision identifiers, used by Alembic.
+revision = "0b6e3d9a4f21"
+down_revision = "f2a7c93e5d18"
+branch_labels = None
+depends_on = None
+
+TABLE_NAME = f"data_{settings.VECTOR_STORE_TABLE_NAME}"
+# named like PGVectorStore names the index of hybrid search tables
+TEXT_SEARCH_INDEX_NAME = f"{settings.VECTOR_STORE_TABLE_NAME}_idx"
+TEXT_SEARCH_SQL = "to_tsvector('english', text)"
+
+
+def is_generated_column(conn: sa.engine.Connection) -> bool:
+    return bool(
+        conn.execute(
+            sa.text(
+                "SELECT attgenerated = 's' FROM pg_attribute "
+                "WHERE attrelid = to_regclass(:table_name) "
+                "AND attname = 'text_search_tsv'"
+            ),
+            {"table_name": TABLE_NAME},
+        ).scalar()
+    )
+
+
+def get_unindexed_partitions(conn: sa.engine.Connection) -> List[str]:
+    """
+    The partitions that don't have an index attached to the table's text search
+    index yet. Partitions attached after the table's index was created get
+    theirs along with it.
+    """
+    return list(
+        conn.execute(
+            sa.text(
+                """
+                SELECT partition.relname
+                FROM pg_inherits AS inheritance
+                JOIN pg_class AS partition ON partition.oid = inheritance.inhrelid
+                WHERE inheritance.inhparent = to_regclass(:table_name)
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM pg_inherits AS index_inheritance
+                    JOIN pg_index AS partition_index
+                        ON partition_index.indexrelid = index_inheritance.inhrelid
+                    WHERE index_inheritance.inhparent = to_regclass(:index_name)
+                    AND partition_index.indrelid = partition.oid
+                )
+                ORDER BY partition.relname
+                """
+            ),
+            {"table_name": TABLE_NAME, "index_name": TEXT_SEARCH_INDEX_NAME},
+        ).scalars()
+    )
+
+
+def upgrade() -> None:
+    # the table is created with the column & index by the vector store's
+    # run_setup, so only databases where it already exists need them added
+    conn = op.get_bind()
+    if not sa.inspect(conn).has_table(TABLE_NAME):
+        return
+
+    # The column is a plain one that the vector store fills as it writes rows,
+    # since adding a stored generated column rewrites every partition while
+    # blocking reads & writes. The existing rows are filled a partition, i.e. a
+    # document, per transaction, and indexed concurrently.
+    with op.get_context().autocommit_block():
+        if is_generated_column(conn):
+            # keeps the computed values, without a rewrite
+            op.execute(
+                f"ALTER TABLE {TABLE_NAME} "
+                f"ALTER COLUMN text_search_tsv DROP EXPRESSION"
+            )
+        op.execute(
+            f"ALTER TABLE {TABLE_NAME} "
+            f"ADD COLUMN IF NOT EXISTS text_search_tsv tsvector"
+        )
+        # only the (empty) parent, so that the partitions can be indexed
+        # concurrently and attached to it
+        op.execute(
+            f"CREATE INDEX IF NOT EXISTS {TEXT_SEARCH_INDEX_NAME} "
+            f"ON ONLY {TABLE_NAME} USING gin (text_search_tsv)"
+        )
+        for partition_name in get_unindexed_partitions(conn):
+            op.execute(
+                f"UPDATE {partition_name} SET text_search_tsv = {TEXT_SEARCH_SQL} "
+                f"WHERE text_search_tsv IS NULL"
+            )
+            partition_index_name = f"{partition_name}_tsv_idx"
+            # left invalid by an interrupted upgrade
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {partition_index_name}")
+            op.execute(
+                f"CREATE INDEX CONCURRENTLY {partition_index_name} "
+                f"ON {partition_name} USING gin (text_search_tsv)"
+            )
+            op.execute(
+                f"ALTER INDEX {TEXT_SEARCH_INDEX_NAME} "
+                f"ATTACH PARTITION {partition_index_name}"
+            )
+
+
+def downgrade() -> None:
+    # along with the partitions' indices
+    op.execute(f"DROP INDEX IF EXISTS {TEXT_SEARCH_INDEX_NAME}")
+    op.execute(
+        f"ALTER TABLE IF EXISTS {TABLE_NAME} DROP COLUMN IF EXISTS text_search_tsv"
+    )
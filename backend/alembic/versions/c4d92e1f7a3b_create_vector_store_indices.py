@@ -0,0 +1,55 @@
+"""create vector store indices
+
+Revision ID: c4d92e1f7a3b
+Revises: e7b94d15c3a8
+Create Date: 2026-10-18 18:12:45.207316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from app.core.config import settings
+
+# revision identifiers, used by Alembic.
+revision = "c4d92e1f7a3b"
+down_revision = "e7b94d15c3a8"
+branch_labels = None
+depends_on = None
+
+TABLE_NAME = f"data_{settings.VECTOR_STORE_TABLE_NAME}"
+DB_DOCUMENT_ID_INDEX_NAME = f"{TABLE_NAME}_db_document_id_idx"
+EMBEDDING_INDEX_NAME = f"{TABLE_NAME}_embedding_idx"
+
+
+def get_embedding_index_params() -> str:
+    if settings.VECTOR_INDEX_TYPE == "ivfflat":
+        return f"lists = {settings.VECTOR_INDEX_IVFFLAT_LISTS}"
+    return (
+        f"m = {settings.VECTOR_INDEX_HNSW_M}, "
+        f"ef_construction = {settings.VECTOR_INDEX_HNSW_EF_CONSTRUCTION}"
+    )
+
+
+def upgrade() -> None:
+    # the table is created by the vector store's run_setup, along with these
+    # indices, so only databases where it already exists need them added
+    context = op.get_context()
+    if not context.as_sql and not sa.inspect(op.get_bind()).has_table(TABLE_NAME):
+        return
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, and keeps the
+    # table writable while the index builds
+    with context.autocommit_block():
+        op.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {DB_DOCUMENT_ID_INDEX_NAME} "
+            f"ON {TABLE_NAME} ((metadata_ ->> 'db_document_id'))"
+        )
+        op.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {EMBEDDING_INDEX_NAME} "
+            f"ON {TABLE_NAME} USING {settings.VECTOR_INDEX_TYPE} "
+            f"(embedding vector_cosine_ops) WITH ({get_embedding_index_params()})"
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {EMBEDDING_INDEX_NAME}")
+        op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {DB_DOCUMENT_ID_INDEX_NAME}")
@@ -0,0 +1,349 @@
+"""partition vector store by document
+
+Revision ID: f2a7c93e5d18
+Revises: c4d92e1f7a3b
+Create Date: 2026-10-18 19:48:02.613904
+
+"""
+from typing import List
+from uuid import UUID
+import hashlib
+from alembic import op
+import sqlalchemy as sa
+from app.core.config import settings
+
+# revision identifiers, used by Alembic.
+revision = "f2a7c93e5d18"
+down_revision = "c4d92e1f7a3b"
+branch_labels = None
+depends_on = None
+
+TABLE_NAME = f"data_{settings.VECTOR_STORE_TABLE_NAME}"
+NEW_TABLE_NAME = f"{TABLE_NAME}_partitioned"
+OLD_TABLE_NAME = f"{TABLE_NAME}_old"
+CHANGED_DOCUMENTS_TABLE_NAME = f"{TABLE_NAME}_changed_documents"
+TRACK_CHANGES_FUNCTION_NAME = f"{TABLE_NAME}_track_changes"
+CONTENT_KEY_INDEX_NAME = f"{TABLE_NAME}_content_key_idx"
+DB_DOCUMENT_ID_INDEX_NAME = f"{TABLE_NAME}_db_document_id_idx"
+EMBEDDING_INDEX_NAME = f"{TABLE_NAME}_embedding_idx"
+TEXT_HASH_SQL = "encode(sha256(convert_to(text, 'UTF8')), 'hex')"
+DB_DOCUMENT_ID_SQL = "coalesce(metadata_ ->> 'db_document_id', '')"
+# Number of row IDs copied per transaction
+BATCH_SIZE = 5000
+# Documents written to during the copy are copied again until at most this many
+# are left, which are then copied while writes to the table are blocked
+MAX_FINAL_CHANGED_DOCUMENTS = 10
+MAX_CATCH_UP_ROUNDS = 10
+
+
+def get_partition_name(db_document_id: str) -> str:
+    try:
+        suffix = UUID(db_document_id).hex
+    except ValueError:
+        suffix = hashlib.sha256(db_document_id.encode("utf-8")).hexdigest()[:32]
+    return f"{TABLE_NAME}_{suffix}"
+
+
+def get_embedding_index_sql(table_name: str, index_name: str) -> str:
+    if settings.VECTOR_INDEX_TYPE == "ivfflat":
+        index_params = f"lists = {settings.VECTOR_INDEX_IVFFLAT_LISTS}"
+    else:
+        index_params = (
+            f"m = {settings.VECTOR_INDEX_HNSW_M}, "
+            f"ef_construction = {settings.VECTOR_INDEX_HNSW_EF_CONSTRUCTION}"
+        )
+    return (
+        f"CREATE INDEX {index_name} ON {table_name} "
+        f"USING {settings.VECTOR_INDEX_TYPE} (embedding vector_cosine_ops) "
+        f"WITH ({index_params})"
+    )
+
+
+def is_partitioned(conn: sa.engine.Connection) -> bool:
+    return (
+        conn.execute(
+            sa.text(
+                "SELECT 1 FROM pg_partitioned_table "
+                "WHERE partrelid = to_regclass(:table_name)"
+            ),
+            {"table_name": TABLE_NAME},
+        ).first()
+        is not None
+    )
+
+
+def get_embedding_type(conn: sa.engine.Connection) -> str:
+    return conn.execute(
+        sa.text(
+            "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+            "WHERE attrelid = to_regclass(:table_name) AND attname = 'embedding'"
+        ),
+        {"table_name": TABLE_NAME},
+    ).scalar()
+
+
+def rename_to_old_table(conn: sa.engine.Connection) -> str:
+    """
+    Move the current table out of the way, along with the names of its
+    sequence & primary key, returning the type of its embedding column.
+    """
+    embedding_type = get_embedding_type(conn)
+    op.execute(f"ALTER TABLE {TABLE_NAME} RENAME TO {OLD_TABLE_NAME}")
+    op.execute(
+        f"ALTER TABLE {OLD_TABLE_NAME} "
+        f"RENAME CONSTRAINT {TABLE_NAME}_pkey TO {OLD_TABLE_NAME}_pkey"
+    )
+    op.execute(
+        f"ALTER SEQUENCE {TABLE_NAME}_id_seq RENAME TO {OLD_TABLE_NAME}_id_seq"
+    )
+    return embedding_type
+
+
+def drop_copy_tables() -> None:
+    """
+    Drop what a previous, interrupted upgrade left behind.
+    """
+    op.execute(f"DROP TRIGGER IF EXISTS {TRACK_CHANGES_FUNCTION_NAME} ON {TABLE_NAME}")
+    op.execute(f"DROP FUNCTION IF EXISTS {TRACK_CHANGES_FUNCTION_NAME}()")
+    op.execute(f"DROP TABLE IF EXISTS {CHANGED_DOCUMENTS_TABLE_NAME}")
+    # along with its partitions
+    op.execute(f"DROP TABLE IF EXISTS {NEW_TABLE_NAME}")
+
+
+def create_new_table(embedding_type: str) -> None:
+    # shares the current table's sequence, so the copied rows keep their IDs
+    # and rows written during the copy don't collide with them
+    op.execute(
+        f"""
+        CREATE TABLE {NEW_TABLE_NAME} (
+            id BIGINT NOT NULL DEFAULT nextval('{TABLE_NAME}_id_seq'),
+            text VARCHAR NOT NULL,
+            metadata_ JSON,
+            node_id VARCHAR,
+            embedding {embedding_type},
+            text_hash VARCHAR,
+            db_document_id VARCHAR NOT NULL,
+            PRIMARY KEY (id, db_document_id)
+        ) PARTITION BY LIST (db_document_id)
+        """
+    )
+    op.execute(
+        f"CREATE UNIQUE INDEX {NEW_TABLE_NAME}_content_key_idx ON {NEW_TABLE_NAME} "
+        f"(db_document_id, (metadata_ ->> 'page_label'), text_hash)"
+    )
+
+
+def track_changed_documents() -> None:
+    """
+    Record the DB document of every row that's written to the current table from
+    here on, so that documents written to during the copy are copied again.
+    """
+    op.execute(
+        f"CREATE TABLE {CHANGED_DOCUMENTS_TABLE_NAME} "
+        f"(db_document_id VARCHAR PRIMARY KEY)"
+    )
+    op.execute(
+        f"""
+        CREATE FUNCTION {TRACK_CHANGES_FUNCTION_NAME}() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO {CHANGED_DOCUMENTS_TABLE_NAME}
+                VALUES (coalesce(NEW.metadata_ ->> 'db_document_id', ''))
+                ON CONFLICT DO NOTHING;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                INSERT INTO {CHANGED_DOCUMENTS_TABLE_NAME}
+                VALUES (coalesce(OLD.metadata_ ->> 'db_document_id', ''))
+                ON CONFLICT DO NOTHING;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        f"CREATE TRIGGER {TRACK_CHANGES_FUNCTION_NAME} "
+        f"AFTER INSERT OR UPDATE OR DELETE ON {TABLE_NAME} "
+        f"FOR EACH ROW EXECUTE FUNCTION {TRACK_CHANGES_FUNCTION_NAME}()"
+    )
+
+
+def create_partitions(db_document_ids: List[str]) -> None:
+    # the new table isn't read from yet, so locking it while adding partitions
+    # doesn't block anything
+    for db_document_id in db_document_ids:
+        partition_value = db_document_id.replace("'", "''")
+        op.execute(
+            f"CREATE TABLE IF NOT EXISTS {get_partition_name(db_document_id)} "
+            f"PARTITION OF {NEW_TABLE_NAME} FOR VALUES IN ('{partition_value}')"
+        )
+
+
+def copy_rows(conn: sa.engine.Connection, where_sql: str, params: dict) -> None:
+    """
+    Copy the current table's rows that match where_sql into the new table,
+    hashing their text. Of any duplicate chunks, the latest copy is kept, like
+    the content key upserts do.
+    """
+    db_document_ids = conn.execute(
+        sa.text(
+            f"SELECT DISTINCT {DB_DOCUMENT_ID_SQL} FROM {TABLE_NAME} WHERE {where_sql}"
+        ),
+        params,
+    ).scalars()
+    create_partitions(list(db_document_ids))
+    conn.execute(
+        sa.text(
+            f"""
+            INSERT INTO {NEW_TABLE_NAME}
+                (id, text, metadata_, node_id, embedding, text_hash, db_document_id)
+            SELECT DISTINCT ON (db_document_id, metadata_ ->> 'page_label', text_hash)
+                id, text, metadata_, node_id, embedding, text_hash, db_document_id
+            FROM (
+                SELECT
+                    id, text, metadata_, node_id, embedding,
+                    coalesce(text_hash, {TEXT_HASH_SQL}) AS text_hash,
+                    {DB_DOCUMENT_ID_SQL} AS db_document_id
+                FROM {TABLE_NAME}
+                WHERE {where_sql}
+            ) AS old_rows
+            ORDER BY db_document_id, metadata_ ->> 'page_label', text_hash, id DESC
+            ON CONFLICT (db_document_id, (metadata_ ->> 'page_label'), text_hash)
+            DO UPDATE SET
+                id = excluded.id,
+                text = excluded.text,
+                metadata_ = excluded.metadata_,
+                node_id = excluded.node_id,
+                embedding = excluded.embedding
+            WHERE {NEW_TABLE_NAME}.id < excluded.id
+            """
+        ),
+        params,
+    )
+
+
+def copy_changed_documents(conn: sa.engine.Connection) -> int:
+    """
+    Copy the rows of the documents written to since they were last copied
+    again, returning the number of documents.
+    """
+    db_document_ids = list(
+        conn.execute(
+            sa.text(
+                f"DELETE FROM {CHANGED_DOCUMENTS_TABLE_NAME} RETURNING db_document_id"
+            )
+        ).scalars()
+    )
+    for db_document_id in db_document_ids:
+        conn.execute(
+            sa.text(f"DELETE FROM {NEW_TABLE_NAME} WHERE db_document_id = :id"),
+            {"id": db_document_id},
+        )
+        # finds the document's rows through the db_document_id index
+        where_sql = (
+            "metadata_ ->> 'db_document_id' = :id"
+            if db_document_id
+            else f"{DB_DOCUMENT_ID_SQL} = :id"
+        )
+        copy_rows(conn, where_sql, {"id": db_document_id})
+    return len(db_document_ids)
+
+
+def upgrade() -> None:
+    # the table is created partitioned by the vector store's run_setup, so only
+    # databases where it already exists need converting
+    conn = op.get_bind()
+    if not sa.inspect(conn).has_table(TABLE_NAME) or is_partitioned(conn):
+        return
+
+    # The rows are copied into a new, partitioned table in batches of short
+    # transactions, while the current table keeps serving reads & writes. Only
+    # the final switch over blocks writes, for as long as it takes to copy the
+    # documents written to since the last batch.
+    with op.get_context().autocommit_block():
+        drop_copy_tables()
+        # the text hash column is missing from tables that predate the content key
+        op.execute(
+            f"ALTER TABLE {TABLE_NAME} ADD COLUMN IF NOT EXISTS text_hash VARCHAR"
+        )
+        create_new_table(get_embedding_type(conn))
+        track_changed_documents()
+
+        max_id = conn.execute(sa.text(f"SELECT max(id) FROM {TABLE_NAME}")).scalar()
+        for start_id in range(0, (max_id or 0) + 1, BATCH_SIZE):
+            copy_rows(
+                conn,
+                "id >= :start_id AND id < :end_id",
+                {"start_id": start_id, "end_id": start_id + BATCH_SIZE},
+            )
+        # building the index after the rows are copied is much faster
+        op.execute(
+            get_embedding_index_sql(NEW_TABLE_NAME, f"{NEW_TABLE_NAME}_embedding_idx")
+        )
+        for _ in range(MAX_CATCH_UP_ROUNDS):
+            if copy_changed_documents(conn) <= MAX_FINAL_CHANGED_DOCUMENTS:
+                break
+
+    # blocks writes but not reads, until the migration's transaction commits
+    op.execute(f"LOCK TABLE {TABLE_NAME} IN EXCLUSIVE MODE")
+    copy_changed_documents(conn)
+    op.execute(f"ALTER SEQUENCE {TABLE_NAME}_id_seq OWNED BY {NEW_TABLE_NAME}.id")
+    # along with its trigger
+    op.execute(f"DROP TABLE {TABLE_NAME}")
+    op.execute(f"DROP FUNCTION {TRACK_CHANGES_FUNCTION_NAME}()")
+    op.execute(f"DROP TABLE {CHANGED_DOCUMENTS_TABLE_NAME}")
+    op.execute(f"ALTER TABLE {NEW_TABLE_NAME} RENAME TO {TABLE_NAME}")
+    op.execute(
+        f"ALTER TABLE {TABLE_NAME} "
+        f"RENAME CONSTRAINT {NEW_TABLE_NAME}_pkey TO {TABLE_NAME}_pkey"
+    )
+    op.execute(
+        f"ALTER INDEX {NEW_TABLE_NAME}_content_key_idx "
+        f"RENAME TO {CONTENT_KEY_INDEX_NAME}"
+    )
+    op.execute(
+        f"ALTER INDEX {NEW_TABLE_NAME}_embedding_idx RENAME TO {EMBEDDING_INDEX_NAME}"
+    )
+
+
+def downgrade() -> None:
+    conn = op.get_bind()
+    if not sa.inspect(conn).has_table(TABLE_NAME) or not is_partitioned(conn):
+        return
+
+    embedding_type = rename_to_old_table(conn)
+    op.execute(
+        f"""
+        CREATE TABLE {TABLE_NAME} (
+            id BIGSERIAL NOT NULL,
+            text VARCHAR NOT NULL,
+            metadata_ JSON,
+            node_id VARCHAR,
+            embedding {embedding_type},
+            text_hash VARCHAR,
+            PRIMARY KEY (id)
+        )
+        """
+    )
+    op.execute(
+        f"""
+        INSERT INTO {TABLE_NAME} (id, text, metadata_, node_id, embedding, text_hash)
+        SELECT id, text, metadata_, node_id, embedding, text_hash FROM {OLD_TABLE_NAME}
+        """
+    )
+    op.execute(
+        f"SELECT setval(pg_get_serial_sequence('{TABLE_NAME}', 'id'), "
+        f"coalesce((SELECT max(id) FROM {TABLE_NAME}), 0) + 1, false)"
+    )
+    # drops every partition along with the partitioned table
+    op.execute(f"DROP TABLE {OLD_TABLE_NAME}")
+
+    op.execute(
+        f"CREATE UNIQUE INDEX {CONTENT_KEY_INDEX_NAME} ON {TABLE_NAME} "
+        f"((metadata_ ->> 'db_document_id'), (metadata_ ->> 'page_label'), text_hash)"
+    )
+    op.execute(
+        f"CREATE INDEX {DB_DOCUMENT_ID_INDEX_NAME} ON {TABLE_NAME} "
+        f"((metadata_ ->> 'db_document_id'))"
+    )
+    op.execute(get_embedding_index_sql(TABLE_NAME, EMBEDDING_INDEX_NAME))
@@ -1,7 +1,13 @@
 from typing import Optional, Sequence, List
 from sqlalchemy.orm import joinedload
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.models.db import Conversation, Message, Document, ConversationDocument
+from app.models.db import (
+    Conversation,
+    Message,
+    MessageStatusEnum,
+    Document,
+    ConversationDocument,
+)
 from app import schema
 from sqlalchemy import select, delete
 from sqlalchemy.dialects.postgresql import insert
@@ -39,6 +45,63 @@ async def fetch_conversation_with_messages(
     return None
 
 
+async def fetch_conversation_for_chat(
+    db: AsyncSession, conversation_id: str, max_messages: int
+) -> Optional[schema.Conversation]:
+    """
+    Fetch a conversation with its documents & its latest successful messages, in
+    the order they were created, without their sub processes. This is all the chat
+    engine needs, and doesn't grow with the length of the conversation.
+    return None if the conversation with the given id does not exist
+    """
+    stmt = (
+        select(Conversation)
+        .options(
+            joinedload(Conversation.conversation_documents).joinedload(
+                ConversationDocument.document
+            )
+        )
+        .where(Conversation.id == conversation_id)
+    )
+    result = await db.execute(stmt)
+    conversation = result.unique().scalars().first()
+    if conversation is None:
+        return None
+
+    # uses the (conversation_id, created_at) index
+    messages_stmt = (
+        select(
+            Message.id,
+            Message.created_at,
+            Message.updated_at,
+            Message.conversation_id,
+            Message.content,
+            Message.role,
+            Message.status,
+        )
+        .where(
+            Message.conversation_id == conversation_id,
+            Message.status == MessageStatusEnum.SUCCESS,
+        )
+        .order_by(Message.created_at.desc())
+        .limit(max_messages)
+    )
+    messages_result = await db.execute(messages_stmt)
+    messages = [
+        schema.Message(**row._mapping, sub_processes=[])
+        for row in reversed(messages_result.all())
+    ]
+    return schema.Conversation(
+        id=conversation.id,
+        created_at=conversation.created_at,
+        updated_at=conversation.updated_at,
+        messages=messages,
+        documents=[
+            convo_doc.document for convo_doc in conversation.conversation_documents
+        ],
+    )
+
+
 async def create_conversation(
     db: AsyncSession, convo_payload: schema.ConversationCreate
 ) -> schema.Conversation:
@@ -104,7 +167,9 @@ async def fetch_documents(
         stmt = stmt.limit(limit)
     result = await db.execute(stmt)
     documents = result.scalars().all()
-    return [schema.Document.model_validate(doc, from_attributes=True) for doc in documents]
+    return [
+        schema.Document.model_validate(doc, from_attributes=True) for doc in documents
+    ]
 
 
 async def upsert_document_by_url(
@@ -120,6 +185,8 @@ async def upsert_document_by_url(
     )
     stmt = stmt.returning(Document)
     result = await db.execute(stmt)
-    upserted_doc = schema.Document.model_validate(result.scalars().first(), from_attributes=True)
+    upserted_doc = schema.Document.model_validate(
+        result.scalars().first(), from_attributes=True
+    )
     await db.commit()
     return upserted_doc
@@ -1,8 +1,16 @@
 from typing import Generator
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from app.db.session import SessionLocal
 
 
 async def get_db() -> Generator[AsyncSession, None, None]:
     async with SessionLocal() as db:
         yield db
+
+
+def get_session_factory() -> async_sessionmaker:
+    """
+    For endpoints that open short-lived sessions themselves, rather than holding
+    one for the whole request, e.g. while streaming a response.
+    """
+    return SessionLocal
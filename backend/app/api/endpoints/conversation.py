@@ -4,23 +4,22 @@ from uuid import uuid4
 import datetime
 import asyncio
 import logging
-from collections import OrderedDict
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sse_starlette.sse import EventSourceResponse
-from app.api.deps import get_db
+from app.api.deps import get_db, get_session_factory
 from app.api import crud
 from app import schema
+from app.core.config import settings
 from app.chat.messaging import (
     handle_chat_message,
-    StreamedMessage,
-    StreamedMessageSubProcess,
+    astream_message_events,
+    get_message_stream_encoder,
+    StreamedMessageBuilder,
 )
 from app.models.db import (
     Message,
-    MessageSubProcess,
     MessageRoleEnum,
     MessageStatusEnum,
-    MessageSubProcessStatusEnum,
 )
 from uuid import UUID
 
@@ -71,16 +70,34 @@ async def delete_conversation(
 async def message_conversation(
     conversation_id: UUID,
     user_message: str,
-    db: AsyncSession = Depends(get_db),
+    stream_protocol: schema.MessageStreamProtocolEnum = (
+        schema.MessageStreamProtocolEnum.CUMULATIVE
+    ),
+    session_factory: async_sessionmaker = Depends(get_session_factory),
 ) -> EventSourceResponse:
     """
-    Send a message from a user to a conversation, receive a SSE stream of the assistant's response.
-    Each event in the SSE stream is a Message object. As the assistant continues processing the response,
-    the message object's sub_processes list and content string is appended to. While the message is being
-    generated, the status of the message will be PENDING. Once the message is generated, the status will
-    be SUCCESS. If there was an error in processing the message, the final status will be ERROR.
+    Send a message from a user to a conversation, receive a SSE stream of the
+    assistant's response. While the message is being generated, the status of the
+    message will be PENDING. Once the message is generated, the status will be
+    SUCCESS. If there was an error in processing the message, the final status will
+    be ERROR.
+
+    With the default "cumulative" stream_protocol, each event in the SSE stream is
+    the whole Message object generated so far.
+    With the "delta" stream_protocol, each event in the SSE stream is a versioned
+    MessageStreamEvent: a "start" event with the empty message, then "patch"
+    events with the text to append to the message's content and the
+    sub-processes to add to the message (or that replace the earlier ones of the
+    same event_id), and finally a "snapshot" event with the whole saved message.
+    Updates are batched into one event per MESSAGE_STREAM_FLUSH_INTERVAL_MS.
     """
-    conversation = await crud.fetch_conversation_with_messages(db, str(conversation_id))
+    # The response streams for as long as the answer takes to generate, so no
+    # pooled connection is held meanwhile: one session reads the conversation,
+    # and another saves the messages once the answer is generated.
+    async with session_factory() as db:
+        conversation = await crud.fetch_conversation_for_chat(
+            db, str(conversation_id), max_messages=settings.CHAT_HISTORY_MAX_MESSAGES
+        )
     if conversation is None:
         raise HTTPException(status_code=404, detail="Conversation not found")
 
@@ -94,6 +111,7 @@ async def message_conversation(
     )
 
     send_chan, recv_chan = anyio.create_memory_object_stream(100)
+    encoder = get_message_stream_encoder(stream_protocol)
 
     async def event_publisher():
         async with send_chan:
@@ -109,43 +127,17 @@ async def message_conversation(
                 status=MessageStatusEnum.PENDING,
                 sub_processes=[],
             )
+            builder = StreamedMessageBuilder(message)
             final_status = MessageStatusEnum.ERROR
-            event_id_to_sub_process = OrderedDict()
             try:
-                async for message_obj in recv_chan:
-                    if isinstance(message_obj, StreamedMessage):
-                        message.content = message_obj.content
-                    elif isinstance(message_obj, StreamedMessageSubProcess):
-                        status = (
-                            MessageSubProcessStatusEnum.FINISHED
-                            if message_obj.has_ended
-                            else MessageSubProcessStatusEnum.PENDING
-                        )
-                        if message_obj.event_id in event_id_to_sub_process:
-                            created_at = event_id_to_sub_process[
-                                message_obj.event_id
-                            ].created_at
-                        else:
-                            created_at = datetime.datetime.utcnow()
-                        sub_process = MessageSubProcess(
-                            # NOTE: By setting the created_at to the current time, we are
-                            # no longer able to use the created_at field to determine the
-                            # time at which the subprocess was inserted into the database.
-                            created_at=created_at,
-                            message_id=message_id,
-                            source=message_obj.source,
-                            metadata_map=message_obj.metadata_map,
-                            status=status,
-                        )
-                        event_id_to_sub_process[message_obj.event_id] = sub_process
-
-                        message.sub_processes = list(event_id_to_sub_process.values())
-                    else:
-                        logger.error(
-                            f"Unknown message object type: {type(message_obj)}"
-                        )
-                        continue
-                    yield schema.Message.from_orm(message).json()
+                async for event in astream_message_events(
+                    recv_chan,
+                    builder,
+                    encoder,
+                    flush_interval_ms=settings.MESSAGE_STREAM_FLUSH_INTERVAL_MS,
+                    flush_max_bytes=settings.MESSAGE_STREAM_FLUSH_MAX_BYTES,
+                ):
+                    yield event
                 await task
                 if task.exception():
                     raise ValueError(
@@ -156,11 +148,14 @@ async def message_conversation(
                 logger.error("Error in message publisher", exc_info=True)
                 final_status = MessageStatusEnum.ERROR
             message.status = final_status
-            db.add(user_message)
-            db.add(message)
-            await db.commit()
-            final_message = await crud.fetch_message_with_sub_processes(db, message_id)
-            yield final_message.json()
+            async with session_factory() as db:
+                db.add(user_message)
+                db.add(message)
+                await db.commit()
+                final_message = await crud.fetch_message_with_sub_processes(
+                    db, message_id
+                )
+            yield encoder.encode_final(final_message)
 
     return EventSourceResponse(event_publisher())
 
@@ -169,13 +164,17 @@ async def message_conversation(
 async def test_message_conversation(
     conversation_id: UUID,
     user_message: str,
-    db: AsyncSession = Depends(get_db),
+    session_factory: async_sessionmaker = Depends(get_session_factory),
 ) -> schema.Message:
     """
-    Test version of /message endpoint that returns a single message object instead of a SSE stream.
+    Test version of /message endpoint that returns a single message object instead of
+    a SSE stream.
     """
     response: EventSourceResponse = await message_conversation(
-        conversation_id, user_message, db
+        conversation_id,
+        user_message,
+        stream_protocol=schema.MessageStreamProtocolEnum.CUMULATIVE,
+        session_factory=session_factory,
     )
     final_message = None
     async for message in response.body_iterator:
@@ -0,0 +1,259 @@
+from typing import Callable, Dict, List, Optional
+import copy
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.async_utils import asyncio_run
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.base.response.schema import RESPONSE_TYPE, Response
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# metadata key marking a response that was served from the cache
+SUB_QUESTION_CACHE_HIT_KEY = "sub_question_cache_hit"
+
+
+def normalize_question(question: str) -> str:
+    """
+    Lowercase, collapse whitespace & drop trailing punctuation, so trivially
+    different phrasings of a question share an entry.
+    """
+    question = re.sub(r"\s+", " ", question).strip().lower()
+    return question.rstrip("?.!").rstrip()
+
+
+@dataclass
+class CachedAnswer:
+    cache_key: str
+    question: str
+    # unit length, so that a dot product is the cosine similarity
+    embedding: np.ndarray
+    answer: str
+    source_nodes: List[NodeWithScore]
+    expires_at: float
+
+
+@dataclass
+class SubQuestionAnswerCacheStats:
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class SubQuestionAnswerCache:
+    """
+    Per-worker cache of the answers a document's query engine gave to
+    sub-questions, along with their source nodes.
+
+    A sub-question is answered from the cache when an unexpired entry of the
+    same document has an embedding whose cosine similarity with the
+    sub-question's is at least similarity_threshold. Past max_entries, the
+    least recently used entries across all documents are evicted.
+    """
+
+    def __init__(
+        self,
+        similarity_threshold: float,
+        ttl_seconds: float,
+        max_entries: int,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        self._similarity_threshold = similarity_threshold
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        self._timer = timer
+        self._lock = threading.Lock()
+        # least recently used first
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._entry_ids_by_key: Dict[str, List[int]] = {}
+        self._next_entry_id = 0
+        self.stats = SubQuestionAnswerCacheStats()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        entry_ids = self._entry_ids_by_key[entry.cache_key]
+        entry_ids.remove(entry_id)
+        if not entry_ids:
+            del self._entry_ids_by_key[entry.cache_key]
+
+    def _get_live_entry_ids(self, cache_key: str) -> List[int]:
+        now = self._timer()
+        entry_ids = list(self._entry_ids_by_key.get(cache_key, []))
+        for entry_id in entry_ids:
+            if self._entries[entry_id].expires_at <= now:
+                self._remove(entry_id)
+        return list(self._entry_ids_by_key.get(cache_key, []))
+
+    def _hit(self, entry_id: int) -> CachedAnswer:
+        self._entries.move_to_end(entry_id)
+        self.stats.hits += 1
+        return self._entries[entry_id]
+
+    def get_exact(self, cache_key: str, question: str) -> Optional[CachedAnswer]:
+        """
+        Look up an entry by its normalized question, without an embedding. A
+        miss isn't counted, since the lookup by embedding follows it.
+        """
+        with self._lock:
+            for entry_id in self._get_live_entry_ids(cache_key):
+                if self._entries[entry_id].question == question:
+                    return self._hit(entry_id)
+            return None
+
+    def get(self, cache_key: str, embedding: List[float]) -> Optional[CachedAnswer]:
+        """
+        Look up the most similar entry of cache_key, if it's similar enough.
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        with self._lock:
+            entry_ids = [
+                entry_id
+                for entry_id in self._get_live_entry_ids(cache_key)
+                # entries from before a change of embedding dimensions
+                if self._entries[entry_id].embedding.shape == query.shape
+            ]
+            if entry_ids:
+                matrix = np.stack([self._entries[i].embedding for i in entry_ids])
+                similarities = matrix @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self._similarity_threshold:
+                    return self._hit(entry_ids[best])
+            self.stats.misses += 1
+            return None
+
+    def put(
+        self,
+        cache_key: str,
+        question: str,
+        embedding: List[float],
+        answer: str,
+        source_nodes: List[NodeWithScore],
+    ) -> None:
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        with self._lock:
+            entry_id = self._next_entry_id
+            self._next_entry_id += 1
+            self._entries[entry_id] = CachedAnswer(
+                cache_key=cache_key,
+                question=question,
+                embedding=vector,
+                answer=answer,
+                source_nodes=copy.deepcopy(source_nodes),
+                expires_at=self._timer() + self._ttl_seconds,
+            )
+            self._entry_ids_by_key.setdefault(cache_key, []).append(entry_id)
+            while len(self._entries) > self._max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._entry_ids_by_key.clear()
+            self.stats = SubQuestionAnswerCacheStats()
+
+
+class SubQuestionAnswerCacheQueryEngine(BaseQueryEngine):
+    """
+    Checks the answer cache before running a document's query engine, and
+    caches the answers it gives.
+
+    The SubQuestionQueryEngine that calls this still emits the SUB_QUESTION
+    events of cached answers, so their citations stream to the UI like any
+    other. Questions are matched exactly by their normalized text, then by the
+    embedding of the sub-question, which is reused for retrieval on a miss.
+    """
+
+    def __init__(
+        self,
+        query_engine: BaseQueryEngine,
+        cache: SubQuestionAnswerCache,
+        cache_key: str,
+        embed_model: Optional[BaseEmbedding] = None,
+    ):
+        super().__init__(callback_manager=query_engine.callback_manager)
+        self._query_engine = query_engine
+        self._cache = cache
+        self._cache_key = cache_key
+        self._embed_model = embed_model
+
+    def _get_prompt_modules(self) -> dict:
+        return {"query_engine": self._query_engine}
+
+    @staticmethod
+    def _to_response(entry: CachedAnswer) -> Response:
+        return Response(
+            response=entry.answer,
+            source_nodes=copy.deepcopy(entry.source_nodes),
+            metadata={SUB_QUESTION_CACHE_HIT_KEY: True},
+        )
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        question = normalize_question(query_bundle.query_str)
+        entry = self._cache.get_exact(self._cache_key, question)
+        if entry is not None:
+            return self._to_response(entry)
+
+        # embedded like the retriever would, rather than normalized, so that a
+        # miss retrieves exactly what the query engine would on its own
+        embed_model = self._embed_model or Settings.embed_model
+        embedding = (
+            query_bundle.embedding
+            or await embed_model.aget_agg_embedding_from_queries(
+                query_bundle.embedding_strs
+            )
+        )
+        entry = self._cache.get(self._cache_key, embedding)
+        if entry is not None:
+            logger.debug("Answered %r from the cache of %r", question, entry.question)
+            return self._to_response(entry)
+
+        response = await self._query_engine.aquery(
+            QueryBundle(
+                query_str=query_bundle.query_str,
+                custom_embedding_strs=query_bundle.custom_embedding_strs,
+                embedding=embedding,
+            )
+        )
+        if response.response:
+            self._cache.put(
+                self._cache_key,
+                question,
+                embedding,
+                str(response),
+                response.source_nodes,
+            )
+        return response
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        return asyncio_run(self._aquery(query_bundle))
+
+
+_sub_question_answer_cache: Optional[SubQuestionAnswerCache] = None
+
+
+def get_sub_question_answer_cache() -> SubQuestionAnswerCache:
+    global _sub_question_answer_cache
+    if _sub_question_answer_cache is None:
+        _sub_question_answer_cache = SubQuestionAnswerCache(
+            similarity_threshold=settings.SUB_QUESTION_CACHE_SIMILARITY_THRESHOLD,
+            ttl_seconds=settings.SUB_QUESTION_CACHE_TTL_SECONDS,
+            max_entries=settings.SUB_QUESTION_CACHE_MAX_ENTRIES,
+        )
+    return _sub_question_answer_cache
@@ -18,3 +18,6 @@ The current date is: {curr_date}
 
 NODE_PARSER_CHUNK_SIZE = 512
 NODE_PARSER_CHUNK_OVERLAP = 10
+
+# Number of dimensions of text-embedding-3-small's embeddings, unless shortened
+EMBEDDING_NATIVE_DIMENSIONS = 1536
@@ -0,0 +1,223 @@
+from typing import Dict, List, Optional
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+import logging
+from cachetools import LRUCache
+from pydantic import PrivateAttr
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from llama_index.core.async_utils import asyncio_run
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models.db import EmbeddingCacheEntry
+from app.chat.utils import hash_text
+
+logger = logging.getLogger(__name__)
+
+# Max number of rows written by a single INSERT statement
+EMBEDDING_CACHE_INSERT_BATCH_SIZE = 500
+
+
+class BaseEmbeddingCacheStore(ABC):
+    """
+    Storage for cached embeddings, keyed by (model, dimensions, text hash).
+    """
+
+    @abstractmethod
+    async def aget_many(
+        self, model: str, dimensions: int, text_hashes: List[str]
+    ) -> Dict[str, Embedding]:
+        """Get the embeddings that exist for the given text hashes."""
+
+    @abstractmethod
+    async def aput_many(
+        self, model: str, dimensions: int, embeddings: Dict[str, Embedding]
+    ) -> None:
+        """Store embeddings by text hash."""
+
+
+class PostgresEmbeddingCacheStore(BaseEmbeddingCacheStore):
+    """
+    Embedding cache backed by the embeddingcacheentry table.
+    """
+
+    async def aget_many(
+        self, model: str, dimensions: int, text_hashes: List[str]
+    ) -> Dict[str, Embedding]:
+        if not text_hashes:
+            return {}
+        stmt = select(
+            EmbeddingCacheEntry.text_hash, EmbeddingCacheEntry.embedding
+        ).where(
+            EmbeddingCacheEntry.model == model,
+            EmbeddingCacheEntry.dimensions == dimensions,
+            EmbeddingCacheEntry.text_hash.in_(text_hashes),
+        )
+        async with SessionLocal() as db:
+            result = await db.execute(stmt)
+            return {
+                text_hash: [float(x) for x in embedding]
+                for text_hash, embedding in result.all()
+            }
+
+    async def aput_many(
+        self, model: str, dimensions: int, embeddings: Dict[str, Embedding]
+    ) -> None:
+        rows = [
+            {
+                "model": model,
+                "dimensions": dimensions,
+                "text_hash": text_hash,
+                "embedding": embedding,
+            }
+            for text_hash, embedding in embeddings.items()
+        ]
+        if not rows:
+            return
+        async with SessionLocal() as db:
+            for i in range(0, len(rows), EMBEDDING_CACHE_INSERT_BATCH_SIZE):
+                stmt = insert(EmbeddingCacheEntry).values(
+                    rows[i : i + EMBEDDING_CACHE_INSERT_BATCH_SIZE]
+                )
+                # another worker embedding the same text wrote the same vector
+                stmt = stmt.on_conflict_do_nothing(
+                    index_elements=[
+                        EmbeddingCacheEntry.model,
+                        EmbeddingCacheEntry.dimensions,
+                        EmbeddingCacheEntry.text_hash,
+                    ]
+                )
+                await db.execute(stmt)
+            await db.commit()
+
+
+@dataclass
+class EmbeddingCacheStats:
+    hits: int
+    misses: int
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"embedding cache: {self.hits} hits, {self.misses} misses "
+            f"({self.hit_rate:.1%} hit rate)"
+        )
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Wraps an embedding model with a persistent cache, so a piece of text is
+    only ever sent to the embedding API once per model.
+
+    Entries are keyed by the model name, its number of dimensions and the
+    SHA-256 of the text.
+
+    Query embeddings are mostly of one-off user questions, so they're only kept
+    in an in-memory LRU cache. They don't cost a database round trip per query
+    or grow the table.
+    """
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _store: BaseEmbeddingCacheStore = PrivateAttr()
+    _query_cache: LRUCache = PrivateAttr()
+    _text_model_key: str = PrivateAttr()
+    _dimensions: int = PrivateAttr()
+    _hits: int = PrivateAttr(default=0)
+    _misses: int = PrivateAttr(default=0)
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        store: Optional[BaseEmbeddingCacheStore] = None,
+        query_cache_size: int = settings.EMBEDDING_CACHE_QUERY_CACHE_SIZE,
+        **kwargs,
+    ):
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            num_workers=embed_model.num_workers,
+            **kwargs,
+        )
+        self._embed_model = embed_model
+        self._store = store or PostgresEmbeddingCacheStore()
+        self._query_cache = LRUCache(maxsize=query_cache_size)
+        # OpenAIEmbedding may use different models for queries & texts
+        self._text_model_key = getattr(embed_model, "_text_engine", None) or (
+            embed_model.model_name
+        )
+        self._dimensions = getattr(embed_model, "dimensions", None) or 0
+        self._hits = 0
+        self._misses = 0
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def embed_model(self) -> BaseEmbedding:
+        return self._embed_model
+
+    def get_stats(self) -> EmbeddingCacheStats:
+        return EmbeddingCacheStats(hits=self._hits, misses=self._misses)
+
+    def reset_stats(self) -> None:
+        self._hits = 0
+        self._misses = 0
+
+    async def _aget_cached_embeddings(self, texts: List[str]) -> List[Embedding]:
+        text_hashes = [hash_text(text) for text in texts]
+        embeddings = await self._store.aget_many(
+            self._text_model_key, self._dimensions, list(set(text_hashes))
+        )
+        # embed each distinct missing text once, even if it repeats in the batch
+        missing = {
+            text_hash: text
+            for text_hash, text in zip(text_hashes, texts)
+            if text_hash not in embeddings
+        }
+        self._hits += len(texts) - len(missing)
+        self._misses += len(missing)
+        if missing:
+            new_embeddings = await self._embed_model._aget_text_embeddings(
+                list(missing.values())
+            )
+            new_entries = dict(zip(missing.keys(), new_embeddings))
+            await self._store.aput_many(
+                self._text_model_key, self._dimensions, new_entries
+            )
+            embeddings.update(new_entries)
+        logger.debug(
+            "Embedded %d texts with %d cache misses", len(texts), len(missing)
+        )
+        return [embeddings[text_hash] for text_hash in text_hashes]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        text_hash = hash_text(query)
+        embedding = self._query_cache.get(text_hash)
+        if embedding is not None:
+            self._hits += 1
+            return embedding
+        self._misses += 1
+        embedding = await self._embed_model._aget_query_embedding(query)
+        self._query_cache[text_hash] = embedding
+        return embedding
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return asyncio_run(self._aget_query_embedding(query))
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return asyncio_run(self._aget_text_embedding(text))
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return await self._aget_cached_embeddings(texts)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return asyncio_run(self._aget_text_embeddings(texts))
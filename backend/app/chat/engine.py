@@ -1,33 +1,35 @@
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple, cast
 import logging
-from pathlib import Path
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
 from datetime import datetime
 import s3fs
 from fsspec.asyn import AsyncFileSystem
 from llama_index.core import (
+    Settings,
     VectorStoreIndex,
     StorageContext,
-    load_indices_from_storage,
 )
+from llama_index.core.indices.registry import INDEX_STRUCT_TYPE_TO_INDEX_CLASS
 from llama_index.core.vector_stores.types import VectorStore
-from tempfile import TemporaryDirectory
-import requests
+from llama_index.core.storage.docstore.keyval_docstore import KVDocumentStore
 import nest_asyncio
-from datetime import timedelta
-from cachetools import cached, TTLCache
-from llama_index.readers.file.docs.base import PDFReader
-from llama_index.core.schema import Document as LlamaIndexDocument
+from cachetools import cached, LRUCache
 from llama_index.core.chat_engine.types import ChatMessage
+from llama_index.core.utils import get_tokenizer
 from llama_index.agent.openai import OpenAIAgent
 from llama_index.llms.openai import OpenAI
 from llama_index.core.base.llms.types import MessageRole
 from llama_index.core.callbacks.base import BaseCallbackHandler, CallbackManager
 from llama_index.core.tools import QueryEngineTool, ToolMetadata
-from llama_index.core.query_engine import SubQuestionQueryEngine
+from llama_index.core.query_engine import SubQuestionQueryEngine, RetrieverQueryEngine
 from llama_index.core.indices.query.base import BaseQueryEngine
+from llama_index.core.response_synthesizers import BaseSynthesizer
 from llama_index.core.vector_stores.types import (
     MetadataFilters,
     ExactMatchFilter,
+    VectorStoreQueryMode,
 )
 from app.core.config import settings
 from app.schema import (
@@ -44,8 +46,21 @@ from app.chat.constants import (
 )
 from app.chat.tools import get_api_query_engine_tool
 from app.chat.utils import build_title_for_document
-from app.chat.pg_vector import get_vector_store_singleton
+from app.chat.pg_vector import CustomPGVectorStore, get_vector_store_singleton
+from app.chat.flat_vectors import FlatVectorStore, get_flat_vector_store_singleton
+from app.chat.retrieval import (
+    VectorStoreQueryBatcher,
+    build_batched_retriever,
+    build_flat_vector_retriever,
+)
 from app.chat.qa_response_synth import get_custom_response_synth
+from app.chat.answer_cache import (
+    SubQuestionAnswerCacheQueryEngine,
+    get_sub_question_answer_cache,
+)
+from app.chat.storage import PostgresKVStore, CachedIndexStore
+from app.chat.ingestion import IngestionPipeline, get_document_sha256
+from app.chat.manifest import IngestionManifest
 
 
 logger = logging.getLogger(__name__)
@@ -55,7 +70,6 @@ logger.info("Applying nested asyncio patch")
 nest_asyncio.apply()
 
 
-
 def get_s3_fs() -> AsyncFileSystem:
     s3 = s3fs.S3FileSystem(
         key=settings.AWS_KEY,
@@ -67,25 +81,6 @@ def get_s3_fs() -> AsyncFileSystem:
     return s3
 
 
-def fetch_and_read_document(
-    document: DocumentSchema,
-) -> List[LlamaIndexDocument]:
-    # Super hacky approach to get this to feature complete on time.
-    # TODO: Come up with better abstractions for this and the other methods in this module.
-    with TemporaryDirectory() as temp_dir:
-        temp_file_path = Path(temp_dir) / f"{str(document.id)}.pdf"
-        with open(temp_file_path, "wb") as temp_file:
-            with requests.get(document.url, stream=True) as r:
-                r.raise_for_status()
-                for chunk in r.iter_content(chunk_size=8192):
-                    temp_file.write(chunk)
-            temp_file.seek(0)
-            reader = PDFReader()
-            return reader.load_data(
-                temp_file_path, extra_info={DB_DOC_ID_KEY: str(document.id)}
-            )
-
-
 def build_description_for_document(document: DocumentSchema) -> str:
     if DocumentMetadataKeysEnum.SEC_DOCUMENT in document.metadata_map:
         sec_metadata = SecDocumentMetadata.parse_obj(
@@ -100,85 +95,135 @@ def build_description_for_document(document: DocumentSchema) -> str:
     return "A document containing useful information that the user pre-selected to discuss with the assistant."
 
 
-def index_to_query_engine(doc_id: str, index: VectorStoreIndex) -> BaseQueryEngine:
+def index_to_query_engine(
+    doc_id: str,
+    index: VectorStoreIndex,
+    query_batcher: Optional[VectorStoreQueryBatcher] = None,
+    flat_vector_store: Optional[FlatVectorStore] = None,
+    content_sha256: Optional[str] = None,
+) -> BaseQueryEngine:
     filters = MetadataFilters(
         filters=[ExactMatchFilter(key=DB_DOC_ID_KEY, value=doc_id)]
     )
-    kwargs = {"similarity_top_k": 3, "filters": filters}
-    return index.as_query_engine(**kwargs)
+    kwargs = {
+        "similarity_top_k": 3,
+        "filters": filters,
+        "vector_store_kwargs": {"exact_search": settings.VECTOR_QUERY_EXACT_SEARCH},
+    }
+    if settings.VECTOR_QUERY_HYBRID_ENABLED:
+        kwargs.update(
+            vector_store_query_mode=VectorStoreQueryMode.HYBRID,
+            similarity_top_k=settings.VECTOR_QUERY_HYBRID_CANDIDATES,
+            sparse_top_k=settings.VECTOR_QUERY_HYBRID_CANDIDATES,
+            hybrid_top_k=3,
+        )
+    elif flat_vector_store is not None and content_sha256 is not None:
+        # searched locally, so there's no round trip for the batcher to save
+        kwargs["vector_store_kwargs"] = {
+            **kwargs["vector_store_kwargs"],
+            "content_sha256": content_sha256,
+        }
+        retriever = build_flat_vector_retriever(index, flat_vector_store, **kwargs)
+        return RetrieverQueryEngine.from_args(retriever, llm=Settings.llm, **kwargs)
+    if query_batcher is None:
+        return index.as_query_engine(**kwargs)
+    retriever = build_batched_retriever(index, query_batcher, **kwargs)
+    return RetrieverQueryEngine.from_args(retriever, llm=Settings.llm, **kwargs)
+
+
+def build_query_batcher(vector_store: VectorStore) -> Optional[VectorStoreQueryBatcher]:
+    if not settings.VECTOR_QUERY_BATCHING_ENABLED or not isinstance(
+        vector_store, CustomPGVectorStore
+    ):
+        return None
+    return VectorStoreQueryBatcher(
+        vector_store,
+        window_seconds=settings.VECTOR_QUERY_BATCH_WINDOW_MS / 1000,
+        max_batch_size=settings.VECTOR_QUERY_MAX_BATCH_SIZE,
+    )
 
 
 @cached(
-    TTLCache(maxsize=10, ttl=timedelta(minutes=5).total_seconds()),
+    LRUCache(maxsize=1),
     key=lambda *args, **kwargs: "global_storage_context",
 )
-def get_storage_context(
-    persist_dir: str, vector_store: VectorStore, fs: Optional[AsyncFileSystem] = None
-) -> StorageContext:
+def get_storage_context(vector_store: VectorStore) -> StorageContext:
+    """
+    Build a storage context whose docstore and index store read and write
+    individual rows in Postgres, rather than loading every document's data
+    up front.
+    """
     logger.info("Creating new storage context.")
+    kvstore = PostgresKVStore()
     return StorageContext.from_defaults(
-        persist_dir=persist_dir, vector_store=vector_store, fs=fs
+        docstore=KVDocumentStore(kvstore),
+        index_store=CachedIndexStore(kvstore),
+        vector_store=vector_store,
     )
 
 
 async def build_doc_id_to_index_map(
     callback_manager: CallbackManager,
     documents: List[DocumentSchema],
-    fs: Optional[AsyncFileSystem] = None,
 ) -> Dict[str, VectorStoreIndex]:
-    persist_dir = f"{settings.S3_BUCKET_NAME}"
-
     vector_store = await get_vector_store_singleton()
-    try:
-        try:
-            storage_context = get_storage_context(persist_dir, vector_store, fs=fs)
-        except FileNotFoundError:
-            logger.info(
-                "Could not find storage context in S3. Creating new storage context."
-            )
-            storage_context = StorageContext.from_defaults(
-                vector_store=vector_store, fs=fs
-            )
-            storage_context.persist(persist_dir=persist_dir, fs=fs)
-        index_ids = [str(doc.id) for doc in documents]
-        indices = load_indices_from_storage(
-            storage_context,
-            index_ids=index_ids,
+    storage_context = get_storage_context(vector_store)
+    index_store = cast(CachedIndexStore, storage_context.index_store)
+    index_ids = [str(doc.id) for doc in documents]
+    index_structs = await index_store.aget_index_structs(index_ids)
+    # built from the structs that were just read, like load_indices_from_storage
+    # does, but without its sync reads of the index store
+    doc_id_to_index: Dict[str, VectorStoreIndex] = {
+        index_id: INDEX_STRUCT_TYPE_TO_INDEX_CLASS[index_struct.get_type()](
+            index_struct=index_struct,
+            storage_context=storage_context,
             callback_manager=callback_manager,
         )
-        doc_id_to_index = dict(zip(index_ids, indices))
+        for index_id, index_struct in index_structs.items()
+    }
+    if doc_id_to_index:
         logger.debug("Loaded indices from storage.")
-    except ValueError:
+
+    missing_docs = [doc for doc in documents if str(doc.id) not in index_structs]
+    if missing_docs:
         logger.error(
-            "Failed to load indices from storage. Creating new indices. "
-            "If you're running the seed_db script, this is normal and expected."
+            "Failed to load %d indices from storage. Creating new indices. "
+            "If you're running the seed_db script, this is normal and expected.",
+            len(missing_docs),
         )
-        storage_context = StorageContext.from_defaults(
-            persist_dir=persist_dir, vector_store=vector_store, fs=fs
+        # the docstore & index store write through to their own rows, so
+        # there's no need to persist the whole storage context afterwards
+        pipeline = IngestionPipeline(
+            storage_context, callback_manager, manifest=IngestionManifest()
         )
-        doc_id_to_index = {}
-        for doc in documents:
-            llama_index_docs = fetch_and_read_document(doc)
-            storage_context.docstore.add_documents(llama_index_docs)
-            index = VectorStoreIndex.from_documents(
-                llama_index_docs,
-                storage_context=storage_context,
-                callback_manager=callback_manager,
-            )
-            index.set_index_id(str(doc.id))
-            index.storage_context.persist(persist_dir=persist_dir, fs=fs)
-            doc_id_to_index[str(doc.id)] = index
-    return doc_id_to_index
+        doc_id_to_index.update(await pipeline.run(missing_docs))
+    return {
+        index_id: doc_id_to_index[index_id]
+        for index_id in index_ids
+        if index_id in doc_id_to_index
+    }
+
+
+@cached(LRUCache(maxsize=4096))
+def count_message_tokens(content: str) -> int:
+    """
+    Number of tokens in a message's content. Messages don't change once they're
+    sent, so the recent messages of a conversation are only tokenized once
+    rather than on every message that's sent after them.
+    """
+    return len(get_tokenizer()(content))
 
 
 def get_chat_history(
     chat_messages: List[MessageSchema],
+    token_budget: Optional[int] = None,
 ) -> List[ChatMessage]:
     """
     Given a list of chat messages, return a list of ChatMessage instances.
 
     Failed chat messages are filtered out and then the remaining ones are
-    sorted by created_at.
+    sorted by created_at. With a token_budget, only the latest messages whose
+    content adds up to at most that many tokens are kept.
     """
     # pre-process chat messages
     chat_messages = [
@@ -186,11 +231,17 @@ def get_chat_history(
         for m in chat_messages
         if m.content.strip() and m.status == MessageStatusEnum.SUCCESS
     ]
-    # TODO: could be a source of high CPU utilization
+    # the messages are usually already in order, which sorting just checks
     chat_messages = sorted(chat_messages, key=lambda m: m.created_at)
 
+    # newest first, so that counting stops at the first message over the budget
     chat_history = []
-    for message in chat_messages:
+    num_tokens = 0
+    for message in reversed(chat_messages):
+        if token_budget is not None:
+            num_tokens += count_message_tokens(message.content)
+            if num_tokens > token_budget:
+                break
         role = (
             MessageRole.ASSISTANT
             if message.role == MessageRoleEnum.assistant
@@ -198,55 +249,168 @@ def get_chat_history(
         )
         chat_history.append(ChatMessage(content=message.content, role=role))
 
+    chat_history.reverse()
     return chat_history
 
 
-async def get_chat_engine(
-    callback_handler: BaseCallbackHandler,
-    conversation: ConversationSchema,
-) -> OpenAIAgent:
-    callback_manager = CallbackManager([callback_handler])
-    s3_fs = get_s3_fs()
-    doc_id_to_index = await build_doc_id_to_index_map(
-        callback_manager, conversation.documents, fs=s3_fs
-    )
-    id_to_doc: Dict[str, DocumentSchema] = {
-        str(doc.id): doc for doc in conversation.documents
-    }
+_request_callback_handlers: ContextVar[Tuple[BaseCallbackHandler, ...]] = ContextVar(
+    "request_callback_handlers", default=()
+)
 
-    vector_query_engine_tools = [
-        QueryEngineTool(
-            query_engine=index_to_query_engine(doc_id, index),
-            metadata=ToolMetadata(
-                name=doc_id,
-                description=build_description_for_document(id_to_doc[doc_id]),
-            ),
-        )
-        for doc_id, index in doc_id_to_index.items()
-    ]
 
-    response_synth = get_custom_response_synth(callback_manager, conversation.documents)
+class RequestScopedCallbackManager(CallbackManager):
+    """
+    CallbackManager whose handlers are looked up from the current asyncio context.
 
-    qualitative_question_engine = SubQuestionQueryEngine.from_defaults(
-        query_engine_tools=vector_query_engine_tools,
+    The cached tool graphs are shared between concurrent requests, so they can't
+    hold a reference to any one request's callback handler. Instead, each request
+    binds its handlers to its own context via bind_request_callback_handlers and
+    every event emitted by the shared graph is dispatched to those handlers.
+    """
+
+    @property
+    def handlers(self) -> List[BaseCallbackHandler]:
+        return self._static_handlers + list(_request_callback_handlers.get())
+
+    @handlers.setter
+    def handlers(self, handlers: List[BaseCallbackHandler]) -> None:
+        self._static_handlers = list(handlers)
+
+    def add_handler(self, handler: BaseCallbackHandler) -> None:
+        self._static_handlers.append(handler)
+
+    def remove_handler(self, handler: BaseCallbackHandler) -> None:
+        self._static_handlers.remove(handler)
+
+
+def bind_request_callback_handlers(*handlers: BaseCallbackHandler) -> None:
+    """
+    Route events from cached tool graphs to the given handlers for the rest of
+    the current task (and any tasks it spawns).
+    """
+    _request_callback_handlers.set(handlers)
+
+
+@dataclass
+class ChatEngineToolGraph:
+    """
+    The parts of a chat engine that only depend on the set of documents in a
+    conversation and can be shared between messages.
+    """
+
+    document_ids: Tuple[str, ...]
+    top_level_sub_tools: List[QueryEngineTool]
+
+
+@dataclass
+class ChatEngineCacheStats:
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+# Sized by the number of documents in each entry, since that's what the memory
+# footprint of a tool graph scales with.
+_tool_graph_cache: LRUCache = LRUCache(
+    maxsize=settings.CHAT_ENGINE_CACHE_MAX_DOCUMENTS,
+    getsizeof=lambda graph: max(len(graph.document_ids), 1),
+)
+_tool_graph_cache_stats = ChatEngineCacheStats()
+
+
+def get_chat_engine_cache_stats() -> ChatEngineCacheStats:
+    return _tool_graph_cache_stats
+
+
+def clear_chat_engine_cache() -> None:
+    global _tool_graph_cache_stats
+    _tool_graph_cache.clear()
+    _tool_graph_cache_stats = ChatEngineCacheStats()
+
+
+def get_document_cache_key(document: DocumentSchema) -> str:
+    """
+    Identifies a version of the document, so that anything cached for a previous
+    version of it isn't reused.
+    """
+    return f"{document.id}:{get_document_sha256(document) or ''}"
+
+
+def get_tool_graph_cache_key(documents: List[DocumentSchema]) -> Tuple[str, ...]:
+    return tuple(sorted(get_document_cache_key(doc) for doc in documents))
+
+
+def build_quantitative_question_engine(
+    documents: List[DocumentSchema],
+    callback_manager: CallbackManager,
+    response_synth: BaseSynthesizer,
+    mode: Optional[str] = None,
+) -> SubQuestionQueryEngine:
+    api_query_engine_tools = [
+        get_api_query_engine_tool(doc, callback_manager, mode)
+        for doc in documents
+        if DocumentMetadataKeysEnum.SEC_DOCUMENT in doc.metadata_map
+    ]
+    return SubQuestionQueryEngine.from_defaults(
+        query_engine_tools=api_query_engine_tools,
         response_synthesizer=response_synth,
         verbose=settings.VERBOSE,
         use_async=True,
     )
 
-    api_query_engine_tools = [
-        get_api_query_engine_tool(doc, callback_manager)
-        for doc in conversation.documents
-        if DocumentMetadataKeysEnum.SEC_DOCUMENT in doc.metadata_map
-    ]
 
-    quantitative_question_engine = SubQuestionQueryEngine.from_defaults(
-        query_engine_tools=api_query_engine_tools,
+async def build_chat_engine_tool_graph(
+    documents: List[DocumentSchema],
+) -> ChatEngineToolGraph:
+    callback_manager = RequestScopedCallbackManager([])
+    doc_id_to_index = await build_doc_id_to_index_map(callback_manager, documents)
+    id_to_doc: Dict[str, DocumentSchema] = {str(doc.id): doc for doc in documents}
+    query_batcher = build_query_batcher(await get_vector_store_singleton())
+    flat_vector_store = (
+        await get_flat_vector_store_singleton()
+        if settings.FLAT_VECTOR_STORE_ENABLED
+        else None
+    )
+
+    vector_query_engine_tools = []
+    for doc_id, index in doc_id_to_index.items():
+        content_sha256 = get_document_sha256(id_to_doc[doc_id])
+        query_engine = index_to_query_engine(
+            doc_id, index, query_batcher, flat_vector_store, content_sha256
+        )
+        if settings.SUB_QUESTION_CACHE_ENABLED:
+            query_engine = SubQuestionAnswerCacheQueryEngine(
+                query_engine,
+                get_sub_question_answer_cache(),
+                cache_key=get_document_cache_key(id_to_doc[doc_id]),
+            )
+        vector_query_engine_tools.append(
+            QueryEngineTool(
+                query_engine=query_engine,
+                metadata=ToolMetadata(
+                    name=doc_id,
+                    description=build_description_for_document(id_to_doc[doc_id]),
+                ),
+            )
+        )
+
+    response_synth = get_custom_response_synth(callback_manager, documents)
+
+    qualitative_question_engine = SubQuestionQueryEngine.from_defaults(
+        query_engine_tools=vector_query_engine_tools,
         response_synthesizer=response_synth,
         verbose=settings.VERBOSE,
         use_async=True,
     )
 
+    quantitative_question_engine = build_quantitative_question_engine(
+        documents, callback_manager, response_synth
+    )
+
     top_level_sub_tools = [
         QueryEngineTool(
             query_engine=qualitative_question_engine,
@@ -269,6 +433,60 @@ Any questions about company-related financials or other metrics should be asked
             ),
         ),
     ]
+    return ChatEngineToolGraph(
+        document_ids=tuple(sorted(id_to_doc)),
+        top_level_sub_tools=top_level_sub_tools,
+    )
+
+
+async def get_chat_engine_tool_graph(
+    documents: List[DocumentSchema],
+) -> ChatEngineToolGraph:
+    """
+    Fetch the tool graph for the given documents from the per-worker LRU cache,
+    building it on a cache miss.
+    """
+    cache_key = get_tool_graph_cache_key(documents)
+    tool_graph = _tool_graph_cache.get(cache_key)
+    if tool_graph is not None:
+        _tool_graph_cache_stats.hits += 1
+        return tool_graph
+
+    _tool_graph_cache_stats.misses += 1
+    start_time = time.perf_counter()
+    tool_graph = await build_chat_engine_tool_graph(documents)
+    logger.info(
+        "Built chat engine tool graph for %d documents in %.3fs (hits=%d, misses=%d)",
+        len(cache_key),
+        time.perf_counter() - start_time,
+        _tool_graph_cache_stats.hits,
+        _tool_graph_cache_stats.misses,
+    )
+    try:
+        _tool_graph_cache[cache_key] = tool_graph
+    except ValueError:
+        # tool graph is larger than the whole cache
+        logger.warning(
+            "Tool graph for %d documents is too large to cache", len(cache_key)
+        )
+    return tool_graph
+
+
+async def get_chat_engine(
+    callback_handler: BaseCallbackHandler,
+    conversation: ConversationSchema,
+) -> OpenAIAgent:
+    """
+    Build the chat engine for a single message in a conversation.
+
+    The document-dependent tool graph is shared between messages via
+    get_chat_engine_tool_graph. Only the callback handler, chat history and
+    system prompt are attached here. Note that this binds callback_handler to
+    the calling task's context.
+    """
+    bind_request_callback_handlers(callback_handler)
+    callback_manager = CallbackManager([callback_handler])
+    tool_graph = await get_chat_engine_tool_graph(conversation.documents)
 
     chat_llm = OpenAI(
         temperature=0,
@@ -277,7 +495,9 @@ Any questions about company-related financials or other metrics should be asked
         api_key=settings.OPENAI_API_KEY,
     )
     chat_messages: List[MessageSchema] = conversation.messages
-    chat_history = get_chat_history(chat_messages)
+    chat_history = get_chat_history(
+        chat_messages, token_budget=settings.CHAT_HISTORY_TOKEN_BUDGET
+    )
     logger.debug("Chat history: %s", chat_history)
 
     if conversation.documents:
@@ -289,7 +509,7 @@ Any questions about company-related financials or other metrics should be asked
 
     curr_date = datetime.utcnow().strftime("%Y-%m-%d")
     chat_engine = OpenAIAgent.from_tools(
-        tools=top_level_sub_tools,
+        tools=tool_graph.top_level_sub_tools,
         llm=chat_llm,
         chat_history=chat_history,
         verbose=settings.VERBOSE,
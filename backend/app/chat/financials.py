@@ -0,0 +1,387 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+import datetime
+import html
+import logging
+import re
+from dataclasses import dataclass
+from uuid import UUID
+from sqlalchemy import delete, select
+from app.db.session import SessionLocal
+from app.models.db import DocumentFinancialFact, FinancialStatementEnum
+from app import schema
+
+logger = logging.getLogger(__name__)
+
+# The figures extracted from a filing: (statement, polygon.io's name for the
+# figure) -> (label, XBRL concepts it may be reported as, in order of preference)
+FinancialConceptKey = Tuple[FinancialStatementEnum, str]
+FINANCIAL_CONCEPTS: Dict[FinancialConceptKey, Tuple[str, List[str]]] = {
+    (FinancialStatementEnum.INCOME_STATEMENT, "revenues"): (
+        "Revenues",
+        [
+            "us-gaap:Revenues",
+            "us-gaap:RevenueFromContractWithCustomerExcludingAssessedTax",
+            "us-gaap:RevenueFromContractWithCustomerIncludingAssessedTax",
+            "us-gaap:SalesRevenueNet",
+        ],
+    ),
+    (FinancialStatementEnum.INCOME_STATEMENT, "cost_of_revenue"): (
+        "Cost Of Revenue",
+        ["us-gaap:CostOfRevenue", "us-gaap:CostOfGoodsAndServicesSold"],
+    ),
+    (FinancialStatementEnum.INCOME_STATEMENT, "gross_profit"): (
+        "Gross Profit",
+        ["us-gaap:GrossProfit"],
+    ),
+    (FinancialStatementEnum.INCOME_STATEMENT, "operating_expenses"): (
+        "Operating Expenses",
+        ["us-gaap:OperatingExpenses", "us-gaap:CostsAndExpenses"],
+    ),
+    (FinancialStatementEnum.INCOME_STATEMENT, "operating_income_loss"): (
+        "Operating Income/Loss",
+        ["us-gaap:OperatingIncomeLoss"],
+    ),
+    (FinancialStatementEnum.INCOME_STATEMENT, "net_income_loss"): (
+        "Net Income/Loss",
+        ["us-gaap:NetIncomeLoss", "us-gaap:ProfitLoss"],
+    ),
+    (FinancialStatementEnum.INCOME_STATEMENT, "basic_earnings_per_share"): (
+        "Basic Earnings Per Share",
+        ["us-gaap:EarningsPerShareBasic"],
+    ),
+    (FinancialStatementEnum.INCOME_STATEMENT, "diluted_earnings_per_share"): (
+        "Diluted Earnings Per Share",
+        ["us-gaap:EarningsPerShareDiluted"],
+    ),
+    (FinancialStatementEnum.BALANCE_SHEET, "assets"): ("Assets", ["us-gaap:Assets"]),
+    (FinancialStatementEnum.BALANCE_SHEET, "current_assets"): (
+        "Current Assets",
+        ["us-gaap:AssetsCurrent"],
+    ),
+    (FinancialStatementEnum.BALANCE_SHEET, "liabilities"): (
+        "Liabilities",
+        ["us-gaap:Liabilities"],
+    ),
+    (FinancialStatementEnum.BALANCE_SHEET, "current_liabilities"): (
+        "Current Liabilities",
+        ["us-gaap:LiabilitiesCurrent"],
+    ),
+    (FinancialStatementEnum.BALANCE_SHEET, "equity"): (
+        "Equity",
+        [
+            "us-gaap:StockholdersEquity",
+            "us-gaap:"
+            "StockholdersEquityIncludingPortionAttributableToNoncontrollingInterest",
+        ],
+    ),
+    (
+        FinancialStatementEnum.CASH_FLOW_STATEMENT,
+        "net_cash_flow_from_operating_activities",
+    ): (
+        "Net Cash Flow From Operating Activities",
+        ["us-gaap:NetCashProvidedByUsedInOperatingActivities"],
+    ),
+    (
+        FinancialStatementEnum.CASH_FLOW_STATEMENT,
+        "net_cash_flow_from_investing_activities",
+    ): (
+        "Net Cash Flow From Investing Activities",
+        ["us-gaap:NetCashProvidedByUsedInInvestingActivities"],
+    ),
+    (
+        FinancialStatementEnum.CASH_FLOW_STATEMENT,
+        "net_cash_flow_from_financing_activities",
+    ): (
+        "Net Cash Flow From Financing Activities",
+        ["us-gaap:NetCashProvidedByUsedInFinancingActivities"],
+    ),
+    (FinancialStatementEnum.CASH_FLOW_STATEMENT, "net_cash_flow"): (
+        "Net Cash Flow",
+        [
+            "us-gaap:CashCashEquivalentsRestrictedCashAndRestrictedCashEquivalents"
+            "PeriodIncreaseDecreaseIncludingExchangeRateEffect",
+            "us-gaap:CashAndCashEquivalentsPeriodIncreaseDecrease",
+        ],
+    ),
+    (
+        FinancialStatementEnum.COMPREHENSIVE_INCOME,
+        "comprehensive_income_loss_attributable_to_parent",
+    ): (
+        "Comprehensive Income/Loss Attributable To Parent",
+        ["us-gaap:ComprehensiveIncomeNetOfTax"],
+    ),
+}
+
+# Length in days of the period of each kind of report's figures
+ANNUAL_PERIOD_DAYS = 365
+QUARTERLY_PERIOD_DAYS = 91
+
+_DOCUMENT_PATTERN = re.compile(r"<DOCUMENT>(.*?)</DOCUMENT>", re.DOTALL)
+_DOCUMENT_FIELD_PATTERN = re.compile(r"^<(TYPE|FILENAME)>([^\n<]+)", re.MULTILINE)
+_ATTRIBUTE_PATTERN = re.compile(r'([\w:.-]+)\s*=\s*"([^"]*)"')
+_CONTEXT_PATTERN = re.compile(
+    r"<(?:xbrli:)?context\b([^>]*)>(.*?)</(?:xbrli:)?context>", re.DOTALL
+)
+_UNIT_PATTERN = re.compile(
+    r"<(?:xbrli:)?unit\b([^>]*)>(.*?)</(?:xbrli:)?unit>", re.DOTALL
+)
+_MEASURE_PATTERN = re.compile(r"<(?:xbrli:)?measure>\s*([^<\s]+)\s*<", re.DOTALL)
+_DATE_PATTERN = r"<(?:xbrli:)?{}>\s*(\d{{4}}-\d{{2}}-\d{{2}})"
+# a fact of an XBRL instance document, e.g. <us-gaap:Assets ...>1</us-gaap:Assets>
+_INSTANCE_FACT_PATTERN = re.compile(
+    r"<([A-Za-z][\w-]*:\w+)\b([^>]*\bunitRef\s*=[^>]*)>([^<]*)</\1>"
+)
+# a fact of an inline XBRL document, e.g. <ix:nonFraction name="us-gaap:Assets" ...>
+_INLINE_FACT_PATTERN = re.compile(
+    r"<ix:nonFraction\b([^>]*?)(?<!/)>(.*?)</ix:nonFraction>",
+    re.DOTALL | re.IGNORECASE,
+)
+_TAG_PATTERN = re.compile(r"<[^>]+>")
+
+
+@dataclass
+class XbrlContext:
+    start_date: Optional[datetime.date]
+    end_date: datetime.date
+    # facts of a dimension of the company, e.g. a single segment, aren't its totals
+    has_dimensions: bool
+
+
+@dataclass
+class XbrlFact:
+    concept: str
+    context_id: str
+    unit_id: str
+    value: float
+
+
+def iter_submission_documents(full_submission: str) -> Iterator[Tuple[str, str, str]]:
+    """
+    The (type, filename, text) of each document of an EDGAR full-submission.txt
+    """
+    for match in _DOCUMENT_PATTERN.finditer(full_submission):
+        document = match.group(1)
+        fields = dict(_DOCUMENT_FIELD_PATTERN.findall(document))
+        doc_type, filename = fields.get("TYPE", ""), fields.get("FILENAME", "")
+        yield doc_type.strip(), filename.strip(), document
+
+
+def get_xbrl_document(full_submission: str) -> Optional[str]:
+    """
+    The XBRL instance document of a submission, or else its inline XBRL
+    primary document.
+    """
+    inline_document = None
+    for doc_type, filename, document in iter_submission_documents(full_submission):
+        # EDGAR extracts the instance document of inline XBRL into *_htm.xml
+        if doc_type == "EX-101.INS" or filename.endswith("_htm.xml"):
+            return document
+        if inline_document is None and "<ix:nonFraction" in document:
+            inline_document = document
+    return inline_document
+
+
+def _parse_attributes(text: str) -> Dict[str, str]:
+    return dict(_ATTRIBUTE_PATTERN.findall(text))
+
+
+def _parse_date(pattern_name: str, text: str) -> Optional[datetime.date]:
+    match = re.search(_DATE_PATTERN.format(pattern_name), text)
+    return datetime.date.fromisoformat(match.group(1)) if match else None
+
+
+def parse_contexts(document: str) -> Dict[str, XbrlContext]:
+    contexts = {}
+    for match in _CONTEXT_PATTERN.finditer(document):
+        context_id = _parse_attributes(match.group(1)).get("id")
+        body = match.group(2)
+        end_date = _parse_date("endDate", body) or _parse_date("instant", body)
+        if context_id is None or end_date is None:
+            continue
+        contexts[context_id] = XbrlContext(
+            start_date=_parse_date("startDate", body),
+            end_date=end_date,
+            has_dimensions="explicitMember" in body or "typedMember" in body,
+        )
+    return contexts
+
+
+def parse_units(document: str) -> Dict[str, str]:
+    """
+    Units by ID, named like polygon.io does, e.g. "USD" or "USD / shares"
+    """
+    units = {}
+    for match in _UNIT_PATTERN.finditer(document):
+        unit_id = _parse_attributes(match.group(1)).get("id")
+        # measures are qualified by their namespace, e.g. iso4217:USD
+        measures = [
+            measure.split(":")[-1]
+            for measure in _MEASURE_PATTERN.findall(match.group(2))
+        ]
+        if unit_id is not None and measures:
+            units[unit_id] = " / ".join(measures)
+    return units
+
+
+def _parse_inline_value(text: str, attributes: Dict[str, str]) -> Optional[float]:
+    text = html.unescape(_TAG_PATTERN.sub("", text)).strip()
+    number_format = attributes.get("format", "")
+    if number_format.endswith(("fixed-zero", "zerodash")) or text in ("-", "—"):
+        value = 0.0
+    else:
+        if "comma-decimal" in number_format or "numcommadecimal" in number_format:
+            text = text.replace(".", "").replace(" ", "").replace(",", ".")
+        else:
+            text = text.replace(",", "").replace(" ", "")
+        try:
+            value = float(text)
+        except ValueError:
+            return None
+    value *= 10 ** int(attributes.get("scale", "0"))
+    return -value if attributes.get("sign") == "-" else value
+
+
+def parse_facts(document: str) -> List[XbrlFact]:
+    """
+    The numeric facts of an XBRL instance or inline XBRL document
+    """
+    facts = []
+    for match in _INSTANCE_FACT_PATTERN.finditer(document):
+        concept, attributes = match.group(1), _parse_attributes(match.group(2))
+        if concept.lower().startswith("ix:") or "contextRef" not in attributes:
+            continue
+        try:
+            value = float(match.group(3).strip())
+        except ValueError:
+            continue
+        facts.append(
+            XbrlFact(concept, attributes["contextRef"], attributes["unitRef"], value)
+        )
+    for match in _INLINE_FACT_PATTERN.finditer(document):
+        attributes = _parse_attributes(match.group(1))
+        if not {"name", "contextRef", "unitRef"} <= attributes.keys():
+            continue
+        value = _parse_inline_value(match.group(2), attributes)
+        if value is not None:
+            facts.append(
+                XbrlFact(
+                    attributes["name"],
+                    attributes["contextRef"],
+                    attributes["unitRef"],
+                    value,
+                )
+            )
+    return facts
+
+
+def extract_financials(
+    full_submission: str,
+    period_of_report_date: datetime.date,
+    is_annual: bool,
+) -> List[schema.DocumentFinancialFact]:
+    """
+    Extract the figures of FINANCIAL_CONCEPTS for the reported period from the
+    XBRL data of an EDGAR full-submission.txt.
+
+    Figures over a period are taken from the period ending at the report date
+    whose length is closest to a year for annual reports, and to a quarter
+    otherwise. Quarterly cash flows are usually only reported year to date.
+    """
+    document = get_xbrl_document(full_submission)
+    if document is None:
+        return []
+    contexts = parse_contexts(document)
+    units = parse_units(document)
+    period_days = ANNUAL_PERIOD_DAYS if is_annual else QUARTERLY_PERIOD_DAYS
+
+    facts_by_concept: Dict[str, List[Tuple[XbrlContext, XbrlFact]]] = {}
+    for fact in parse_facts(document):
+        context = contexts.get(fact.context_id)
+        if (
+            context is not None
+            and not context.has_dimensions
+            and context.end_date == period_of_report_date
+            and fact.unit_id in units
+        ):
+            facts_by_concept.setdefault(fact.concept, []).append((context, fact))
+
+    def distance_from_period(context_and_fact: Tuple[XbrlContext, XbrlFact]) -> int:
+        context, _ = context_and_fact
+        if context.start_date is None:
+            return 0
+        return abs((context.end_date - context.start_date).days - period_days)
+
+    financials = []
+    for (statement, concept), (label, xbrl_concepts) in FINANCIAL_CONCEPTS.items():
+        for xbrl_concept in xbrl_concepts:
+            candidates = facts_by_concept.get(xbrl_concept)
+            if not candidates:
+                continue
+            context, fact = min(candidates, key=distance_from_period)
+            financials.append(
+                schema.DocumentFinancialFact(
+                    statement=statement,
+                    concept=concept,
+                    xbrl_concept=xbrl_concept,
+                    label=label,
+                    value=fact.value,
+                    unit=units[fact.unit_id],
+                    start_date=context.start_date,
+                    end_date=context.end_date,
+                )
+            )
+            break
+    return financials
+
+
+async def aget_document_financials(
+    document_id: UUID,
+) -> List[schema.DocumentFinancialFact]:
+    stmt = (
+        select(DocumentFinancialFact)
+        .where(DocumentFinancialFact.document_id == document_id)
+        .order_by(DocumentFinancialFact.statement, DocumentFinancialFact.concept)
+    )
+    async with SessionLocal() as db:
+        result = await db.execute(stmt)
+        return [
+            schema.DocumentFinancialFact.model_validate(fact)
+            for fact in result.scalars().all()
+        ]
+
+
+async def aget_document_ids_with_financials(document_ids: List[UUID]) -> set:
+    if not document_ids:
+        return set()
+    stmt = (
+        select(DocumentFinancialFact.document_id)
+        .where(DocumentFinancialFact.document_id.in_(document_ids))
+        .distinct()
+    )
+    async with SessionLocal() as db:
+        result = await db.execute(stmt)
+        return set(result.scalars().all())
+
+
+async def areplace_document_financials(
+    document_id: UUID, financials: List[schema.DocumentFinancialFact]
+) -> None:
+    """
+    Replace the financials of a document, e.g. because its filing changed.
+    """
+    async with SessionLocal() as db:
+        await db.execute(
+            delete(DocumentFinancialFact).where(
+                DocumentFinancialFact.document_id == document_id
+            )
+        )
+        db.add_all(
+            DocumentFinancialFact(
+                document_id=document_id,
+                **fact.model_dump(
+                    exclude={"id", "created_at", "updated_at", "document_id"}
+                ),
+            )
+            for fact in financials
+        )
+        await db.commit()
@@ -0,0 +1,428 @@
+from typing import Any, List, Optional, Tuple
+import asyncio
+import json
+import logging
+import os
+import struct
+import threading
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+import numpy as np
+import s3fs
+from cachetools import LRUCache
+from fsspec import AbstractFileSystem
+from pydantic import PrivateAttr
+from llama_index.core.async_utils import asyncio_run
+from llama_index.core.schema import BaseNode, TextNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from app.core.config import settings
+from app.chat.pg_vector import (
+    CustomPGVectorStore,
+    get_filtered_db_document_id,
+    get_vector_store_singleton,
+)
+
+logger = logging.getLogger(__name__)
+
+FLAT_VECTOR_FILE_MAGIC = b"FLATVEC\x00"
+FLAT_VECTOR_FORMAT_VERSION = 1
+# the embedding matrix starts on a 64 byte boundary, so it can be memory mapped
+FLAT_VECTOR_MATRIX_ALIGNMENT = 64
+_HEADER_LENGTH = struct.Struct("<Q")
+# number of flat vector files kept loaded in memory by each worker
+LOADED_FLAT_VECTOR_FILES = 256
+
+
+def _get_matrix_offset(header_length: int) -> int:
+    offset = len(FLAT_VECTOR_FILE_MAGIC) + _HEADER_LENGTH.size + header_length
+    return -(-offset // FLAT_VECTOR_MATRIX_ALIGNMENT) * FLAT_VECTOR_MATRIX_ALIGNMENT
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def encode_flat_vectors(rows: List[dict]) -> bytes:
+    """
+    Encode vector store rows (node_id, text, metadata_ & embedding) as a flat
+    vector file:
+
+    - a magic string, the length of the JSON header & the header itself
+    - the unit-normalized embeddings as a contiguous row-major float16 matrix,
+      aligned to FLAT_VECTOR_MATRIX_ALIGNMENT bytes
+    - a JSON list of the node ID, text & metadata of each row of the matrix
+    """
+    if rows:
+        matrix = np.asarray([row["embedding"] for row in rows], dtype=np.float32)
+    else:
+        matrix = np.zeros((0, 0), dtype=np.float32)
+    matrix = _normalize(matrix).astype("<f2")
+    header = json.dumps(
+        {
+            "version": FLAT_VECTOR_FORMAT_VERSION,
+            "num_vectors": matrix.shape[0],
+            "dim": matrix.shape[1],
+            "dtype": "float16",
+        }
+    ).encode("utf-8")
+    nodes = json.dumps(
+        [
+            {
+                "node_id": row["node_id"],
+                "text": row["text"],
+                "metadata": row["metadata_"],
+            }
+            for row in rows
+        ]
+    ).encode("utf-8")
+    prefix = FLAT_VECTOR_FILE_MAGIC + _HEADER_LENGTH.pack(len(header)) + header
+    padding = b"\x00" * (_get_matrix_offset(len(header)) - len(prefix))
+    return b"".join([prefix, padding, matrix.tobytes(), nodes])
+
+
+class FlatVectorIndex:
+    """
+    The embeddings & nodes of one document, loaded from a flat vector file.
+    The embedding matrix is memory mapped, and searched exactly.
+    """
+
+    def __init__(self, matrix: np.ndarray, nodes: List[dict]):
+        self._matrix = matrix
+        self._nodes = nodes
+
+    @classmethod
+    def from_file(cls, path: Path) -> "FlatVectorIndex":
+        with open(path, "rb") as f:
+            if f.read(len(FLAT_VECTOR_FILE_MAGIC)) != FLAT_VECTOR_FILE_MAGIC:
+                raise ValueError(f"{path} isn't a flat vector file")
+            (header_length,) = _HEADER_LENGTH.unpack(f.read(_HEADER_LENGTH.size))
+            header = json.loads(f.read(header_length))
+            if header.get("version") != FLAT_VECTOR_FORMAT_VERSION:
+                raise ValueError(f"Unsupported flat vector file version in {path}")
+            shape = (header["num_vectors"], header["dim"])
+            matrix_offset = _get_matrix_offset(header_length)
+            f.seek(matrix_offset + shape[0] * shape[1] * 2)
+            nodes = json.loads(f.read())
+        if shape[0] == 0:
+            # an empty file can't be memory mapped
+            matrix = np.zeros(shape, dtype="<f2")
+        else:
+            matrix = np.memmap(
+                path, dtype="<f2", mode="r", offset=matrix_offset, shape=shape
+            )
+        if len(nodes) != shape[0]:
+            raise ValueError(f"Truncated flat vector file {path}")
+        return cls(matrix, nodes)
+
+    @property
+    def dim(self) -> int:
+        return self._matrix.shape[1]
+
+    def __len__(self) -> int:
+        return self._matrix.shape[0]
+
+    def _to_node(self, node_data: dict) -> BaseNode:
+        # the same conversion as PGVectorStore's query results
+        try:
+            node = metadata_dict_to_node(node_data["metadata"])
+            node.set_content(str(node_data["text"]))
+        except Exception:
+            node = TextNode(
+                id_=node_data["node_id"],
+                text=node_data["text"],
+                metadata=node_data["metadata"],
+            )
+        return node
+
+    def query(self, query_embedding: List[float], top_k: int) -> VectorStoreQueryResult:
+        """
+        The top_k rows by cosine similarity to the query embedding.
+        """
+        top_k = min(top_k, len(self))
+        if top_k == 0:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+        query = _normalize(np.asarray(query_embedding, dtype=np.float32))
+        # float16 is only the storage format, the dot products are float32
+        similarities = self._matrix @ query
+        top_indices = np.argpartition(-similarities, top_k - 1)[:top_k]
+        top_indices = sorted(top_indices, key=lambda i: -similarities[i])
+        return VectorStoreQueryResult(
+            nodes=[self._to_node(self._nodes[i]) for i in top_indices],
+            similarities=[float(similarities[i]) for i in top_indices],
+            ids=[self._nodes[i]["node_id"] for i in top_indices],
+        )
+
+
+class FlatVectorFileCache:
+    """
+    Flat vector files of each document, keyed by DB document ID and the SHA-256
+    of the document's file, so a re-ingested document never reads a stale file.
+
+    Reads go to the local directory first and then to the remote fsspec
+    filesystem (S3), which is shared by every worker; remote hits are copied to
+    local disk. The local directory is kept under max_bytes by evicting the least
+    recently used files. Failures of the remote tier are logged and treated as misses.
+    """
+
+    def __init__(
+        self,
+        local_dir: Path,
+        max_bytes: int,
+        fs: Optional[AbstractFileSystem] = None,
+        remote_root: Optional[str] = None,
+    ):
+        self._local_dir = Path(local_dir)
+        self._max_bytes = max_bytes
+        self._fs = fs
+        self._remote_root = remote_root.rstrip("/") if remote_root else None
+        self._loaded: LRUCache = LRUCache(maxsize=LOADED_FLAT_VECTOR_FILES)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _file_name(db_document_id: str, content_sha256: str) -> str:
+        return f"{db_document_id}/{content_sha256}.fvec"
+
+    def _local_path(self, db_document_id: str, content_sha256: str) -> Path:
+        return self._local_dir / self._file_name(db_document_id, content_sha256)
+
+    def _remote_path(self, db_document_id: str, content_sha256: str) -> Optional[str]:
+        if self._fs is None or self._remote_root is None:
+            return None
+        return f"{self._remote_root}/{self._file_name(db_document_id, content_sha256)}"
+
+    def _write_local(
+        self, db_document_id: str, content_sha256: str, data: bytes
+    ) -> None:
+        local_path = self._local_path(db_document_id, content_sha256)
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temp file first so concurrent readers never see a partial file
+        with NamedTemporaryFile(dir=local_path.parent, delete=False) as f:
+            f.write(data)
+        os.replace(f.name, local_path)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Delete the least recently used local files until they fit in max_bytes.
+        Loaded files stay usable, since their memory maps outlive the files.
+        """
+        files: List[Tuple[float, int, Path]] = []
+        for path in self._local_dir.glob("*/*.fvec"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files, key=lambda file: file[0]):
+            if total_bytes <= self._max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes -= size
+
+    def _load_local(
+        self, db_document_id: str, content_sha256: str
+    ) -> Optional[FlatVectorIndex]:
+        local_path = self._local_path(db_document_id, content_sha256)
+        try:
+            index = FlatVectorIndex.from_file(local_path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logger.warning("Ignoring unreadable flat vector file %s", local_path)
+            return None
+        # the modification time is what eviction orders files by
+        os.utime(local_path)
+        return index
+
+    def get(
+        self, db_document_id: str, content_sha256: str
+    ) -> Optional[FlatVectorIndex]:
+        key = (db_document_id, content_sha256)
+        with self._lock:
+            index = self._loaded.get(key)
+        if index is not None:
+            return index
+
+        index = self._load_local(db_document_id, content_sha256)
+        if index is None:
+            remote_path = self._remote_path(db_document_id, content_sha256)
+            if remote_path is None:
+                return None
+            try:
+                with self._fs.open(remote_path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return None
+            except Exception:
+                logger.exception("Error reading flat vector file %s", remote_path)
+                return None
+            self._write_local(db_document_id, content_sha256, data)
+            index = self._load_local(db_document_id, content_sha256)
+            if index is None:
+                return None
+        with self._lock:
+            self._loaded[key] = index
+        return index
+
+    def put(self, db_document_id: str, content_sha256: str, rows: List[dict]) -> None:
+        data = encode_flat_vectors(rows)
+        self._write_local(db_document_id, content_sha256, data)
+        with self._lock:
+            self._loaded.pop((db_document_id, content_sha256), None)
+        remote_path = self._remote_path(db_document_id, content_sha256)
+        if remote_path is None:
+            return
+        try:
+            with self._fs.open(remote_path, "wb") as f:
+                f.write(data)
+        except Exception:
+            logger.exception("Error writing flat vector file %s", remote_path)
+
+    async def aget(
+        self, db_document_id: str, content_sha256: str
+    ) -> Optional[FlatVectorIndex]:
+        return await asyncio.to_thread(self.get, db_document_id, content_sha256)
+
+    async def aput(
+        self, db_document_id: str, content_sha256: str, rows: List[dict]
+    ) -> None:
+        await asyncio.to_thread(self.put, db_document_id, content_sha256, rows)
+
+
+class FlatVectorStore(BasePydanticVectorStore):
+    """
+    Read-only vector store that answers per-document vector searches from flat
+    vector files, and everything else from the Postgres vector store it wraps.
+
+    A search is served from a file when it's a default (vector only) search,
+    filtered to a single DB document, and given that document's content_sha256
+    as a keyword argument, e.g. through a retriever's vector_store_kwargs.
+    A document whose file is in neither the local nor the remote tier has it
+    built from its rows in Postgres, which remains the source of truth.
+    Writes go straight to Postgres.
+    """
+
+    stores_text: bool = True
+    flat_metadata: bool = False
+
+    _fallback: CustomPGVectorStore = PrivateAttr()
+    _file_cache: FlatVectorFileCache = PrivateAttr()
+
+    def __init__(
+        self, fallback: CustomPGVectorStore, file_cache: FlatVectorFileCache
+    ) -> None:
+        super().__init__()
+        self._fallback = fallback
+        self._file_cache = file_cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FlatVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        return self._fallback.add(nodes, **add_kwargs)
+
+    async def async_add(self, nodes: List[BaseNode], **kwargs: Any) -> List[str]:
+        return await self._fallback.async_add(nodes, **kwargs)
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        self._fallback.delete(ref_doc_id, **delete_kwargs)
+
+    async def adelete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        await self._fallback.adelete(ref_doc_id, **delete_kwargs)
+
+    @staticmethod
+    def _get_served_db_document_id(query: VectorStoreQuery) -> Optional[str]:
+        if (
+            query.mode != VectorStoreQueryMode.DEFAULT
+            or query.query_embedding is None
+            or query.node_ids
+            or query.doc_ids
+            or query.filters is None
+            or len(query.filters.filters) != 1
+        ):
+            return None
+        return get_filtered_db_document_id(query.filters)
+
+    async def _aget_index(
+        self, db_document_id: str, content_sha256: str, dim: int
+    ) -> Optional[FlatVectorIndex]:
+        index = await self._file_cache.aget(db_document_id, content_sha256)
+        # a file of another number of dimensions predates a change of
+        # EMBEDDING_DIMENSIONS, and is rebuilt
+        if index is not None and index.dim == dim:
+            return index
+        rows = await self._fallback.aget_db_document_rows(db_document_id)
+        if not rows:
+            # not ingested yet, or still being ingested
+            return None
+        await self._file_cache.aput(db_document_id, content_sha256, rows)
+        return await self._file_cache.aget(db_document_id, content_sha256)
+
+    def query(
+        self,
+        query: VectorStoreQuery,
+        content_sha256: Optional[str] = None,
+        **kwargs: Any,
+    ) -> VectorStoreQueryResult:
+        return asyncio_run(self.aquery(query, content_sha256=content_sha256, **kwargs))
+
+    async def aquery(
+        self,
+        query: VectorStoreQuery,
+        content_sha256: Optional[str] = None,
+        **kwargs: Any,
+    ) -> VectorStoreQueryResult:
+        db_document_id = self._get_served_db_document_id(query)
+        if db_document_id is not None and content_sha256 is not None:
+            index = await self._aget_index(
+                db_document_id, content_sha256, len(query.query_embedding)
+            )
+            if index is not None and index.dim == len(query.query_embedding):
+                return index.query(query.query_embedding, query.similarity_top_k)
+        return await self._fallback.aquery(query, **kwargs)
+
+
+_flat_vector_file_cache: Optional[FlatVectorFileCache] = None
+_flat_vector_store: Optional[FlatVectorStore] = None
+
+
+def get_flat_vector_file_cache() -> FlatVectorFileCache:
+    global _flat_vector_file_cache
+    if _flat_vector_file_cache is None:
+        fs = None
+        if settings.FLAT_VECTOR_S3_ENABLED:
+            fs = s3fs.S3FileSystem(
+                key=settings.AWS_KEY,
+                secret=settings.AWS_SECRET,
+                endpoint_url=settings.S3_ENDPOINT_URL,
+            )
+        _flat_vector_file_cache = FlatVectorFileCache(
+            local_dir=Path(settings.FLAT_VECTOR_CACHE_DIR),
+            max_bytes=settings.FLAT_VECTOR_CACHE_MAX_BYTES,
+            fs=fs,
+            remote_root=f"{settings.S3_BUCKET_NAME}/{settings.FLAT_VECTOR_S3_PREFIX}",
+        )
+    return _flat_vector_file_cache
+
+
+async def get_flat_vector_store_singleton() -> FlatVectorStore:
+    global _flat_vector_store
+    if _flat_vector_store is None:
+        _flat_vector_store = FlatVectorStore(
+            fallback=await get_vector_store_singleton(),
+            file_cache=get_flat_vector_file_cache(),
+        )
+    return _flat_vector_store
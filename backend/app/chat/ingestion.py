@@ -0,0 +1,467 @@
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, cast
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import anyio
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
+import httpx
+from llama_index.core import Settings, StorageContext, VectorStoreIndex
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.data_structs.data_structs import IndexDict
+from llama_index.core.indices.utils import async_embed_nodes
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.schema import BaseNode, Document as LlamaIndexDocument
+from app.core.config import settings
+from app.schema import Document as DocumentSchema, DocumentMetadataKeysEnum
+from app.chat.constants import DB_DOC_ID_KEY
+from app.chat import pdf_parsing
+from app.chat.page_cache import PageTexts, get_page_text_cache
+from app.chat.flat_vectors import get_flat_vector_file_cache
+from app.chat.manifest import IngestionManifest
+from app.chat.pg_vector import CustomPGVectorStore
+from app.chat.storage import CachedIndexStore
+from app.models.db import IngestionStageEnum
+
+logger = logging.getLogger(__name__)
+
+
+_pdf_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_pdf_process_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    Process pool that PDF parsing is offloaded to, so that parsing a large filing
+    neither blocks the event loop nor is limited to a single core.
+
+    Returns None when PDF_PARSER_PROCESSES is 0, in which case parsing runs in
+    the event loop's default thread pool instead.
+    """
+    global _pdf_process_pool
+    if settings.PDF_PARSER_PROCESSES <= 0:
+        return None
+    if _pdf_process_pool is None:
+        _pdf_process_pool = ProcessPoolExecutor(
+            max_workers=settings.PDF_PARSER_PROCESSES,
+            # forking a process that's running an event loop & DB connection pool
+            # is unsafe
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pdf_process_pool
+
+
+def shutdown_pdf_process_pool() -> None:
+    global _pdf_process_pool
+    if _pdf_process_pool is not None:
+        _pdf_process_pool.shutdown(cancel_futures=True)
+        _pdf_process_pool = None
+
+
+async def download_document(document: DocumentSchema, file_path: Path) -> str:
+    """
+    Download the document to file_path and return the SHA-256 of its contents.
+    """
+    hasher = hashlib.sha256()
+    async with httpx.AsyncClient(
+        timeout=settings.DOCUMENT_DOWNLOAD_TIMEOUT_SECONDS, follow_redirects=True
+    ) as client:
+        async with client.stream("GET", document.url) as r:
+            r.raise_for_status()
+            with open(file_path, "wb") as f:
+                async for chunk in r.aiter_bytes(chunk_size=64 * 1024):
+                    hasher.update(chunk)
+                    f.write(chunk)
+    return hasher.hexdigest()
+
+
+def get_document_sha256(document: DocumentSchema) -> Optional[str]:
+    """
+    The SHA-256 of the document's file, if it was recorded when the document was
+    upserted.
+    """
+    return (document.metadata_map or {}).get(DocumentMetadataKeysEnum.CONTENT_SHA256)
+
+
+async def extract_pages(file_path: Path) -> PageTexts:
+    """
+    Extract the (page_label, text) of every page of a PDF, using the text
+    extraction backend set in PDF_PARSER_BACKEND.
+
+    The pages are split into ranges of PDF_PARSER_PAGES_PER_TASK that are parsed
+    in parallel by the PDF process pool.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_pdf_process_pool()
+    backend = settings.PDF_PARSER_BACKEND
+    path_str = str(file_path)
+    num_pages = await loop.run_in_executor(
+        pool, pdf_parsing.count_pages, backend, path_str
+    )
+    pages_per_task = max(settings.PDF_PARSER_PAGES_PER_TASK, 1)
+    page_ranges = await asyncio.gather(
+        *(
+            loop.run_in_executor(
+                pool,
+                pdf_parsing.extract_page_range,
+                backend,
+                path_str,
+                start,
+                min(start + pages_per_task, num_pages),
+            )
+            for start in range(0, num_pages, pages_per_task)
+        )
+    )
+    return [page for page_range in page_ranges for page in page_range]
+
+
+def pages_to_documents(
+    document: DocumentSchema, pages: PageTexts
+) -> List[LlamaIndexDocument]:
+    """
+    One LlamaIndex document per page, with the same metadata PDFReader would set.
+    """
+    file_name = f"{str(document.id)}.pdf"
+    return [
+        LlamaIndexDocument(
+            text=page_text,
+            metadata={
+                "page_label": page_label,
+                "file_name": file_name,
+                DB_DOC_ID_KEY: str(document.id),
+            },
+        )
+        for page_label, page_text in pages
+    ]
+
+
+async def read_document(
+    document: DocumentSchema, file_path: Path
+) -> List[LlamaIndexDocument]:
+    """
+    Parse a PDF into one LlamaIndex document per page, the same way PDFReader does.
+    """
+    return pages_to_documents(document, await extract_pages(file_path))
+
+
+async def get_cached_pages(document: DocumentSchema) -> Optional[PageTexts]:
+    """
+    Look up the document's page text in the page text cache without downloading
+    it. Only possible if the document's SHA-256 is known.
+    """
+    sha256 = get_document_sha256(document)
+    if sha256 is None:
+        return None
+    return await get_page_text_cache().aget(sha256, settings.PDF_PARSER_BACKEND)
+
+
+async def read_document_with_cache(sha256: str, file_path: Path) -> PageTexts:
+    """
+    Extract the pages of a downloaded PDF, unless they were already cached
+    under its SHA-256.
+    """
+    cache = get_page_text_cache()
+    backend = settings.PDF_PARSER_BACKEND
+    pages = await cache.aget(sha256, backend)
+    if pages is None:
+        pages = await extract_pages(file_path)
+        await cache.aput(sha256, backend, pages)
+    return pages
+
+
+async def fetch_and_read_document(
+    document: DocumentSchema,
+) -> List[LlamaIndexDocument]:
+    pages = await get_cached_pages(document)
+    if pages is None:
+        with TemporaryDirectory() as temp_dir:
+            temp_file_path = Path(temp_dir) / f"{str(document.id)}.pdf"
+            sha256 = await download_document(document, temp_file_path)
+            pages = await read_document_with_cache(sha256, temp_file_path)
+    return pages_to_documents(document, pages)
+
+
+@dataclass
+class StageStats:
+    name: str
+    concurrency: int
+    num_items: int = 0
+    num_errors: int = 0
+    busy_seconds: float = 0.0
+    started_at: Optional[float] = None
+    ended_at: Optional[float] = None
+
+    @property
+    def wall_seconds(self) -> float:
+        if self.started_at is None or self.ended_at is None:
+            return 0.0
+        return self.ended_at - self.started_at
+
+    @property
+    def items_per_second(self) -> float:
+        return self.num_items / self.wall_seconds if self.wall_seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name}: {self.num_items} items ({self.num_errors} errors) "
+            f"in {self.wall_seconds:.1f}s, {self.items_per_second:.2f} items/s, "
+            f"busy {self.busy_seconds:.1f}s across {self.concurrency} workers"
+        )
+
+
+@dataclass
+class PipelineStage:
+    """
+    A step of a pipeline that runs fn on each item with at most `concurrency`
+    items in flight.
+    """
+
+    name: str
+    fn: Callable[[Any], Awaitable[Any]]
+    concurrency: int = 1
+    stats: StageStats = field(init=False)
+
+    def __post_init__(self):
+        self.stats = StageStats(name=self.name, concurrency=self.concurrency)
+
+
+async def _run_stage_worker(
+    stage: PipelineStage,
+    recv_chan: MemoryObjectReceiveStream,
+    send_chan: Optional[MemoryObjectSendStream],
+) -> None:
+    stats = stage.stats
+    async with recv_chan:
+        async for item in recv_chan:
+            start_time = time.perf_counter()
+            if stats.started_at is None:
+                stats.started_at = start_time
+            try:
+                result = await stage.fn(item)
+            except Exception:
+                stats.num_errors += 1
+                logger.exception("Pipeline stage %s failed for %s", stage.name, item)
+                continue
+            finally:
+                stats.ended_at = time.perf_counter()
+                stats.busy_seconds += stats.ended_at - start_time
+            stats.num_items += 1
+            if send_chan is not None:
+                await send_chan.send(result)
+    if send_chan is not None:
+        send_chan.close()
+
+
+async def run_pipeline(
+    items: Sequence[Any], stages: List[PipelineStage], queue_size: int = 1
+) -> List[Any]:
+    """
+    Push every item through the stages in order.
+
+    Stages run concurrently with each other and are connected by bounded queues,
+    so a slow stage applies backpressure to the ones before it instead of letting
+    work pile up in memory. Items that fail in any stage are logged and dropped.
+    Returns the outputs of the last stage, in completion order.
+    """
+    results = []
+    async with anyio.create_task_group() as tg:
+        first_send_chan, recv_chan = anyio.create_memory_object_stream(queue_size)
+        for stage in stages:
+            send_chan, next_recv_chan = anyio.create_memory_object_stream(queue_size)
+            async with recv_chan, send_chan:
+                for _ in range(stage.concurrency):
+                    tg.start_soon(
+                        _run_stage_worker, stage, recv_chan.clone(), send_chan.clone()
+                    )
+            recv_chan = next_recv_chan
+
+        async def collect_results():
+            async with recv_chan:
+                async for result in recv_chan:
+                    results.append(result)
+
+        tg.start_soon(collect_results)
+        async with first_send_chan:
+            for item in items:
+                await first_send_chan.send(item)
+    return results
+
+
+@dataclass
+class _IngestionItem:
+    document: DocumentSchema
+    temp_dir: Optional[TemporaryDirectory] = None
+    file_path: Optional[Path] = None
+    sha256: Optional[str] = None
+    pages: Optional[PageTexts] = None
+    llama_index_docs: Optional[List[LlamaIndexDocument]] = None
+    nodes: Optional[List[BaseNode]] = None
+
+
+class IngestionPipeline:
+    """
+    Builds vector indices for documents in separate download, parse, chunk, embed
+    and write stages, so network, CPU and embedding API work overlap across documents.
+
+    The download & parse stages are skipped for documents whose page text is
+    in the page text cache, so re-indexing only chunks and embeds.
+
+    If given a manifest, the pipeline records each stage a document completes
+    and the error it failed with. A retried document resumes where it left off:
+    its parsed pages and embeddings are served from their caches.
+    """
+
+    def __init__(
+        self,
+        storage_context: StorageContext,
+        callback_manager: CallbackManager,
+        download_concurrency: int = settings.INGESTION_DOWNLOAD_CONCURRENCY,
+        parse_concurrency: int = settings.INGESTION_PARSE_CONCURRENCY,
+        chunk_concurrency: int = settings.INGESTION_CHUNK_CONCURRENCY,
+        embed_concurrency: int = settings.INGESTION_EMBED_CONCURRENCY,
+        write_concurrency: int = settings.INGESTION_WRITE_CONCURRENCY,
+        queue_size: int = settings.INGESTION_QUEUE_SIZE,
+        manifest: Optional[IngestionManifest] = None,
+    ):
+        self._storage_context = storage_context
+        self._callback_manager = callback_manager
+        self._queue_size = queue_size
+        self._manifest = manifest
+        self.stages = [
+            self._build_stage("download", self._download, download_concurrency),
+            self._build_stage("parse", self._parse, parse_concurrency),
+            self._build_stage("chunk", self._chunk, chunk_concurrency),
+            self._build_stage("embed", self._embed, embed_concurrency),
+            self._build_stage("write", self._write, write_concurrency),
+        ]
+
+    def _build_stage(
+        self,
+        name: str,
+        fn: Callable[[_IngestionItem], Awaitable[Any]],
+        concurrency: int,
+    ) -> PipelineStage:
+        async def run_and_record_errors(item: _IngestionItem) -> Any:
+            try:
+                return await fn(item)
+            except Exception as e:
+                if self._manifest is not None:
+                    await self._manifest.arecord_error(item.document.url, name, e)
+                raise
+
+        return PipelineStage(name, run_and_record_errors, concurrency)
+
+    async def _record_stage(
+        self,
+        item: _IngestionItem,
+        stage: IngestionStageEnum,
+        content_sha256: Optional[str] = None,
+    ) -> None:
+        if self._manifest is not None:
+            await self._manifest.arecord_stage(
+                item.document.url,
+                stage,
+                document_id=item.document.id,
+                content_sha256=content_sha256,
+            )
+
+    @property
+    def stage_stats(self) -> List[StageStats]:
+        return [stage.stats for stage in self.stages]
+
+    def format_stats(self) -> str:
+        return "\n".join(f"\t- {stats}" for stats in self.stage_stats)
+
+    async def run(
+        self, documents: Sequence[DocumentSchema]
+    ) -> Dict[str, VectorStoreIndex]:
+        items = [_IngestionItem(document=doc) for doc in documents]
+        try:
+            indices = await run_pipeline(items, self.stages, self._queue_size)
+        finally:
+            for item in items:
+                if item.temp_dir is not None:
+                    item.temp_dir.cleanup()
+        logger.info("Ingestion pipeline stats:\n%s", self.format_stats())
+        return {index.index_id: index for index in indices}
+
+    async def _download(self, item: _IngestionItem) -> _IngestionItem:
+        # documents whose page text is already cached are neither downloaded nor parsed
+        item.pages = await get_cached_pages(item.document)
+        if item.pages is not None:
+            return item
+        item.temp_dir = TemporaryDirectory()
+        item.file_path = Path(item.temp_dir.name) / f"{str(item.document.id)}.pdf"
+        item.sha256 = await download_document(item.document, item.file_path)
+        return item
+
+    async def _parse(self, item: _IngestionItem) -> _IngestionItem:
+        if item.pages is None:
+            item.pages = await read_document_with_cache(item.sha256, item.file_path)
+            item.temp_dir.cleanup()
+            item.temp_dir = None
+        item.llama_index_docs = pages_to_documents(item.document, item.pages)
+        item.pages = None
+        await self._record_stage(
+            item,
+            IngestionStageEnum.PARSED,
+            content_sha256=item.sha256 or get_document_sha256(item.document),
+        )
+        return item
+
+    async def _chunk(self, item: _IngestionItem) -> _IngestionItem:
+        item.nodes = await asyncio.to_thread(
+            run_transformations, item.llama_index_docs, Settings.transformations
+        )
+        return item
+
+    async def _embed(self, item: _IngestionItem) -> _IngestionItem:
+        id_to_embedding = await async_embed_nodes(item.nodes, Settings.embed_model)
+        for node in item.nodes:
+            node.embedding = id_to_embedding[node.node_id]
+        await self._record_stage(item, IngestionStageEnum.EMBEDDED)
+        return item
+
+    async def _write(self, item: _IngestionItem) -> VectorStoreIndex:
+        await self._storage_context.docstore.async_add_documents(
+            item.llama_index_docs
+        )
+        vector_store = self._storage_context.vector_store
+        if isinstance(vector_store, CustomPGVectorStore):
+            # also drops what a previous version of the document, or a previous
+            # attempt that failed part way through, left behind
+            await vector_store.areplace_db_document(str(item.document.id), item.nodes)
+        else:
+            await vector_store.async_add(item.nodes)
+        content_sha256 = get_document_sha256(item.document)
+        if (
+            settings.FLAT_VECTOR_STORE_ENABLED
+            and content_sha256 is not None
+            and isinstance(vector_store, CustomPGVectorStore)
+        ):
+            # keyed by the document's SHA-256 like the searches that read it.
+            # Documents without one are searched in Postgres.
+            await get_flat_vector_file_cache().aput(
+                str(item.document.id),
+                content_sha256,
+                vector_store.nodes_to_rows(item.nodes),
+            )
+        # the vector store keeps the node text, so the index struct stays empty.
+        # It's only written (under the document's ID) once the vectors are in,
+        # so a failed ingestion is retried rather than leaving a hollow index.
+        index_struct = IndexDict(index_id=str(item.document.id))
+        index_store = cast(CachedIndexStore, self._storage_context.index_store)
+        await index_store.async_add_index_struct(index_struct)
+        index = VectorStoreIndex(
+            index_struct=index_struct,
+            storage_context=self._storage_context,
+            callback_manager=self._callback_manager,
+        )
+        item.llama_index_docs = None
+        item.nodes = None
+        await self._record_stage(item, IngestionStageEnum.INDEXED)
+        return index
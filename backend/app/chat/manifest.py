@@ -0,0 +1,110 @@
+from typing import Dict, List, Optional
+from uuid import UUID
+from sqlalchemy import select, update, func
+from sqlalchemy.dialects.postgresql import insert
+from app.db.session import SessionLocal
+from app.models.db import IngestionManifestEntry, IngestionStageEnum
+from app import schema
+
+INGESTION_STAGES = list(IngestionStageEnum)
+
+
+def is_stage_done(
+    entry: Optional[schema.IngestionManifestEntry], stage: IngestionStageEnum
+) -> bool:
+    """
+    Whether the entry's document has completed the given stage.
+    """
+    if entry is None:
+        return False
+    return INGESTION_STAGES.index(entry.stage) >= INGESTION_STAGES.index(stage)
+
+
+class IngestionManifest:
+    """
+    Records the last ingestion stage each document completed, along with the
+    hashes of its content, in the ingestionmanifestentry table.
+
+    Seeding uses it to skip documents that are unchanged & fully ingested, and
+    to resume the others at the stage that failed.
+    """
+
+    async def aget_entries(
+        self, urls: Optional[List[str]] = None
+    ) -> Dict[str, schema.IngestionManifestEntry]:
+        """Get the entries of the given URLs, or of every document if None."""
+        stmt = select(IngestionManifestEntry)
+        if urls is not None:
+            if not urls:
+                return {}
+            stmt = stmt.where(IngestionManifestEntry.url.in_(urls))
+        async with SessionLocal() as db:
+            result = await db.execute(stmt)
+            return {
+                entry.url: schema.IngestionManifestEntry.model_validate(entry)
+                for entry in result.scalars().all()
+            }
+
+    async def _aupsert(self, values: dict) -> None:
+        stmt = insert(IngestionManifestEntry).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[IngestionManifestEntry.url],
+            set_={
+                **{key: value for key, value in values.items() if key != "url"},
+                "updated_at": func.now(),
+            },
+        )
+        async with SessionLocal() as db:
+            await db.execute(stmt)
+            await db.commit()
+
+    async def arecord_downloaded(
+        self, url: str, source_sha256: str, content_sha256: Optional[str] = None
+    ) -> None:
+        """
+        Start the document over from the first stage, e.g. because it's new or
+        its source changed.
+        """
+        values = {
+            "url": url,
+            "stage": IngestionStageEnum.DOWNLOADED,
+            "source_sha256": source_sha256,
+            "content_sha256": content_sha256,
+            "document_id": None,
+            "error": None,
+        }
+        await self._aupsert(values)
+
+    async def arecord_stage(
+        self,
+        url: str,
+        stage: IngestionStageEnum,
+        document_id: Optional[UUID] = None,
+        source_sha256: Optional[str] = None,
+        content_sha256: Optional[str] = None,
+    ) -> None:
+        """
+        Record that the document completed the given stage. The document ID &
+        hashes are only updated if given.
+        """
+        values = {"url": url, "stage": stage, "error": None}
+        if document_id is not None:
+            values["document_id"] = document_id
+        if source_sha256 is not None:
+            values["source_sha256"] = source_sha256
+        if content_sha256 is not None:
+            values["content_sha256"] = content_sha256
+        await self._aupsert(values)
+
+    async def arecord_error(self, url: str, stage_name: str, error: Exception) -> None:
+        """
+        Record why the document failed, without changing the stage it last completed.
+        """
+        stmt = (
+            update(IngestionManifestEntry)
+            .where(IngestionManifestEntry.url == url)
+            .values(error=f"{stage_name}: {error!r}"[:2000], updated_at=func.now())
+        )
+        async with SessionLocal() as db:
+            await db.execute(stmt)
+            await db.commit()
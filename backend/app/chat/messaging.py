@@ -1,9 +1,14 @@
-from typing import Dict, Any, Optional, List
+from typing import AsyncIterator, Dict, Any, Optional, List, Union
+from abc import ABC, abstractmethod
 import asyncio
+import datetime
 import logging
+from collections import OrderedDict
+from dataclasses import dataclass
 from uuid import uuid4
-from anyio import ClosedResourceError
-from anyio.streams.memory import MemoryObjectSendStream
+import anyio
+from anyio import BrokenResourceError, ClosedResourceError
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
 
 from llama_index.core.callbacks.base import BaseCallbackHandler
 from llama_index.core.callbacks.schema import CBEventType, EventPayload
@@ -12,15 +17,22 @@ from llama_index.core.chat_engine.types import StreamingAgentChatResponse
 from pydantic import BaseModel
 
 from app import schema
+from app.core.config import settings
 from app.schema import SubProcessMetadataKeysEnum, SubProcessMetadataMap
-from app.models.db import MessageSubProcessSourceEnum
+from app.models.db import (
+    Message,
+    MessageSubProcess,
+    MessageSubProcessSourceEnum,
+    MessageSubProcessStatusEnum,
+)
 from app.chat.engine import get_chat_engine
 
 logger = logging.getLogger(__name__)
 
 
 class StreamedMessage(BaseModel):
-    content: str
+    # text generated since the previous StreamedMessage
+    delta: str
 
 
 class StreamedMessageSubProcess(BaseModel):
@@ -30,29 +42,394 @@ class StreamedMessageSubProcess(BaseModel):
     metadata_map: Optional[SubProcessMetadataMap] = None
 
 
+class StreamedMessageBuilder:
+    """
+    Builds the assistant's Message row from the objects streamed by
+    handle_chat_message, keeping track of the updates that haven't been sent in
+    an SSE event yet.
+    """
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.event_id_to_sub_process: Dict[str, MessageSubProcess] = OrderedDict()
+        self._pending_deltas: List[str] = []
+        # an ordered set of the event IDs of the pending sub-processes
+        self._pending_event_ids: Dict[str, None] = {}
+        self.num_pending_updates = 0
+        self.pending_content_size = 0
+        self.num_updates = 0
+
+    def add(self, message_obj: Union[StreamedMessage, StreamedMessageSubProcess]):
+        if isinstance(message_obj, StreamedMessage):
+            self._pending_deltas.append(message_obj.delta)
+            self.pending_content_size += len(message_obj.delta)
+        elif isinstance(message_obj, StreamedMessageSubProcess):
+            self._add_sub_process(message_obj)
+            self._pending_event_ids[message_obj.event_id] = None
+        else:
+            logger.error(f"Unknown message object type: {type(message_obj)}")
+            return
+        self.num_pending_updates += 1
+        self.num_updates += 1
+
+    def _add_sub_process(self, streamed_sub_process: StreamedMessageSubProcess):
+        """
+        Create the MessageSubProcess row of a streamed sub-process, which replaces
+        the earlier row of the same event.
+        """
+        status = (
+            MessageSubProcessStatusEnum.FINISHED
+            if streamed_sub_process.has_ended
+            else MessageSubProcessStatusEnum.PENDING
+        )
+        event_id = streamed_sub_process.event_id
+        if event_id in self.event_id_to_sub_process:
+            created_at = self.event_id_to_sub_process[event_id].created_at
+        else:
+            created_at = datetime.datetime.utcnow()
+        self.event_id_to_sub_process[event_id] = MessageSubProcess(
+            # NOTE: By setting the created_at to the current time, we are
+            # no longer able to use the created_at field to determine the
+            # time at which the subprocess was inserted into the database.
+            created_at=created_at,
+            message_id=self.message.id,
+            source=streamed_sub_process.source,
+            metadata_map=streamed_sub_process.metadata_map,
+            status=status,
+        )
+
+    def flush(self, encoder: "MessageStreamEncoder") -> Optional[str]:
+        """
+        Apply the pending updates to the message, and encode them into the data
+        of a single SSE event. None when there are no pending updates.
+        """
+        if not self.num_pending_updates:
+            return None
+        delta = "".join(self._pending_deltas)
+        if delta:
+            self.message.content += delta
+        sub_processes = {
+            event_id: self.event_id_to_sub_process[event_id]
+            for event_id in self._pending_event_ids
+        }
+        if sub_processes:
+            self.message.sub_processes = list(self.event_id_to_sub_process.values())
+        self._pending_deltas = []
+        self._pending_event_ids = {}
+        self.num_pending_updates = 0
+        self.pending_content_size = 0
+        return encoder.encode_patch(self.message, delta, sub_processes)
+
+
+class MessageStreamEncoder(ABC):
+    """
+    Encodes the updates of an assistant message being generated into the data
+    of the events of its SSE stream.
+    """
+
+    def encode_start(self, message: Message) -> Optional[str]:
+        return None
+
+    @abstractmethod
+    def encode_patch(
+        self,
+        message: Message,
+        delta: str,
+        sub_processes: Dict[str, MessageSubProcess],
+    ) -> str:
+        """
+        Encode the content appended to the message, and its sub-processes that
+        were added or replaced by event ID.
+        """
+
+    @abstractmethod
+    def encode_final(self, message: schema.Message) -> str:
+        """Encode the message once it's been generated & saved."""
+
+
+class CumulativeMessageStreamEncoder(MessageStreamEncoder):
+    """
+    Every event is the whole message generated so far, so the stream's size
+    grows quadratically with the length of the answer.
+    """
+
+    def encode_patch(
+        self,
+        message: Message,
+        delta: str,
+        sub_processes: Dict[str, MessageSubProcess],
+    ) -> str:
+        return schema.Message.from_orm(message).json()
+
+    def encode_final(self, message: schema.Message) -> str:
+        return message.json()
+
+
+class DeltaMessageStreamEncoder(MessageStreamEncoder):
+    """
+    Events carry only what changed: the empty message, then patches of content
+    deltas & sub-processes, and finally a snapshot of the whole message.
+    """
+
+    def encode_start(self, message: Message) -> Optional[str]:
+        return schema.MessageStreamStart(
+            message=schema.Message.from_orm(message)
+        ).json()
+
+    def encode_patch(
+        self,
+        message: Message,
+        delta: str,
+        sub_processes: Dict[str, MessageSubProcess],
+    ) -> str:
+        return schema.MessageStreamPatch(
+            delta=delta,
+            sub_processes=[
+                schema.MessageSubProcessPatch(
+                    event_id=event_id,
+                    sub_process=schema.MessageSubProcess.from_orm(sub_process),
+                )
+                for event_id, sub_process in sub_processes.items()
+            ],
+        ).json()
+
+    def encode_final(self, message: schema.Message) -> str:
+        return schema.MessageStreamSnapshot(message=message).json()
+
+
+def get_message_stream_encoder(
+    protocol: schema.MessageStreamProtocolEnum,
+) -> MessageStreamEncoder:
+    if protocol == schema.MessageStreamProtocolEnum.CUMULATIVE:
+        return CumulativeMessageStreamEncoder()
+    return DeltaMessageStreamEncoder()
+
+
+@dataclass
+class MessageStreamStats:
+    num_messages: int = 0
+    num_updates: int = 0
+    num_events: int = 0
+    num_bytes: int = 0
+
+    @property
+    def events_per_message(self) -> float:
+        return self.num_events / self.num_messages if self.num_messages else 0.0
+
+    @property
+    def updates_per_event(self) -> float:
+        return self.num_updates / self.num_events if self.num_events else 0.0
+
+
+_message_stream_stats = MessageStreamStats()
+
+
+def get_message_stream_stats() -> MessageStreamStats:
+    return _message_stream_stats
+
+
+def reset_message_stream_stats() -> None:
+    global _message_stream_stats
+    _message_stream_stats = MessageStreamStats()
+
+
+async def astream_message_events(
+    recv_chan: MemoryObjectReceiveStream,
+    builder: StreamedMessageBuilder,
+    encoder: MessageStreamEncoder,
+    flush_interval_ms: float,
+    flush_max_bytes: int,
+) -> AsyncIterator[str]:
+    """
+    Yield the data of the SSE events of the objects streamed by
+    handle_chat_message, until the stream is closed. The updates are batched
+    into one event per flush_interval_ms, or as soon as flush_max_bytes of
+    content is pending, whichever comes first. Each update gets its own event
+    when flush_interval_ms is 0.
+    """
+    flush_interval = flush_interval_ms / 1000
+    events: List[str] = []
+    start_event = encoder.encode_start(builder.message)
+    if start_event is not None:
+        events.append(start_event)
+        yield start_event
+    try:
+        is_open = True
+        while is_open:
+            try:
+                builder.add(await recv_chan.receive())
+                if flush_interval > 0:
+                    # a single timeout per batch, rather than per update
+                    with anyio.move_on_after(flush_interval):
+                        while builder.pending_content_size < flush_max_bytes:
+                            builder.add(await recv_chan.receive())
+            except anyio.EndOfStream:
+                is_open = False
+            event = builder.flush(encoder)
+            if event is not None:
+                events.append(event)
+                yield event
+    finally:
+        _message_stream_stats.num_messages += 1
+        _message_stream_stats.num_updates += builder.num_updates
+        _message_stream_stats.num_events += len(events)
+        _message_stream_stats.num_bytes += sum(map(len, events))
+        logger.debug(
+            "Streamed %d updates of message %s in %d events",
+            builder.num_updates,
+            builder.message.id,
+            len(events),
+        )
+
+
+@dataclass
+class CallbackEventStats:
+    num_dispatched: int = 0
+    # events that arrived after the message's stream was closed
+    num_dropped: int = 0
+    # events that didn't fit in the queue
+    num_overflowed: int = 0
+
+
+_callback_event_stats = CallbackEventStats()
+
+
+def get_callback_event_stats() -> CallbackEventStats:
+    return _callback_event_stats
+
+
+def reset_callback_event_stats() -> None:
+    global _callback_event_stats
+    _callback_event_stats = CallbackEventStats()
+
+
+class CallbackEventDispatcher:
+    """
+    Sends the sub-processes of a message's callback events to its send channel
+    from a single task, in the order the events happened.
+
+    The channel applies backpressure when the message's SSE stream falls
+    behind. Callbacks can't wait for it, so events are queued in the meantime,
+    and the ones that don't fit in the bounded queue are dropped.
+    """
+
+    def __init__(self, send_chan: MemoryObjectSendStream, max_queue_size: int):
+        self._send_chan = send_chan
+        self._queue: "asyncio.Queue[StreamedMessageSubProcess]" = asyncio.Queue(
+            max_queue_size
+        )
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._is_closed = False
+        self.stats = CallbackEventStats()
+
+    async def __aenter__(self) -> "CallbackEventDispatcher":
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.create_task(self._adispatch_events())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if exc_type is None:
+                # send the events of the message before its stream is closed
+                await self._queue.join()
+        finally:
+            self._is_closed = True
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self.stats.num_dropped += self._queue.qsize()
+            _callback_event_stats.num_dispatched += self.stats.num_dispatched
+            _callback_event_stats.num_dropped += self.stats.num_dropped
+            _callback_event_stats.num_overflowed += self.stats.num_overflowed
+            if self.stats.num_dropped or self.stats.num_overflowed:
+                logger.warning(
+                    "Callback events of a message were lost: %s", self.stats
+                )
+
+    def dispatch(self, streamed_sub_process: StreamedMessageSubProcess) -> None:
+        """
+        Queue the sub-process of an event. Safe to call from any thread.
+        """
+        if self._is_closed or self._loop is None:
+            self.stats.num_dropped += 1
+            return
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self._loop:
+            self._put(streamed_sub_process)
+        else:
+            # e.g. a sync query engine running its own event loop in a thread
+            self._loop.call_soon_threadsafe(self._put, streamed_sub_process)
+
+    def _put(self, streamed_sub_process: StreamedMessageSubProcess) -> None:
+        if self._is_closed:
+            self.stats.num_dropped += 1
+            return
+        try:
+            self._queue.put_nowait(streamed_sub_process)
+        except asyncio.QueueFull:
+            self.stats.num_overflowed += 1
+
+    async def _adispatch_events(self) -> None:
+        while True:
+            streamed_sub_process = await self._queue.get()
+            try:
+                await self._send_chan.send(streamed_sub_process)
+                self.stats.num_dispatched += 1
+            except (ClosedResourceError, BrokenResourceError):
+                logger.debug(
+                    "Tried sending SubProcess event (source=%s) after channel was "
+                    "closed",
+                    streamed_sub_process.source,
+                )
+                self.stats.num_dropped += 1
+            finally:
+                self._queue.task_done()
+
+
+def get_streamed_callback_event_types() -> List[CBEventType]:
+    return [
+        CBEventType(event_type) for event_type in settings.CHAT_CALLBACK_EVENT_TYPES
+    ]
+
+
 class ChatCallbackHandler(BaseCallbackHandler):
     def __init__(
         self,
         send_chan: MemoryObjectSendStream,
+        event_types: Optional[List[CBEventType]] = None,
+        max_queue_size: Optional[int] = None,
     ):
-        """Initialize the base callback handler."""
-        ignored_events = [CBEventType.CHUNKING, CBEventType.NODE_PARSING]
+        """
+        Initialize the callback handler, which streams the given event types
+        (CHAT_CALLBACK_EVENT_TYPES by default) & ignores the others.
+        """
+        if event_types is None:
+            event_types = get_streamed_callback_event_types()
+        ignored_events = [
+            event_type for event_type in CBEventType if event_type not in event_types
+        ]
         super().__init__(ignored_events, ignored_events)
-        self._send_chan = send_chan
+        self.dispatcher = CallbackEventDispatcher(
+            send_chan, max_queue_size or settings.CHAT_CALLBACK_QUEUE_SIZE
+        )
 
     def on_event_start(
         self,
         event_type: CBEventType,
         payload: Optional[Dict[str, Any]] = None,
         event_id: str = "",
+        parent_id: str = "",
         **kwargs: Any,
     ) -> str:
-        """Create the MessageSubProcess row for the event that started."""
-        asyncio.create_task(
-            self.async_on_event(
-                event_type, payload, event_id, is_start_event=True, **kwargs
-            )
-        )
+        """Stream the MessageSubProcess of the event that started."""
+        self.on_event(event_type, payload, event_id, is_start_event=True)
+        return event_id
 
     def on_event_end(
         self,
@@ -61,12 +438,8 @@ class ChatCallbackHandler(BaseCallbackHandler):
         event_id: str = "",
         **kwargs: Any,
     ) -> None:
-        """Create the MessageSubProcess row for the event that completed."""
-        asyncio.create_task(
-            self.async_on_event(
-                event_type, payload, event_id, is_start_event=False, **kwargs
-            )
-        )
+        """Stream the MessageSubProcess of the event that completed."""
+        self.on_event(event_type, payload, event_id, is_start_event=False)
 
     def get_metadata_from_event(
         self,
@@ -86,33 +459,24 @@ class ChatCallbackHandler(BaseCallbackHandler):
             ] = schema.QuestionAnswerPair.from_sub_question_answer_pair(sub_q).dict()
         return metadata_map
 
-    async def async_on_event(
+    def on_event(
         self,
         event_type: CBEventType,
         payload: Optional[Dict[str, Any]] = None,
         event_id: str = "",
         is_start_event: bool = False,
-        **kwargs: Any,
     ) -> None:
         metadata_map = self.get_metadata_from_event(
             event_type, payload=payload, is_start_event=is_start_event
         )
-        metadata_map = metadata_map or None
-        source = MessageSubProcessSourceEnum[event_type.name]
-        if self._send_chan._closed:
-            logger.debug("Received event after send channel closed. Ignoring.")
-            return
-        try:
-            await self._send_chan.send(
-                StreamedMessageSubProcess(
-                    source=source,
-                    metadata_map=metadata_map,
-                    event_id=event_id,
-                    has_ended=not is_start_event,
-                )
+        self.dispatcher.dispatch(
+            StreamedMessageSubProcess(
+                source=MessageSubProcessSourceEnum[event_type.name],
+                metadata_map=metadata_map or None,
+                event_id=event_id,
+                has_ended=not is_start_event,
             )
-        except ClosedResourceError:
-            logger.exception("Tried sending SubProcess event %s after channel was closed", f"(source={source})")
+        )
 
     def start_trace(self, trace_id: Optional[str] = None) -> None:
         """No-op."""
@@ -131,38 +495,52 @@ async def handle_chat_message(
     send_chan: MemoryObjectSendStream,
 ) -> None:
     async with send_chan:
-        chat_engine = await get_chat_engine(
-            ChatCallbackHandler(send_chan), conversation
-        )
-        await send_chan.send(
-            StreamedMessageSubProcess(
-                event_id=str(uuid4()),
-                has_ended=True,
-                source=MessageSubProcessSourceEnum.CONSTRUCTED_QUERY_ENGINE,
+        callback_handler = ChatCallbackHandler(send_chan)
+        async with callback_handler.dispatcher:
+            await _astream_chat_response(
+                conversation, user_message, send_chan, callback_handler
             )
+
+
+async def _astream_chat_response(
+    conversation: schema.Conversation,
+    user_message: schema.UserMessageCreate,
+    send_chan: MemoryObjectSendStream,
+    callback_handler: ChatCallbackHandler,
+) -> None:
+    chat_engine = await get_chat_engine(callback_handler, conversation)
+    await send_chan.send(
+        StreamedMessageSubProcess(
+            event_id=str(uuid4()),
+            has_ended=True,
+            source=MessageSubProcessSourceEnum.CONSTRUCTED_QUERY_ENGINE,
         )
-        logger.debug("Engine received")
-        templated_message = f"""
+    )
+    logger.debug("Engine received")
+    templated_message = f"""
 Remember - if I have asked a relevant financial question, use your tools.
 
 {user_message.content}
-        """.strip()
-        streaming_chat_response: StreamingAgentChatResponse = (
-            await chat_engine.astream_chat(templated_message)
-        )
-        response_str = ""
-        async for text in streaming_chat_response.async_response_gen():
-            response_str += text
-            if send_chan._closed:
-                logger.debug(
-                    "Received streamed token after send channel closed. Ignoring."
-                )
-                return
-            await send_chan.send(StreamedMessage(content=response_str))
+    """.strip()
+    streaming_chat_response: StreamingAgentChatResponse = (
+        await chat_engine.astream_chat(templated_message)
+    )
+    is_empty_response = True
+    async for text in streaming_chat_response.async_response_gen():
+        is_empty_response = is_empty_response and text.strip() == ""
+        if send_chan._closed:
+            logger.debug(
+                "Received streamed token after send channel closed. Ignoring."
+            )
+            return
+        await send_chan.send(StreamedMessage(delta=text))
 
-        if response_str.strip() == "":
-            await send_chan.send(
-                StreamedMessage(
-                    content="Sorry, I either wasn't able to understand your question or I don't have an answer for it."
+    if is_empty_response:
+        await send_chan.send(
+            StreamedMessage(
+                delta=(
+                    "Sorry, I either wasn't able to understand your question or I "
+                    "don't have an answer for it."
                 )
             )
+        )
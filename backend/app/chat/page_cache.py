@@ -0,0 +1,153 @@
+from typing import List, Optional, Tuple
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+import s3fs
+from fsspec import AbstractFileSystem
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# (page_label, text) for each page of a PDF, as returned by pdf_parsing
+PageTexts = List[Tuple[str, str]]
+
+PAGE_TEXT_CACHE_FORMAT_VERSION = 1
+
+
+def sha256_file(file_path: Path, chunk_size: int = 1024 * 1024) -> str:
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _encode_pages(pages: PageTexts) -> bytes:
+    return gzip.compress(
+        json.dumps(
+            {"version": PAGE_TEXT_CACHE_FORMAT_VERSION, "pages": pages}
+        ).encode("utf-8")
+    )
+
+
+def _decode_pages(data: bytes) -> Optional[PageTexts]:
+    payload = json.loads(gzip.decompress(data))
+    if payload.get("version") != PAGE_TEXT_CACHE_FORMAT_VERSION:
+        return None
+    return [(page_label, text) for page_label, text in payload["pages"]]
+
+
+class PageTextCache:
+    """
+    Content-addressed cache of the text extracted from PDFs, so re-chunking or
+    re-embedding documents doesn't need to download & parse them again.
+
+    Entries are keyed by the SHA-256 of the PDF and the parser backend that
+    extracted the text, and are stored as gzipped JSON. Reads go to the local
+    directory first and then to the remote fsspec filesystem (S3), which is
+    shared by every worker; remote hits are copied to local disk.
+    Failures of the remote tier are logged and treated as misses.
+    """
+
+    def __init__(
+        self,
+        local_dir: Path,
+        fs: Optional[AbstractFileSystem] = None,
+        remote_root: Optional[str] = None,
+    ):
+        self._local_dir = Path(local_dir)
+        self._fs = fs
+        self._remote_root = remote_root.rstrip("/") if remote_root else None
+
+    @staticmethod
+    def _file_name(sha256: str, backend: str) -> str:
+        return f"{sha256}.{backend}.json.gz"
+
+    def _local_path(self, sha256: str, backend: str) -> Path:
+        # shard by hash prefix to keep directories small
+        return self._local_dir / sha256[:2] / self._file_name(sha256, backend)
+
+    def _remote_path(self, sha256: str, backend: str) -> Optional[str]:
+        if self._fs is None or self._remote_root is None:
+            return None
+        return f"{self._remote_root}/{sha256[:2]}/{self._file_name(sha256, backend)}"
+
+    def _write_local(self, sha256: str, backend: str, data: bytes) -> None:
+        local_path = self._local_path(sha256, backend)
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temp file first so concurrent readers never see a partial entry
+        with NamedTemporaryFile(dir=local_path.parent, delete=False) as f:
+            f.write(data)
+        os.replace(f.name, local_path)
+
+    def get(self, sha256: str, backend: str) -> Optional[PageTexts]:
+        local_path = self._local_path(sha256, backend)
+        if local_path.exists():
+            try:
+                return _decode_pages(local_path.read_bytes())
+            except (OSError, ValueError):
+                logger.warning(
+                    "Ignoring unreadable page text cache entry %s", local_path
+                )
+
+        remote_path = self._remote_path(sha256, backend)
+        if remote_path is None:
+            return None
+        try:
+            with self._fs.open(remote_path, "rb") as f:
+                data = f.read()
+            pages = _decode_pages(data)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.exception("Error reading page text cache entry %s", remote_path)
+            return None
+        if pages is not None:
+            self._write_local(sha256, backend, data)
+        return pages
+
+    def put(self, sha256: str, backend: str, pages: PageTexts) -> None:
+        data = _encode_pages(pages)
+        self._write_local(sha256, backend, data)
+        remote_path = self._remote_path(sha256, backend)
+        if remote_path is None:
+            return
+        try:
+            with self._fs.open(remote_path, "wb") as f:
+                f.write(data)
+        except Exception:
+            logger.exception("Error writing page text cache entry %s", remote_path)
+
+    async def aget(self, sha256: str, backend: str) -> Optional[PageTexts]:
+        return await asyncio.to_thread(self.get, sha256, backend)
+
+    async def aput(self, sha256: str, backend: str, pages: PageTexts) -> None:
+        await asyncio.to_thread(self.put, sha256, backend, pages)
+
+
+_page_text_cache: Optional[PageTextCache] = None
+
+
+def get_page_text_cache() -> PageTextCache:
+    global _page_text_cache
+    if _page_text_cache is None:
+        fs = None
+        if settings.PAGE_TEXT_CACHE_S3_ENABLED:
+            fs = s3fs.S3FileSystem(
+                key=settings.AWS_KEY,
+                secret=settings.AWS_SECRET,
+                endpoint_url=settings.S3_ENDPOINT_URL,
+            )
+        _page_text_cache = PageTextCache(
+            local_dir=Path(settings.PAGE_TEXT_CACHE_DIR),
+            fs=fs,
+            remote_root=(
+                f"{settings.S3_BUCKET_NAME}/{settings.PAGE_TEXT_CACHE_S3_PREFIX}"
+            ),
+        )
+    return _page_text_cache
@@ -0,0 +1,142 @@
+"""
+PDF text extraction that runs inside worker processes.
+
+This module is imported by every worker process of the PDF parsing pool, so it
+should stay free of heavy imports (LlamaIndex, the app settings, etc.).
+Backends other than pypdf are only imported when used.
+"""
+from typing import Dict, List, Tuple, Type
+from abc import ABC, abstractmethod
+from enum import Enum
+import pypdf
+
+
+class PdfParserBackendEnum(str, Enum):
+    """
+    Enum for the available PDF text extraction backends
+    """
+
+    PYPDF = "pypdf"
+    PYMUPDF = "pymupdf"
+    PDFIUM = "pdfium"
+
+
+class PdfTextExtractor(ABC):
+    """
+    Extracts the text of a PDF page by page.
+
+    Every backend must return the same page labels as PDFReader (the PDF's own
+    page labels, falling back to the 1-based page number), since citations are
+    built from them.
+    """
+
+    @abstractmethod
+    def count_pages(self, file_path: str) -> int:
+        pass
+
+    @abstractmethod
+    def extract_page_range(
+        self, file_path: str, start: int, end: int
+    ) -> List[Tuple[str, str]]:
+        """
+        Extract the text of pages [start, end), as a (page_label, text) tuple per page.
+        """
+
+
+class PypdfTextExtractor(PdfTextExtractor):
+    """
+    Pure python extraction, same as the LlamaIndex PDFReader.
+    """
+
+    def count_pages(self, file_path: str) -> int:
+        return len(pypdf.PdfReader(file_path).pages)
+
+    def extract_page_range(
+        self, file_path: str, start: int, end: int
+    ) -> List[Tuple[str, str]]:
+        pdf = pypdf.PdfReader(file_path)
+        return [
+            (pdf.page_labels[page], pdf.pages[page].extract_text())
+            for page in range(start, end)
+        ]
+
+
+class PyMuPDFTextExtractor(PdfTextExtractor):
+    """
+    Extraction with MuPDF. Requires the pymupdf extra, `poetry install -E pymupdf`,
+    since MuPDF is AGPL licensed.
+    """
+
+    def count_pages(self, file_path: str) -> int:
+        import pymupdf
+
+        with pymupdf.open(file_path) as pdf:
+            return pdf.page_count
+
+    def extract_page_range(
+        self, file_path: str, start: int, end: int
+    ) -> List[Tuple[str, str]]:
+        import pymupdf
+
+        with pymupdf.open(file_path) as pdf:
+            pages = []
+            for page_number in range(start, end):
+                page = pdf[page_number]
+                page_label = page.get_label() or str(page_number + 1)
+                pages.append((page_label, page.get_text()))
+            return pages
+
+
+class PdfiumTextExtractor(PdfTextExtractor):
+    """
+    Extraction with PDFium.
+    """
+
+    def count_pages(self, file_path: str) -> int:
+        import pypdfium2
+
+        pdf = pypdfium2.PdfDocument(file_path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+
+    def extract_page_range(
+        self, file_path: str, start: int, end: int
+    ) -> List[Tuple[str, str]]:
+        import pypdfium2
+
+        pdf = pypdfium2.PdfDocument(file_path)
+        try:
+            pages = []
+            for page_number in range(start, end):
+                page_label = pdf.get_page_label(page_number) or str(page_number + 1)
+                text_page = pdf[page_number].get_textpage()
+                pages.append((page_label, text_page.get_text_range()))
+            return pages
+        finally:
+            pdf.close()
+
+
+PDF_TEXT_EXTRACTORS: Dict[PdfParserBackendEnum, Type[PdfTextExtractor]] = {
+    PdfParserBackendEnum.PYPDF: PypdfTextExtractor,
+    PdfParserBackendEnum.PYMUPDF: PyMuPDFTextExtractor,
+    PdfParserBackendEnum.PDFIUM: PdfiumTextExtractor,
+}
+
+
+def get_pdf_text_extractor(backend: PdfParserBackendEnum) -> PdfTextExtractor:
+    return PDF_TEXT_EXTRACTORS[PdfParserBackendEnum(backend)]()
+
+
+# Module level functions so they can be pickled and sent to the worker processes
+
+
+def count_pages(backend: PdfParserBackendEnum, file_path: str) -> int:
+    return get_pdf_text_extractor(backend).count_pages(file_path)
+
+
+def extract_page_range(
+    backend: PdfParserBackendEnum, file_path: str, start: int, end: int
+) -> List[Tuple[str, str]]:
+    return get_pdf_text_extractor(backend).extract_page_range(file_path, start, end)
@@ -1,21 +1,275 @@
-from llama_index.core.vector_stores.types import VectorStore
+from typing import Any, List, Optional
+import asyncio
+from uuid import UUID
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    FilterCondition,
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+    VectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from llama_index.vector_stores.postgres.base import DBEmbeddingRow
 from llama_index.vector_stores.postgres import PGVectorStore
+from pgvector.sqlalchemy import BIT, HALFVEC, VECTOR
 from sqlalchemy.engine import make_url
 from app.db.session import SessionLocal as AppSessionLocal, engine as app_engine
 import sqlalchemy
-from sqlalchemy import create_engine
+from sqlalchemy import Column, Index, Text, and_, create_engine, func, select
+from sqlalchemy.dialects.postgresql import ARRAY, VARCHAR, insert
 from sqlalchemy.orm import sessionmaker
 from app.core.config import settings
+from app.chat.constants import DB_DOC_ID_KEY, EMBEDDING_NATIVE_DIMENSIONS
+from app.chat.utils import hash_text
 
 singleton_instance = None
 did_run_setup = False
 
 
+def get_content_key_index_name(table_name: str) -> str:
+    return f"{table_name}_content_key_idx"
+
+
+def get_embedding_index_name(table_name: str) -> str:
+    return f"{table_name}_embedding_idx"
+
+
+def get_partition_name(table_name: str, db_document_id: str) -> str:
+    """
+    The name of the partition holding the rows of the given DB document.
+    """
+    try:
+        suffix = UUID(db_document_id).hex
+    except ValueError:
+        suffix = hash_text(db_document_id)[:32]
+    return f"{table_name}_{suffix}"
+
+
+def get_filtered_db_document_id(
+    metadata_filters: Optional[MetadataFilters],
+) -> Optional[str]:
+    """
+    The DB document that the filters restrict a search to, if any.
+    """
+    if metadata_filters is None or (
+        metadata_filters.condition != FilterCondition.AND
+        and len(metadata_filters.filters) > 1
+    ):
+        return None
+    for metadata_filter in metadata_filters.filters:
+        if (
+            isinstance(metadata_filter, MetadataFilter)
+            and metadata_filter.key == DB_DOC_ID_KEY
+            and metadata_filter.operator == FilterOperator.EQ
+        ):
+            return str(metadata_filter.value)
+    return None
+
+
+# Constant of the reciprocal rank fusion of hybrid searches, which keeps the
+# top few ranks of either search from dominating the fused score
+HYBRID_RRF_K = 60
+
+# Query modes that aquery_batch can run in a single round trip
+BATCHED_QUERY_MODES = {VectorStoreQueryMode.DEFAULT, VectorStoreQueryMode.HYBRID}
+
+# Max number of rows written by a single INSERT statement
+VECTOR_STORE_INSERT_BATCH_SIZE = 500
+
+
+def _metadata_field(table: sqlalchemy.Table, key: str) -> Any:
+    # the key has to be a literal rather than a bound parameter, otherwise
+    # Postgres can't match ON CONFLICT to the expression index
+    return table.c.metadata_.op("->>")(
+        sqlalchemy.literal_column(f"'{key}'")
+    ).self_group()
+
+
+def get_content_key_columns(table: sqlalchemy.Table) -> List[Any]:
+    """
+    The expressions a chunk is unique by: its document, page and text.
+    """
+    return [
+        table.c.db_document_id,
+        _metadata_field(table, "page_label"),
+        table.c.text_hash,
+    ]
+
+
+# (distance operator, index operator class) of each VECTOR_INDEX_QUANTIZATION
+QUANTIZATION_OPERATORS = {
+    "none": ("<=>", "vector_cosine_ops"),
+    "halfvec": ("<=>", "halfvec_cosine_ops"),
+    "binary": ("<~>", "bit_hamming_ops"),
+}
+
+
+def quantize_embedding(embedding: Any, dim: int) -> Any:
+    """
+    The compact representation of an embedding expression that the ANN index
+    is built on, as set by VECTOR_INDEX_QUANTIZATION.
+    """
+    if settings.VECTOR_INDEX_QUANTIZATION == "halfvec":
+        return sqlalchemy.cast(embedding, HALFVEC(dim))
+    if settings.VECTOR_INDEX_QUANTIZATION == "binary":
+        return sqlalchemy.cast(func.binary_quantize(embedding), BIT(dim))
+    return embedding
+
+
+def get_quantized_distance(
+    embedding: Any, query_embedding: List[float], dim: int
+) -> Any:
+    """
+    The distance between the compact representations of an embedding column
+    and a query embedding, which the ANN index can order by.
+    """
+    operator, _ = QUANTIZATION_OPERATORS[settings.VECTOR_INDEX_QUANTIZATION]
+    # typed, since binary_quantize is overloaded for vector & halfvec
+    query = sqlalchemy.cast(
+        sqlalchemy.literal(query_embedding, VECTOR(dim)), VECTOR(dim)
+    )
+    return quantize_embedding(embedding, dim).op(
+        operator, return_type=sqlalchemy.Float
+    )(quantize_embedding(query, dim))
+
+
+def get_search_indices(table: sqlalchemy.Table) -> List[Index]:
+    """
+    The ANN index on the embeddings, whose type, build parameters &
+    quantization come from the settings. Postgres builds one per partition,
+    i.e. per document.
+    """
+    if settings.VECTOR_INDEX_TYPE == "ivfflat":
+        index_params = {"lists": settings.VECTOR_INDEX_IVFFLAT_LISTS}
+    else:
+        index_params = {
+            "m": settings.VECTOR_INDEX_HNSW_M,
+            "ef_construction": settings.VECTOR_INDEX_HNSW_EF_CONSTRUCTION,
+        }
+    _, operator_class = QUANTIZATION_OPERATORS[settings.VECTOR_INDEX_QUANTIZATION]
+    expression = table.c.embedding
+    if settings.VECTOR_INDEX_QUANTIZATION != "none":
+        # the operator class of an expression is looked up by its label
+        expression = quantize_embedding(expression, expression.type.dim).label(
+            "embedding"
+        )
+    return [
+        Index(
+            get_embedding_index_name(table.name),
+            expression,
+            postgresql_using=settings.VECTOR_INDEX_TYPE,
+            postgresql_with=index_params,
+            postgresql_ops={"embedding": operator_class},
+        ),
+    ]
+
+
+def build_search_parameters_statement(
+    hnsw_ef_search: Optional[int] = None,
+    ivfflat_probes: Optional[int] = None,
+    exact_search: bool = False,
+    **kwargs: Any,
+) -> Optional[Any]:
+    """
+    A statement setting a similarity search's parameters for the rest of its
+    transaction, or None if it uses the server's defaults. Parameters that
+    aren't given for the query are taken from the settings.
+    """
+    parameters = {
+        "hnsw.ef_search": hnsw_ef_search or settings.VECTOR_QUERY_HNSW_EF_SEARCH,
+        "ivfflat.probes": ivfflat_probes or settings.VECTOR_QUERY_IVFFLAT_PROBES,
+        # ANN indices don't support bitmap scans, so this leaves the planner
+        # only exact plans
+        "enable_indexscan": "off" if exact_search else None,
+    }
+    parameters = {
+        name: value for name, value in parameters.items() if value is not None
+    }
+    if not parameters:
+        return None
+    # SET LOCAL, so the parameters don't leak into the pooled connection
+    set_configs = []
+    bind_params = {}
+    for i, (name, value) in enumerate(parameters.items()):
+        set_configs.append(f"set_config(:name_{i}, :value_{i}, true)")
+        bind_params[f"name_{i}"] = name
+        bind_params[f"value_{i}"] = str(value)
+    return sqlalchemy.text("SELECT " + ", ".join(set_configs)).bindparams(**bind_params)
+
+
+def _reciprocal_rank(rank: Any) -> Any:
+    # 0 for chunks that only one of the searches found
+    return func.coalesce(
+        sqlalchemy.literal_column("1.0")
+        / (sqlalchemy.literal_column(str(HYBRID_RRF_K)) + rank),
+        sqlalchemy.literal_column("0"),
+    )
+
+
+def _get_similarity(item: Any) -> float:
+    # hybrid searches rank by their fused score rather than the distance
+    if "score" in item._fields:
+        return float(item.score)
+    return (1 - item.distance) if item.distance is not None else 0
+
+
+def _to_db_embedding_rows(items: List[Any]) -> List[DBEmbeddingRow]:
+    return [
+        DBEmbeddingRow(
+            node_id=item.node_id,
+            text=item.text,
+            metadata=item.metadata_,
+            similarity=_get_similarity(item),
+        )
+        for item in items
+    ]
+
+
 class CustomPGVectorStore(PGVectorStore):
     """
     Custom PGVectorStore that uses the same connection pool as the FastAPI app.
+
+    The table is list partitioned by DB document ID, with a partition per
+    document. Adding a document's chunks attaches its partition, deleting the
+    document drops it, and searches filtered to a document only scan its
+    partition.
+
+    Rows carry a SHA-256 of their text, and are unique by document, page and
+    text hash. Adding a chunk that's already stored updates the existing row
+    instead of adding a duplicate.
+
+    Hybrid searches fuse a full-text search of the tsvector column, which is
+    written along with each row, with the vector search in a single query, by
+    reciprocal rank fusion.
+
+    Similarity searches accept hnsw_ef_search, ivfflat_probes & exact_search
+    as per-query keyword arguments, e.g. through a retriever's vector_store_kwargs.
     """
 
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._table_class.text_hash = Column(VARCHAR)
+        # the partition key has to be part of the primary key
+        self._table_class.db_document_id = Column(VARCHAR, primary_key=True)
+        table = self._table_class.__table__
+        table.dialect_options["postgresql"]["partition_by"] = "LIST (db_document_id)"
+        Index(
+            get_content_key_index_name(table.name),
+            *get_content_key_columns(table),
+            unique=True,
+        )
+        get_search_indices(table)
+        if self.hybrid_search:
+            # written along with the rows rather than generated, so that adding
+            # the column to a populated table doesn't rewrite every partition
+            text_search_column = table.c.text_search_tsv
+            text_search_column.computed = None
+            text_search_column.server_default = None
+            text_search_column.server_onupdate = None
+
     def _connect(self) -> None:
         self._engine = create_engine(self.connection_string)
         self._session = sessionmaker(self._engine)
@@ -33,6 +287,505 @@ class CustomPGVectorStore(PGVectorStore):
     def _create_tables_if_not_exists(self) -> None:
         pass
 
+    def _node_to_row_dict(self, node: BaseNode) -> dict:
+        row = self._node_to_table_row(node)
+        return {
+            "node_id": row.node_id,
+            "embedding": row.embedding,
+            "text": row.text,
+            "metadata_": row.metadata_,
+            "text_hash": hash_text(row.text),
+            "db_document_id": str(row.metadata_.get(DB_DOC_ID_KEY, "")),
+        }
+
+    def _nodes_to_upsert_rows(self, nodes: List[BaseNode]) -> List[dict]:
+        rows = [self._node_to_row_dict(node) for node in nodes]
+        # a single statement can't upsert the same row twice, last one wins
+        return list(
+            {
+                (
+                    row["db_document_id"],
+                    row["metadata_"].get("page_label"),
+                    row["text_hash"],
+                ): row
+                for row in rows
+            }.values()
+        )
+
+    def nodes_to_rows(self, nodes: List[BaseNode]) -> List[dict]:
+        """
+        The rows that adding the nodes writes, after duplicate chunks are collapsed.
+        """
+        return self._nodes_to_upsert_rows(nodes)
+
+    async def aget_db_document_rows(self, db_document_id: str) -> List[dict]:
+        """
+        Every row of the given DB document, with the same keys as nodes_to_rows.
+        """
+        self._initialize()
+        table = self._table_class.__table__
+        stmt = (
+            select(table.c.node_id, table.c.text, table.c.metadata_, table.c.embedding)
+            .where(table.c.db_document_id == db_document_id)
+            .order_by(table.c.id)
+        )
+        async with self._async_session() as session:
+            result = await session.execute(stmt)
+            return [dict(row) for row in result.mappings().all()]
+
+    def _build_upsert_statements(self, rows: List[dict]) -> List[Any]:
+        return [
+            self._build_upsert_statement(rows[i : i + VECTOR_STORE_INSERT_BATCH_SIZE])
+            for i in range(0, len(rows), VECTOR_STORE_INSERT_BATCH_SIZE)
+        ]
+
+    def _build_upsert_statement(self, rows: List[dict]) -> Any:
+        table = self._table_class.__table__
+        if self.hybrid_search:
+            config = sqlalchemy.literal_column(
+                f"'{self.text_search_config}'::regconfig"
+            )
+            rows = [
+                {**row, "text_search_tsv": func.to_tsvector(config, row["text"])}
+                for row in rows
+            ]
+        stmt = insert(table).values(rows)
+        # the same chunk of a document was added again, e.g. by a re-seed.
+        # Keep the latest copy, like dedupe_vector_store.py does.
+        set_ = {
+            "node_id": stmt.excluded.node_id,
+            "embedding": stmt.excluded.embedding,
+            "metadata_": stmt.excluded.metadata_,
+        }
+        if self.hybrid_search:
+            set_["text_search_tsv"] = stmt.excluded.text_search_tsv
+        return stmt.on_conflict_do_update(
+            index_elements=get_content_key_columns(table), set_=set_
+        )
+
+    def _build_create_partition_statements(self, rows: List[dict]) -> List[Any]:
+        """
+        Create the partitions of the rows' DB documents that don't exist yet.
+
+        CREATE TABLE ... PARTITION OF locks the whole table, blocking searches
+        of every other document. Instead, each partition is created as a table
+        of its own and then attached, which only blocks other schema changes.
+        """
+        table = self._table_class.__table__
+        table_name = f"{self.schema_name}.{table.name}"
+        statements = []
+        for db_document_id in sorted({row["db_document_id"] for row in rows}):
+            partition_name = (
+                f"{self.schema_name}.{get_partition_name(table.name, db_document_id)}"
+            )
+            partition_value = db_document_id.replace("'", "''")
+            # the advisory lock serializes concurrent writes of the same document
+            statements.append(
+                sqlalchemy.text(
+                    f"""
+                    DO $$
+                    BEGIN
+                        PERFORM pg_advisory_xact_lock(hashtext('{partition_name}'));
+                        IF to_regclass('{partition_name}') IS NULL THEN
+                            CREATE TABLE {partition_name} (
+                                LIKE {table_name} INCLUDING DEFAULTS INCLUDING GENERATED
+                            );
+                            ALTER TABLE {table_name} ATTACH PARTITION {partition_name}
+                                FOR VALUES IN ('{partition_value}');
+                        END IF;
+                    END
+                    $$
+                    """
+                )
+            )
+        return statements
+
+    async def adelete_db_document(self, db_document_id: str) -> None:
+        """
+        Delete every row of the given DB document, by dropping its partition.
+
+        The partition is detached CONCURRENTLY first, which doesn't block
+        searches of or writes to other documents. That can't run in a
+        transaction block, so this uses an autocommit connection.
+        """
+        self._initialize()
+        table_name = f"{self.schema_name}.{self._table_class.__tablename__}"
+        partition_name = (
+            f"{self.schema_name}."
+            f"{get_partition_name(self._table_class.__tablename__, db_document_id)}"
+        )
+        async with self._async_engine.connect() as connection:
+            connection = await connection.execution_options(
+                isolation_level="AUTOCOMMIT"
+            )
+            result = await connection.execute(
+                sqlalchemy.text(
+                    "SELECT inhdetachpending FROM pg_inherits "
+                    "WHERE inhrelid = to_regclass(:partition_name)"
+                ).bindparams(partition_name=partition_name)
+            )
+            detach_pending = result.scalar()
+            if detach_pending is not None:
+                # a detach that was interrupted has to be finalized instead
+                mode = "FINALIZE" if detach_pending else "CONCURRENTLY"
+                await connection.execute(
+                    sqlalchemy.text(
+                        f"ALTER TABLE {table_name} "
+                        f"DETACH PARTITION {partition_name} {mode}"
+                    )
+                )
+            await connection.execute(
+                sqlalchemy.text(f"DROP TABLE IF EXISTS {partition_name}")
+            )
+
+    async def areplace_db_document(
+        self, db_document_id: str, nodes: List[BaseNode]
+    ) -> List[str]:
+        """
+        Replace every row of the given DB document with the nodes' rows.
+
+        The new rows are upserted and the stale ones deleted in one transaction,
+        so searches see either the previous or the new version of the document,
+        never a partial or empty one. A document without nodes is dropped.
+        """
+        self._initialize()
+        table = self._table_class.__table__
+        rows = self._nodes_to_upsert_rows(nodes)
+        if any(row["db_document_id"] != db_document_id for row in rows):
+            raise ValueError(f"Every node must be of DB document {db_document_id}")
+        if not rows:
+            await self.adelete_db_document(db_document_id)
+            return []
+        async with self._async_session() as session, session.begin():
+            for stmt in self._build_create_partition_statements(rows):
+                await session.execute(stmt)
+        async with self._async_session() as session, session.begin():
+            row_ids = []
+            for stmt in self._build_upsert_statements(rows):
+                result = await session.execute(stmt.returning(table.c.id))
+                row_ids += result.scalars().all()
+            await session.execute(
+                sqlalchemy.delete(table).where(
+                    table.c.db_document_id == db_document_id,
+                    table.c.id
+                    != sqlalchemy.all_(
+                        sqlalchemy.bindparam(
+                            "row_ids", row_ids, type_=ARRAY(sqlalchemy.BigInteger)
+                        )
+                    ),
+                )
+            )
+        return [node.node_id for node in nodes]
+
+    def _apply_filters_and_limit(
+        self,
+        stmt: Any,
+        limit: int,
+        metadata_filters: Optional[MetadataFilters] = None,
+    ) -> Any:
+        db_document_id = get_filtered_db_document_id(metadata_filters)
+        if db_document_id is not None:
+            # lets Postgres prune the scan down to the document's partition
+            stmt = stmt.where(self._table_class.db_document_id == db_document_id)
+        return super()._apply_filters_and_limit(stmt, limit, metadata_filters)
+
+    def _build_ts_query(self, query_str: str) -> Any:
+        config = sqlalchemy.literal_column(f"'{self.text_search_config}'::regconfig")
+        # OR the query's terms together like PGVectorStore's sparse queries do,
+        # since a chunk rarely contains every term of a question
+        return func.to_tsquery(
+            config,
+            func.replace(
+                sqlalchemy.cast(func.plainto_tsquery(config, query_str), Text),
+                "&",
+                "|",
+            ),
+        )
+
+    def _build_nearest_query(
+        self,
+        columns: List[Any],
+        embedding: Optional[List[float]],
+        limit: int,
+        metadata_filters: Optional[MetadataFilters],
+        exact_search: bool,
+    ) -> Any:
+        """
+        The given columns & distance of the limit chunks closest to the
+        embedding. With a quantized index, the closest candidates by their
+        compact embeddings are over-fetched through the index, and rescored by
+        their full precision embeddings.
+        """
+        model = self._table_class
+        distance = model.embedding.cosine_distance(embedding)
+        stmt = select(*columns, distance.label("distance")).order_by(
+            sqlalchemy.text("distance asc")
+        )
+        if settings.VECTOR_INDEX_QUANTIZATION == "none" or exact_search:
+            return self._apply_filters_and_limit(stmt, limit, metadata_filters)
+
+        candidates = self._apply_filters_and_limit(
+            select(model.id, model.db_document_id).order_by(
+                get_quantized_distance(model.embedding, embedding, self.embed_dim)
+            ),
+            limit * settings.VECTOR_QUERY_RESCORE_FACTOR,
+            metadata_filters,
+        ).subquery("candidates")
+        stmt = stmt.join_from(
+            model,
+            candidates,
+            and_(
+                model.id == candidates.c.id,
+                model.db_document_id == candidates.c.db_document_id,
+            ),
+        )
+        db_document_id = get_filtered_db_document_id(metadata_filters)
+        if db_document_id is not None:
+            stmt = stmt.where(model.db_document_id == db_document_id)
+        return stmt.limit(limit)
+
+    def _build_query(
+        self,
+        embedding: Optional[List[float]],
+        limit: int = 10,
+        metadata_filters: Optional[MetadataFilters] = None,
+        exact_search: bool = False,
+    ) -> Any:
+        model = self._table_class
+        return self._build_nearest_query(
+            [model.id, model.node_id, model.text, model.metadata_],
+            embedding,
+            limit,
+            metadata_filters,
+            exact_search,
+        )
+
+    def _build_hybrid_query(
+        self, query: VectorStoreQuery, exact_search: bool = False
+    ) -> Any:
+        """
+        Fuses the top similarity_top_k chunks of the vector search & the top
+        sparse_top_k chunks of the full-text search by their reciprocal ranks,
+        returning the hybrid_top_k best.
+        """
+        if not self.hybrid_search:
+            raise ValueError("hybrid_search must be enabled for hybrid queries.")
+        if query.query_str is None:
+            raise ValueError("query_str must be specified for a hybrid query.")
+        model = self._table_class
+
+        dense = self._build_nearest_query(
+            [model.id, model.db_document_id],
+            query.query_embedding,
+            query.similarity_top_k,
+            query.filters,
+            exact_search,
+        ).subquery("dense")
+        ts_query = self._build_ts_query(query.query_str)
+        text_rank = func.ts_rank_cd(model.text_search_tsv, ts_query)
+        sparse = self._apply_filters_and_limit(
+            select(model.id, model.db_document_id, text_rank.label("text_rank"))
+            .where(model.text_search_tsv.op("@@")(ts_query))
+            .order_by(text_rank.desc()),
+            query.sparse_top_k or query.similarity_top_k,
+            query.filters,
+        ).subquery("sparse")
+
+        dense_ranked = select(
+            dense.c.id,
+            dense.c.db_document_id,
+            func.row_number().over(order_by=dense.c.distance).label("rank"),
+        ).subquery("dense_ranked")
+        sparse_ranked = select(
+            sparse.c.id,
+            sparse.c.db_document_id,
+            func.row_number().over(order_by=sparse.c.text_rank.desc()).label("rank"),
+        ).subquery("sparse_ranked")
+        candidates = (
+            select(
+                func.coalesce(dense_ranked.c.id, sparse_ranked.c.id).label("id"),
+                func.coalesce(
+                    dense_ranked.c.db_document_id, sparse_ranked.c.db_document_id
+                ).label("db_document_id"),
+                (
+                    _reciprocal_rank(dense_ranked.c.rank)
+                    + _reciprocal_rank(sparse_ranked.c.rank)
+                ).label("score"),
+            )
+            .select_from(
+                dense_ranked.outerjoin(
+                    sparse_ranked,
+                    and_(
+                        dense_ranked.c.id == sparse_ranked.c.id,
+                        dense_ranked.c.db_document_id == sparse_ranked.c.db_document_id,
+                    ),
+                    full=True,
+                )
+            )
+            .subquery("candidates")
+        )
+
+        stmt = select(
+            model.id, model.node_id, model.text, model.metadata_, candidates.c.score
+        ).join_from(
+            model,
+            candidates,
+            and_(
+                model.id == candidates.c.id,
+                model.db_document_id == candidates.c.db_document_id,
+            ),
+        )
+        db_document_id = get_filtered_db_document_id(query.filters)
+        if db_document_id is not None:
+            stmt = stmt.where(model.db_document_id == db_document_id)
+        return stmt.order_by(candidates.c.score.desc()).limit(
+            query.hybrid_top_k or query.similarity_top_k
+        )
+
+    def _hybrid_query(
+        self, query: VectorStoreQuery, **kwargs: Any
+    ) -> List[DBEmbeddingRow]:
+        stmt = self._build_hybrid_query(query, kwargs.get("exact_search", False))
+        search_parameters_stmt = build_search_parameters_statement(**kwargs)
+        with self._session() as session, session.begin():
+            if search_parameters_stmt is not None:
+                session.execute(search_parameters_stmt)
+            return _to_db_embedding_rows(session.execute(stmt).all())
+
+    async def _async_hybrid_query(
+        self, query: VectorStoreQuery, **kwargs: Any
+    ) -> List[DBEmbeddingRow]:
+        stmt = self._build_hybrid_query(query, kwargs.get("exact_search", False))
+        search_parameters_stmt = build_search_parameters_statement(**kwargs)
+        async with self._async_session() as async_session, async_session.begin():
+            if search_parameters_stmt is not None:
+                await async_session.execute(search_parameters_stmt)
+            result = await async_session.execute(stmt)
+            return _to_db_embedding_rows(result.all())
+
+    def _build_mode_query(
+        self, query: VectorStoreQuery, exact_search: bool = False
+    ) -> Any:
+        if query.mode == VectorStoreQueryMode.HYBRID:
+            return self._build_hybrid_query(query, exact_search)
+        return self._build_query(
+            query.query_embedding, query.similarity_top_k, query.filters, exact_search
+        )
+
+    def _build_batch_query(
+        self, queries: List[VectorStoreQuery], exact_search: bool = False
+    ) -> Any:
+        """
+        One statement that runs every query's own search, unchanged, as a
+        branch of a UNION ALL. Each row is tagged with the index of its query.
+        """
+        return sqlalchemy.union_all(
+            *(
+                self._build_mode_query(query, exact_search).add_columns(
+                    sqlalchemy.literal(query_index, sqlalchemy.Integer).label(
+                        "query_index"
+                    )
+                )
+                for query_index, query in enumerate(queries)
+            )
+        )
+
+    def _query_with_score(
+        self,
+        embedding: Optional[List[float]],
+        limit: int = 10,
+        metadata_filters: Optional[MetadataFilters] = None,
+        **kwargs: Any,
+    ) -> List[DBEmbeddingRow]:
+        stmt = self._build_query(
+            embedding, limit, metadata_filters, kwargs.get("exact_search", False)
+        )
+        search_parameters_stmt = build_search_parameters_statement(**kwargs)
+        with self._session() as session, session.begin():
+            if search_parameters_stmt is not None:
+                session.execute(search_parameters_stmt)
+            return _to_db_embedding_rows(session.execute(stmt).all())
+
+    async def _aquery_with_score(
+        self,
+        embedding: Optional[List[float]],
+        limit: int = 10,
+        metadata_filters: Optional[MetadataFilters] = None,
+        **kwargs: Any,
+    ) -> List[DBEmbeddingRow]:
+        stmt = self._build_query(
+            embedding, limit, metadata_filters, kwargs.get("exact_search", False)
+        )
+        search_parameters_stmt = build_search_parameters_statement(**kwargs)
+        async with self._async_session() as async_session, async_session.begin():
+            if search_parameters_stmt is not None:
+                await async_session.execute(search_parameters_stmt)
+            result = await async_session.execute(stmt)
+            return _to_db_embedding_rows(result.all())
+
+    async def aquery_batch(
+        self, queries: List[VectorStoreQuery], **kwargs: Any
+    ) -> List[VectorStoreQueryResult]:
+        """
+        Run several similarity searches with the same mode & search parameters
+        in a single round trip. The results are the same as calling aquery for
+        each of them.
+        """
+        self._initialize()
+        modes = {query.mode for query in queries}
+        if len(modes) > 1 or not modes <= BATCHED_QUERY_MODES:
+            return await asyncio.gather(
+                *(self.aquery(query, **kwargs) for query in queries)
+            )
+        if not queries:
+            return []
+
+        rows_by_query: List[List[Any]] = [[] for _ in queries]
+        search_parameters_stmt = build_search_parameters_statement(**kwargs)
+        async with self._async_session() as async_session, async_session.begin():
+            if search_parameters_stmt is not None:
+                await async_session.execute(search_parameters_stmt)
+            result = await async_session.execute(
+                self._build_batch_query(queries, kwargs.get("exact_search", False))
+            )
+            for item in result.all():
+                rows_by_query[item.query_index].append(item)
+
+        results = []
+        for rows in rows_by_query:
+            # UNION ALL doesn't guarantee the order of each branch is kept
+            rows.sort(key=lambda item: -_get_similarity(item))
+            results.append(self._db_rows_to_query_result(_to_db_embedding_rows(rows)))
+        return results
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        self._initialize()
+        if not nodes:
+            return []
+        rows = self._nodes_to_upsert_rows(nodes)
+        # partitions are created in their own transaction, so the lock that
+        # attaching one takes isn't held during the upserts
+        with self._session() as session, session.begin():
+            for stmt in self._build_create_partition_statements(rows):
+                session.execute(stmt)
+        with self._session() as session, session.begin():
+            for stmt in self._build_upsert_statements(rows):
+                session.execute(stmt)
+        return [node.node_id for node in nodes]
+
+    async def async_add(self, nodes: List[BaseNode], **kwargs: Any) -> List[str]:
+        self._initialize()
+        if not nodes:
+            return []
+        rows = self._nodes_to_upsert_rows(nodes)
+        async with self._async_session() as session, session.begin():
+            for stmt in self._build_create_partition_statements(rows):
+                await session.execute(stmt)
+        async with self._async_session() as session, session.begin():
+            for stmt in self._build_upsert_statements(rows):
+                await session.execute(stmt)
+        return [node.node_id for node in nodes]
+
     def _create_extension(self) -> None:
         pass
 
@@ -66,5 +819,7 @@ async def get_vector_store_singleton() -> VectorStore:
         url.username,
         url.password,
         settings.VECTOR_STORE_TABLE_NAME,
+        embed_dim=settings.EMBEDDING_DIMENSIONS or EMBEDDING_NATIVE_DIMENSIONS,
+        hybrid_search=True,
     )
     return singleton_instance
@@ -0,0 +1,189 @@
+from typing import Callable, Dict, List, Optional, Tuple, cast
+import asyncio
+import logging
+import time
+from weakref import WeakKeyDictionary
+from cachetools import TTLCache
+from llama_index.core.storage.kvstore.types import BaseKVStore
+
+# This is from the unofficial polygon.io client: https://polygon.readthedocs.io/
+from polygon.reference_apis import ReferenceClient
+from polygon.reference_apis.reference_api import AsyncReferenceClient
+
+# This is from the official polygon.io client:
+# https://polygon-api-client.readthedocs.io/
+from polygon.rest.models import StockFinancial
+
+from app.core.config import settings
+from app.chat.storage import PostgresKVStore
+
+logger = logging.getLogger(__name__)
+
+STOCK_FINANCIALS_COLLECTION = "polygon_io/stock_financials"
+# max limit of the stock financials endpoint
+STOCK_FINANCIALS_LIMIT = 100
+
+# (ticker, period of report date)
+StockFinancialsKey = Tuple[str, str]
+
+
+class PolygonIOClient:
+    """
+    Process-wide polygon.io client, whose connections are kept alive between
+    calls, with a TTL cache of the stock financials of each filed report.
+
+    Financials are cached in memory, backed by an optional key-value store
+    (the kvstore table) that outlives the process and is shared with other
+    workers. Concurrent calls for the same report share a single fetch.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str,
+        max_connections: int,
+        cache_size: int,
+        cache_ttl_seconds: float,
+        kvstore: Optional[BaseKVStore] = None,
+        timer: Callable[[], float] = time.time,
+    ):
+        self._api_key = api_key
+        self._base_url = base_url
+        self._max_connections = max_connections
+        self._cache_ttl_seconds = cache_ttl_seconds
+        self._kvstore = kvstore
+        self._timer = timer
+        self._memory_cache: TTLCache = TTLCache(
+            maxsize=cache_size, ttl=cache_ttl_seconds, timer=timer
+        )
+        # an httpx client's connection pool belongs to the event loop it's used on
+        self._reference_clients: WeakKeyDictionary = WeakKeyDictionary()
+        self._pending: Dict[
+            Tuple[asyncio.AbstractEventLoop, StockFinancialsKey],
+            "asyncio.Task[List[StockFinancial]]",
+        ] = {}
+        self.num_fetches = 0
+
+    def _get_reference_client(self) -> AsyncReferenceClient:
+        loop = asyncio.get_running_loop()
+        client = self._reference_clients.get(loop)
+        if client is None:
+            client = cast(
+                AsyncReferenceClient,
+                ReferenceClient(
+                    api_key=self._api_key,
+                    connect_timeout=10,
+                    read_timeout=10,
+                    max_connections=self._max_connections,
+                    max_keepalive=self._max_connections,
+                    use_async=True,
+                ),
+            )
+            client.BASE = self._base_url.rstrip("/")
+            self._reference_clients[loop] = client
+        return client
+
+    async def _afetch_results(self, key: StockFinancialsKey) -> List[dict]:
+        ticker, period_of_report_date = key
+        self.num_fetches += 1
+        response_dict = await self._get_reference_client().get_stock_financials_vx(
+            ticker=ticker,
+            period_of_report_date=period_of_report_date,
+            limit=STOCK_FINANCIALS_LIMIT,
+        )
+        if "results" not in response_dict:
+            raise ValueError(
+                f"Failed to fetch the financials of {ticker} for "
+                f"{period_of_report_date}: {response_dict}"
+            )
+        return response_dict["results"]
+
+    async def _aget_stored_results(self, kv_key: str) -> Optional[List[dict]]:
+        try:
+            entry = await self._kvstore.aget(kv_key, STOCK_FINANCIALS_COLLECTION)
+        except Exception:
+            logger.warning("Failed to read %s from the kvstore", kv_key, exc_info=True)
+            return None
+        if entry is None:
+            return None
+        if entry["fetched_at"] + self._cache_ttl_seconds <= self._timer():
+            return None
+        return entry["results"]
+
+    async def _astore_results(self, kv_key: str, results: List[dict]) -> None:
+        try:
+            await self._kvstore.aput(
+                kv_key,
+                {"fetched_at": self._timer(), "results": results},
+                STOCK_FINANCIALS_COLLECTION,
+            )
+        except Exception:
+            logger.warning("Failed to write %s to the kvstore", kv_key, exc_info=True)
+
+    async def _aload_stock_financials(
+        self, key: StockFinancialsKey
+    ) -> List[StockFinancial]:
+        kv_key = "/".join(key)
+        results = None
+        if self._kvstore is not None:
+            results = await self._aget_stored_results(kv_key)
+        if results is None:
+            results = await self._afetch_results(key)
+            if self._kvstore is not None:
+                await self._astore_results(kv_key, results)
+        stock_financials = [StockFinancial.from_dict(result) for result in results]
+        self._memory_cache[key] = stock_financials
+        return stock_financials
+
+    async def aget_stock_financials(
+        self, ticker: str, period_of_report_date: str
+    ) -> List[StockFinancial]:
+        """
+        Get the financials of the report of a ticker for the given period. The
+        returned objects are shared between callers, so must not be modified.
+        """
+        key = (ticker.upper(), period_of_report_date)
+        stock_financials = self._memory_cache.get(key)
+        if stock_financials is not None:
+            return stock_financials
+
+        pending_key = (asyncio.get_running_loop(), key)
+        task = self._pending.get(pending_key)
+        if task is None:
+            task = asyncio.create_task(self._aload_stock_financials(key))
+            self._pending[pending_key] = task
+            task.add_done_callback(lambda _: self._pending.pop(pending_key, None))
+        # a cancelled caller doesn't cancel the fetch for the others
+        return await asyncio.shield(task)
+
+    async def aclose(self) -> None:
+        """
+        Close the connection pool of the current event loop's client.
+        """
+        client = self._reference_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+
+_polygon_io_client: Optional[PolygonIOClient] = None
+
+
+def get_polygon_io_client() -> PolygonIOClient:
+    global _polygon_io_client
+    if _polygon_io_client is None:
+        _polygon_io_client = PolygonIOClient(
+            api_key=settings.POLYGON_IO_API_KEY,
+            base_url=settings.POLYGON_IO_BASE_URL,
+            max_connections=settings.POLYGON_IO_MAX_CONNECTIONS,
+            cache_size=settings.POLYGON_IO_CACHE_SIZE,
+            cache_ttl_seconds=settings.POLYGON_IO_CACHE_TTL_SECONDS,
+            kvstore=PostgresKVStore()
+            if settings.POLYGON_IO_CACHE_POSTGRES_ENABLED
+            else None,
+        )
+    return _polygon_io_client
+
+
+async def close_polygon_io_client() -> None:
+    if _polygon_io_client is not None:
+        await _polygon_io_client.aclose()
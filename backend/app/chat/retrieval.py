@@ -0,0 +1,168 @@
+from typing import Any, Dict, List, Tuple
+import asyncio
+import logging
+from llama_index.core import VectorStoreIndex
+from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import (
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from app.chat.flat_vectors import FlatVectorStore
+from app.chat.pg_vector import CustomPGVectorStore
+
+logger = logging.getLogger(__name__)
+
+_PendingQuery = Tuple[VectorStoreQuery, "asyncio.Future[VectorStoreQueryResult]"]
+# queries are batched per event loop & set of search parameters
+_BatchKey = Tuple[asyncio.AbstractEventLoop, Tuple[Tuple[str, Any], ...]]
+
+
+class VectorStoreQueryBatcher:
+    """
+    Coalesces the vector store queries issued concurrently by a tool graph's
+    per-document query engines, e.g. the sub-questions of a SubQuestionQueryEngine,
+    into a single round trip to Postgres.
+
+    A query waits at most window_seconds for others to join its batch, and a
+    batch is sent early once it has max_batch_size queries. Only queries with
+    the same search parameters share a batch.
+    """
+
+    def __init__(
+        self,
+        vector_store: CustomPGVectorStore,
+        window_seconds: float,
+        max_batch_size: int,
+    ):
+        self._vector_store = vector_store
+        self._window_seconds = window_seconds
+        self._max_batch_size = max_batch_size
+        # tool graphs are cached across requests, which may run on different loops
+        self._pending: Dict[_BatchKey, List[_PendingQuery]] = {}
+        self._flush_timers: Dict[_BatchKey, asyncio.TimerHandle] = {}
+        self._running_tasks: set = set()
+        self.num_queries = 0
+        self.num_round_trips = 0
+
+    async def aquery(
+        self, query: VectorStoreQuery, **kwargs: Any
+    ) -> VectorStoreQueryResult:
+        loop = asyncio.get_running_loop()
+        key = (loop, tuple(sorted(kwargs.items())))
+        future: "asyncio.Future[VectorStoreQueryResult]" = loop.create_future()
+        pending = self._pending.setdefault(key, [])
+        pending.append((query, future))
+        self.num_queries += 1
+        if len(pending) >= self._max_batch_size:
+            self._flush(key)
+        elif key not in self._flush_timers:
+            self._flush_timers[key] = loop.call_later(
+                self._window_seconds, self._flush, key
+            )
+        return await future
+
+    def _flush(self, key: _BatchKey) -> None:
+        timer = self._flush_timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, [])
+        if not batch:
+            return
+        loop, kwargs = key
+        task = loop.create_task(self._run_batch(batch, dict(kwargs)))
+        # keep a reference so the task isn't garbage collected mid-flight
+        self._running_tasks.add(task)
+        task.add_done_callback(self._running_tasks.discard)
+
+    async def _run_batch(
+        self, batch: List[_PendingQuery], kwargs: Dict[str, Any]
+    ) -> None:
+        queries = [query for query, _ in batch]
+        self.num_round_trips += 1
+        try:
+            results = await self._vector_store.aquery_batch(queries, **kwargs)
+        except Exception as e:
+            logger.exception("Batched vector store query failed")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class BatchedVectorIndexRetriever(VectorIndexRetriever):
+    """
+    Vector index retriever whose async queries go through a VectorStoreQueryBatcher.
+    Results are identical to those of VectorIndexRetriever.
+    """
+
+    def __init__(
+        self,
+        index: VectorStoreIndex,
+        query_batcher: VectorStoreQueryBatcher,
+        **kwargs: Any,
+    ):
+        super().__init__(index, **kwargs)
+        self._query_batcher = query_batcher
+
+    async def _aget_nodes_with_embeddings(
+        self, query_bundle_with_embeddings: QueryBundle
+    ) -> List[NodeWithScore]:
+        query = self._build_vector_store_query(query_bundle_with_embeddings)
+        query_result = await self._query_batcher.aquery(query, **self._kwargs)
+        return self._build_node_list_from_query_result(query_result)
+
+
+def build_batched_retriever(
+    index: VectorStoreIndex,
+    query_batcher: VectorStoreQueryBatcher,
+    **kwargs: Any,
+) -> BatchedVectorIndexRetriever:
+    """
+    Same as index.as_retriever(**kwargs), but with batched async queries.
+    """
+    return BatchedVectorIndexRetriever(
+        index,
+        query_batcher,
+        node_ids=list(index.index_struct.nodes_dict.values()),
+        callback_manager=index._callback_manager,
+        object_map=index._object_map,
+        **kwargs,
+    )
+
+
+class FlatVectorIndexRetriever(VectorIndexRetriever):
+    """
+    Vector index retriever that searches a FlatVectorStore instead of the
+    index's own vector store.
+    """
+
+    def __init__(
+        self,
+        index: VectorStoreIndex,
+        flat_vector_store: FlatVectorStore,
+        **kwargs: Any,
+    ):
+        super().__init__(index, **kwargs)
+        self._vector_store = flat_vector_store
+
+
+def build_flat_vector_retriever(
+    index: VectorStoreIndex,
+    flat_vector_store: FlatVectorStore,
+    **kwargs: Any,
+) -> FlatVectorIndexRetriever:
+    """
+    Same as index.as_retriever(**kwargs), but searching the flat vector store.
+    """
+    return FlatVectorIndexRetriever(
+        index,
+        flat_vector_store,
+        node_ids=list(index.index_struct.nodes_dict.values()),
+        callback_manager=index._callback_manager,
+        object_map=index._object_map,
+        **kwargs,
+    )
@@ -0,0 +1,258 @@
+from typing import Any, Coroutine, Dict, List, Optional, Tuple
+import asyncio
+import logging
+from cachetools import TTLCache
+from fsspec import AbstractFileSystem
+from sqlalchemy import select, delete, func
+from sqlalchemy.dialects.postgresql import insert
+from llama_index.core.async_utils import asyncio_run
+from llama_index.core.data_structs.data_structs import IndexStruct
+from llama_index.core.storage.kvstore.types import BaseKVStore, DEFAULT_COLLECTION
+from llama_index.core.storage.kvstore.simple_kvstore import SimpleKVStore
+from llama_index.core.storage.index_store.keyval_index_store import KVIndexStore
+from llama_index.core.storage.index_store.utils import (
+    index_struct_to_json,
+    json_to_index_struct,
+)
+from llama_index.core.storage.docstore.types import (
+    DEFAULT_PERSIST_FNAME as DOCSTORE_FNAME,
+)
+from llama_index.core.storage.index_store.types import (
+    DEFAULT_PERSIST_FNAME as INDEX_STORE_FNAME,
+)
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models.db import KVStoreEntry
+
+logger = logging.getLogger(__name__)
+
+# Max number of rows written by a single INSERT statement
+KV_STORE_INSERT_BATCH_SIZE = 500
+
+
+def _run_sync(coroutine: Coroutine) -> Any:
+    """
+    Run a coroutine from sync code, e.g. a script. Raises if there's an event
+    loop running, since waiting on the database would block it.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio_run(coroutine)
+    coroutine.close()
+    raise RuntimeError(
+        "PostgresKVStore's sync methods block the running event loop, "
+        "use its async methods instead."
+    )
+
+
+class PostgresKVStore(BaseKVStore):
+    """
+    Key-value store backed by the kvstoreentry table.
+
+    Every (collection, key) pair is its own row, so adding a document only writes
+    that document's rows and loading an index struct only reads its own row.
+    Uses the same connection pool as the FastAPI app.
+
+    The sync methods are only for code that doesn't run in an event loop, and
+    raise if there is one.
+    """
+
+    async def aput(
+        self, key: str, val: dict, collection: str = DEFAULT_COLLECTION
+    ) -> None:
+        await self.aput_all([(key, val)], collection=collection)
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        _run_sync(self.aput(key, val, collection))
+
+    async def aput_all(
+        self,
+        kv_pairs: List[Tuple[str, dict]],
+        collection: str = DEFAULT_COLLECTION,
+        batch_size: int = KV_STORE_INSERT_BATCH_SIZE,
+    ) -> None:
+        # the KVDocumentStore passes its own batch size of 1, but every batch
+        # here is a single statement so there's no reason to go that small.
+        batch_size = max(batch_size, KV_STORE_INSERT_BATCH_SIZE)
+        # a single statement can't upsert the same key twice, last one wins
+        kv_dict = dict(kv_pairs)
+        rows = [
+            {"collection": collection, "key": key, "value": val}
+            for key, val in kv_dict.items()
+        ]
+        async with SessionLocal() as db:
+            for i in range(0, len(rows), batch_size):
+                stmt = insert(KVStoreEntry).values(rows[i : i + batch_size])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[KVStoreEntry.collection, KVStoreEntry.key],
+                    set_={"value": stmt.excluded.value, "updated_at": func.now()},
+                )
+                await db.execute(stmt)
+            await db.commit()
+
+    def put_all(
+        self,
+        kv_pairs: List[Tuple[str, dict]],
+        collection: str = DEFAULT_COLLECTION,
+        batch_size: int = KV_STORE_INSERT_BATCH_SIZE,
+    ) -> None:
+        _run_sync(self.aput_all(kv_pairs, collection, batch_size))
+
+    async def aget(
+        self, key: str, collection: str = DEFAULT_COLLECTION
+    ) -> Optional[dict]:
+        return (await self.aget_many([key], collection)).get(key)
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        return _run_sync(self.aget(key, collection))
+
+    async def aget_many(
+        self, keys: List[str], collection: str = DEFAULT_COLLECTION
+    ) -> Dict[str, dict]:
+        """Get the values that exist for the given keys."""
+        if not keys:
+            return {}
+        stmt = select(KVStoreEntry.key, KVStoreEntry.value).where(
+            KVStoreEntry.collection == collection, KVStoreEntry.key.in_(keys)
+        )
+        async with SessionLocal() as db:
+            result = await db.execute(stmt)
+            return {key: value for key, value in result.all()}
+
+    async def aget_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        stmt = select(KVStoreEntry.key, KVStoreEntry.value).where(
+            KVStoreEntry.collection == collection
+        )
+        async with SessionLocal() as db:
+            result = await db.execute(stmt)
+            return {key: value for key, value in result.all()}
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        return _run_sync(self.aget_all(collection))
+
+    async def adelete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        stmt = delete(KVStoreEntry).where(
+            KVStoreEntry.collection == collection, KVStoreEntry.key == key
+        )
+        async with SessionLocal() as db:
+            result = await db.execute(stmt)
+            await db.commit()
+            return result.rowcount > 0
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        return _run_sync(self.adelete(key, collection))
+
+
+class CachedIndexStore(KVIndexStore):
+    """
+    KVIndexStore that keeps recently used index structs in memory.
+
+    Index structs are looked up by id, so a conversation only ever loads the
+    structs of its own documents. Each cached entry is evicted on its own,
+    either by TTL or when the cache is full.
+
+    Async code reads & writes structs with aget_index_structs and
+    async_add_index_struct. An index re-adds the struct it's constructed with,
+    which is skipped if that's the struct that was last read or written, so
+    constructing an index from one of them doesn't touch the database.
+    """
+
+    def __init__(
+        self,
+        kvstore: PostgresKVStore,
+        maxsize: int = settings.INDEX_STRUCT_CACHE_SIZE,
+        ttl: float = settings.INDEX_STRUCT_CACHE_TTL_SECONDS,
+        **kwargs,
+    ) -> None:
+        super().__init__(kvstore, **kwargs)
+        # (struct, the JSON it's stored as) by struct id
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def _cache_index_struct(
+        self, index_struct: IndexStruct, struct_json: dict
+    ) -> None:
+        self._cache[index_struct.index_id] = (index_struct, struct_json)
+
+    def add_index_struct(self, index_struct: IndexStruct) -> None:
+        struct_json = index_struct_to_json(index_struct)
+        _, stored_json = self._cache.get(index_struct.index_id, (None, None))
+        if struct_json != stored_json:
+            self._kvstore.put(
+                index_struct.index_id, struct_json, collection=self._collection
+            )
+        self._cache_index_struct(index_struct, struct_json)
+
+    async def async_add_index_struct(self, index_struct: IndexStruct) -> None:
+        struct_json = index_struct_to_json(index_struct)
+        await self._kvstore.aput(
+            index_struct.index_id, struct_json, collection=self._collection
+        )
+        self._cache_index_struct(index_struct, struct_json)
+
+    def delete_index_struct(self, key: str) -> None:
+        super().delete_index_struct(key)
+        self._cache.pop(key, None)
+
+    def get_index_struct(
+        self, struct_id: Optional[str] = None
+    ) -> Optional[IndexStruct]:
+        if struct_id is None:
+            return super().get_index_struct(struct_id)
+        if struct_id in self._cache:
+            index_struct, _ = self._cache[struct_id]
+            return index_struct
+        struct_json = self._kvstore.get(struct_id, collection=self._collection)
+        if struct_json is None:
+            return None
+        index_struct = json_to_index_struct(struct_json)
+        self._cache_index_struct(index_struct, struct_json)
+        return index_struct
+
+    async def aget_index_structs(
+        self, struct_ids: List[str]
+    ) -> Dict[str, IndexStruct]:
+        """
+        Get the index structs that exist for the given ids, reading all the
+        uncached ones from the database in one query.
+        """
+        index_structs = {
+            struct_id: self._cache[struct_id][0]
+            for struct_id in struct_ids
+            if struct_id in self._cache
+        }
+        missing_ids = [
+            struct_id for struct_id in struct_ids if struct_id not in index_structs
+        ]
+        if missing_ids:
+            struct_jsons = await self._kvstore.aget_many(
+                missing_ids, collection=self._collection
+            )
+            for struct_id, struct_json in struct_jsons.items():
+                index_struct = json_to_index_struct(struct_json)
+                self._cache_index_struct(index_struct, struct_json)
+                index_structs[struct_id] = index_struct
+        return index_structs
+
+
+async def migrate_legacy_persist_dir(
+    fs: AbstractFileSystem, persist_dir: str, kvstore: BaseKVStore
+) -> int:
+    """
+    Copy the monolithic docstore.json & index_store.json written by
+    StorageContext.persist into the given key-value store.
+
+    Returns the number of entries copied.
+    """
+    num_entries = 0
+    for file_name in (DOCSTORE_FNAME, INDEX_STORE_FNAME):
+        persist_path = f"{persist_dir.rstrip('/')}/{file_name}"
+        if not fs.exists(persist_path):
+            logger.info("No legacy %s found at %s", file_name, persist_path)
+            continue
+        legacy_kvstore = SimpleKVStore.from_persist_path(persist_path, fs=fs)
+        for collection, entries in legacy_kvstore.to_dict().items():
+            await kvstore.aput_all(list(entries.items()), collection=collection)
+            num_entries += len(entries)
+    return num_entries
+
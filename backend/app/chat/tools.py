@@ -1,32 +1,33 @@
-from typing import List, Iterator, cast
+from typing import Callable, List, Optional
 import logging
 
-# This is from the unofficial polygon.io client: https://polygon.readthedocs.io/
-from polygon.reference_apis import ReferenceClient
-from polygon.reference_apis.reference_api import AsyncReferenceClient
-
 # This is from the official polygon.io client: https://polygon-api-client.readthedocs.io/
 from polygon.rest.models import StockFinancial
 
 from app.schema import (
     Document as DocumentSchema,
+    DocumentFinancialFact,
     DocumentMetadataKeysEnum,
     SecDocumentMetadata,
 )
 from llama_index.core.tools import FunctionTool, ToolMetadata, QueryEngineTool
 from llama_index.core.callbacks import CallbackManager
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.async_utils import asyncio_run
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.response.schema import Response
+from llama_index.core.schema import QueryBundle
 from llama_index.core import Settings
 from llama_index.agent.openai import OpenAIAgent
 from app.core.config import settings
 from app.chat.utils import build_title_for_document
+from app.chat.polygon_client import get_polygon_io_client
+from app.chat.financials import aget_document_financials
 
 
 logger = logging.getLogger(__name__)
 
 
-from typing import List
-
-
 def describe_financials(financials: StockFinancial) -> str:
     sentences: List[str] = []
 
@@ -78,6 +79,25 @@ def describe_financials(financials: StockFinancial) -> str:
     return " ".join(sentences)
 
 
+def describe_document_financials(
+    sec_metadata: SecDocumentMetadata,
+    financials: List[DocumentFinancialFact],
+) -> str:
+    fiscal_period = f"Q{sec_metadata.quarter}" if sec_metadata.quarter else "FY"
+    sentences: List[str] = [
+        f"For {sec_metadata.company_name} in fiscal year {sec_metadata.year} "
+        f"covering the period {fiscal_period}:"
+    ]
+    for fact in financials:
+        period = (
+            f"from {fact.start_date} to {fact.end_date}"
+            if fact.start_date
+            else f"as of {fact.end_date}"
+        )
+        sentences.append(f"{fact.label} {period}: {fact.value} {fact.unit}.")
+    return " ".join(sentences)
+
+
 def get_tool_metadata_for_document(doc: DocumentSchema) -> ToolMetadata:
     doc_title = build_title_for_document(doc)
     name = f"extract_json_from_sec_document[{doc_title}]"
@@ -96,22 +116,23 @@ def get_polygon_io_sec_tool(document: DocumentSchema) -> FunctionTool:
 
     async def extract_data_from_sec_document(*args, **kwargs) -> List[str]:
         try:
-            client = ReferenceClient(
-                api_key=settings.POLYGON_IO_API_KEY,
-                connect_timeout=10,
-                read_timeout=10,
-                max_connections=20,
-                use_async=True,
+            financials = await aget_document_financials(document.id)
+        except Exception:
+            logger.warning(
+                "Error reading the financials of document_id %s",
+                str(document.id),
+                exc_info=True,
             )
-            client = cast(AsyncReferenceClient, client)
-            response_dict = await client.get_stock_financials_vx(
+            financials = []
+        if financials:
+            return [describe_document_financials(sec_metadata, financials)]
+
+        # the document's filing had no XBRL data, or hasn't been extracted yet
+        try:
+            stock_financials = await get_polygon_io_client().aget_stock_financials(
                 ticker=sec_metadata.company_ticker,
                 period_of_report_date=str(sec_metadata.period_of_report_date.date()),
-                limit=100,  # max limit is 100
             )
-            stock_financials = []
-            for result_dict in response_dict["results"]:
-                stock_financials.append(StockFinancial.from_dict(result_dict))
 
             descriptions = []
             for stock_financial in stock_financials:
@@ -143,24 +164,109 @@ def get_polygon_io_sec_tool(document: DocumentSchema) -> FunctionTool:
     )
 
 
+class FunctionToolQueryEngine(BaseQueryEngine):
+    """
+    Answers every query with the output of a function tool that takes no
+    arguments, without an agent deciding to call it. The query itself is left
+    to the synthesizer of the sub-question engine this is a tool of.
+    """
+
+    def __init__(self, tool: FunctionTool, callback_manager: CallbackManager):
+        super().__init__(callback_manager=callback_manager)
+        self._tool = tool
+
+    def _get_prompt_modules(self) -> dict:
+        return {}
+
+    async def _aquery(self, query_bundle: QueryBundle) -> Response:
+        # the same event an agent's call of the tool emits
+        with self.callback_manager.event(
+            CBEventType.FUNCTION_CALL,
+            payload={
+                EventPayload.FUNCTION_CALL: "{}",
+                EventPayload.TOOL: self._tool.metadata,
+            },
+        ) as event:
+            tool_output = await self._tool.acall()
+            event.on_end(payload={EventPayload.FUNCTION_OUTPUT: str(tool_output)})
+        raw_output = tool_output.raw_output
+        if isinstance(raw_output, list):
+            return Response(response="\n".join(str(item) for item in raw_output))
+        return Response(response=str(raw_output))
+
+    def _query(self, query_bundle: QueryBundle) -> Response:
+        return asyncio_run(self._aquery(query_bundle))
+
+
+class AgentQueryEngine(BaseQueryEngine):
+    """
+    Answers every query with a new agent from agent_factory.
+
+    Querying an agent resets its memory and then appends to it, and the tool
+    graphs this is a part of are shared between concurrent messages. A single
+    agent would have their queries clear and interleave each other's memory.
+    """
+
+    def __init__(
+        self,
+        agent_factory: Callable[[], OpenAIAgent],
+        callback_manager: CallbackManager,
+    ):
+        super().__init__(callback_manager=callback_manager)
+        self._agent_factory = agent_factory
+
+    def _get_prompt_modules(self) -> dict:
+        return {}
+
+    async def _aquery(self, query_bundle: QueryBundle) -> Response:
+        agent_response = await self._agent_factory().achat(query_bundle.query_str)
+        return Response(
+            response=str(agent_response), source_nodes=agent_response.source_nodes
+        )
+
+    def _query(self, query_bundle: QueryBundle) -> Response:
+        agent_response = self._agent_factory().chat(query_bundle.query_str)
+        return Response(
+            response=str(agent_response), source_nodes=agent_response.source_nodes
+        )
+
+
 def get_api_query_engine_tool(
-    document: DocumentSchema, callback_manager: CallbackManager,
+    document: DocumentSchema,
+    callback_manager: CallbackManager,
+    mode: Optional[str] = None,
 ) -> QueryEngineTool:
+    """
+    :param mode: "direct" to answer with the financial data function's output,
+        or "agent" to have a per-document agent call it. Defaults to
+        settings.QUANTITATIVE_ENGINE_MODE
+    """
     polygon_io_tool = get_polygon_io_sec_tool(document)
     tool_metadata = get_tool_metadata_for_document(document)
     doc_title = build_title_for_document(document)
-    llm = Settings.llm.model_copy(
-        update={"callback_manager": callback_manager},
-        deep=True
-    )
-    agent = OpenAIAgent.from_tools(
-        [polygon_io_tool],
-        llm=llm,
-        callback_manager=callback_manager,
-        system_prompt=f"You are an agent that is asked quantitative questions about a SEC filing named {doc_title} and you answer them by using your tools.",
-    )
+    if (mode or settings.QUANTITATIVE_ENGINE_MODE) == "direct":
+        query_engine = FunctionToolQueryEngine(polygon_io_tool, callback_manager)
+    else:
+        llm = Settings.llm.model_copy(
+            update={"callback_manager": callback_manager},
+            deep=True
+        )
+
+        def build_agent() -> OpenAIAgent:
+            return OpenAIAgent.from_tools(
+                [polygon_io_tool],
+                llm=llm,
+                callback_manager=callback_manager,
+                system_prompt=(
+                    "You are an agent that is asked quantitative questions about "
+                    f"a SEC filing named {doc_title} and you answer them by using "
+                    "your tools."
+                ),
+            )
+
+        query_engine = AgentQueryEngine(build_agent, callback_manager)
     return QueryEngineTool.from_defaults(
-        query_engine=agent,
+        query_engine=query_engine,
         name=tool_metadata.name,
         description=tool_metadata.description,
     )
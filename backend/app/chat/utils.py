@@ -1,3 +1,4 @@
+import hashlib
 from app.schema import (
     Document as DocumentSchema,
     DocumentMetadataKeysEnum,
@@ -18,3 +19,10 @@ def build_title_for_document(document: DocumentSchema) -> str:
         else str(sec_metadata.year)
     )
     return f"{sec_metadata.company_name} ({sec_metadata.company_ticker}) {sec_metadata.doc_type.value} ({time_period})"
+
+
+def hash_text(text: str) -> str:
+    """
+    Hex SHA-256 of a piece of text, used to key cached embeddings & vector store rows.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
@@ -66,6 +66,118 @@ class Settings(PreviewPrefixedSettings):
     SEC_EDGAR_COMPANY_NAME: str = "YourOrgName"
     SEC_EDGAR_EMAIL: EmailStr = "you@example.com"
     OPENAI_CHAT_LLM_NAME: str = "gpt-4o-mini"
+    # Upper bound on the total number of documents across all chat engine tool
+    # graphs cached by a single worker.
+    CHAT_ENGINE_CACHE_MAX_DOCUMENTS: int = 64
+    INDEX_STRUCT_CACHE_SIZE: int = 256
+    INDEX_STRUCT_CACHE_TTL_SECONDS: int = 60 * 60
+    # Number of documents each ingestion pipeline stage works on at once
+    INGESTION_DOWNLOAD_CONCURRENCY: int = 4
+    INGESTION_PARSE_CONCURRENCY: int = 2
+    INGESTION_CHUNK_CONCURRENCY: int = 2
+    INGESTION_EMBED_CONCURRENCY: int = 4
+    INGESTION_WRITE_CONCURRENCY: int = 2
+    # Max number of documents waiting between two ingestion pipeline stages
+    INGESTION_QUEUE_SIZE: int = 2
+    # Size of the process pool that PDFs are parsed in. 0 parses in a thread instead.
+    PDF_PARSER_PROCESSES: int = 2
+    PDF_PARSER_PAGES_PER_TASK: int = 25
+    # One of "pypdf", "pymupdf" or "pdfium". The latter two are much faster than pypdf,
+    # see scripts/benchmark_pdf_parsers.py, but extract slightly different text,
+    # which changes the chunks of re-ingested documents. "pymupdf" requires the
+    # pymupdf extra.
+    PDF_PARSER_BACKEND: str = "pypdf"
+    DOCUMENT_DOWNLOAD_TIMEOUT_SECONDS: float = 60.0
+    # Parsed PDF page text is cached on local disk, backed by the S3_BUCKET_NAME bucket
+    PAGE_TEXT_CACHE_DIR: str = ".cache/page_text"
+    PAGE_TEXT_CACHE_S3_ENABLED: bool = True
+    PAGE_TEXT_CACHE_S3_PREFIX: str = "page-text"
+    # Cache embeddings in Postgres so the same text is never embedded twice
+    EMBEDDING_CACHE_ENABLED: bool = True
+    # Query embeddings are only cached in memory, per worker
+    EMBEDDING_CACHE_QUERY_CACHE_SIZE: int = 1024
+    # Shorten the embeddings to this many dimensions, which text-embedding-3
+    # models support natively. The model's full 1536 dimensions when unset.
+    # Existing embeddings are shortened by scripts/migrate_vector_store_format.py
+    EMBEDDING_DIMENSIONS: Optional[int] = None
+    # Coalesce the concurrent per-document vector queries of a chat turn into a
+    # single Postgres round trip. See scripts/benchmark_vector_retrieval.py
+    VECTOR_QUERY_BATCHING_ENABLED: bool = True
+    VECTOR_QUERY_BATCH_WINDOW_MS: float = 5.0
+    VECTOR_QUERY_MAX_BATCH_SIZE: int = 32
+    # ANN index on the vector store's embeddings, one of "hnsw" or "ivfflat".
+    # See scripts/benchmark_vector_index.py for the recall/latency trade-offs
+    VECTOR_INDEX_TYPE: str = "hnsw"
+    VECTOR_INDEX_HNSW_M: int = 16
+    VECTOR_INDEX_HNSW_EF_CONSTRUCTION: int = 64
+    VECTOR_INDEX_IVFFLAT_LISTS: int = 100
+    # Compact representation of the embeddings that the ANN index is built on,
+    # one of "none", "halfvec" (float16) or "binary" (1 bit per dimension). The
+    # table keeps the full precision embeddings, which the candidates found
+    # through a compact index are rescored with. halfvec & binary need pgvector
+    # 0.7+. See scripts/benchmark_vector_formats.py
+    VECTOR_INDEX_QUANTIZATION: str = "none"
+    # Candidates fetched through a compact index per result, for rescoring
+    VECTOR_QUERY_RESCORE_FACTOR: int = 4
+    # Search parameters of the ANN index, the pgvector defaults when unset
+    VECTOR_QUERY_HNSW_EF_SEARCH: Optional[int] = None
+    VECTOR_QUERY_IVFFLAT_PROBES: Optional[int] = None
+    # Rank each document's chunks exactly instead of through the ANN index, which
+    # trades the index's speed for perfect recall
+    VECTOR_QUERY_EXACT_SEARCH: bool = False
+    # Fuse a full-text search into per-document retrieval, which finds chunks
+    # with exact terms that the vector search misses. Changes the retrieved
+    # chunks, and citation scores become fused ranks rather than similarities.
+    # See scripts/benchmark_hybrid_retrieval.py
+    VECTOR_QUERY_HYBRID_ENABLED: bool = False
+    # Number of candidates each of the full-text & vector searches contribute
+    VECTOR_QUERY_HYBRID_CANDIDATES: int = 10
+    # Serve per-document vector searches from flat float16 embedding files that
+    # are written at ingestion, stored in the S3_BUCKET_NAME bucket & cached on
+    # local disk. Postgres remains the source of truth. Hybrid searches aren't
+    # served from the files, so this only applies with VECTOR_QUERY_HYBRID_ENABLED off
+    FLAT_VECTOR_STORE_ENABLED: bool = False
+    FLAT_VECTOR_CACHE_DIR: str = ".cache/flat_vectors"
+    # Least recently used files are evicted from local disk past this size
+    FLAT_VECTOR_CACHE_MAX_BYTES: int = 2 * 1024**3
+    FLAT_VECTOR_S3_ENABLED: bool = True
+    FLAT_VECTOR_S3_PREFIX: str = "flat-vectors"
+    # Answer sub-questions about a document from the answers given to similar
+    # enough sub-questions about the same version of it. Cached per worker
+    SUB_QUESTION_CACHE_ENABLED: bool = False
+    # Min cosine similarity of the embeddings of a sub-question & a cached one
+    SUB_QUESTION_CACHE_SIMILARITY_THRESHOLD: float = 0.95
+    SUB_QUESTION_CACHE_TTL_SECONDS: int = 24 * 60 * 60
+    SUB_QUESTION_CACHE_MAX_ENTRIES: int = 4096
+    # How the quantitative question engine gets each document's financial data:
+    # "agent" has a per-document agent decide to call the function for it, while
+    # "direct" calls it without the agent's LLM round trip per sub-question.
+    # Compare their answers with scripts/benchmark_quantitative_engine.py
+    QUANTITATIVE_ENGINE_MODE: str = "agent"
+    # Overridable to point at a local stand-in of the polygon.io API
+    POLYGON_IO_BASE_URL: str = "https://api.polygon.io"
+    POLYGON_IO_MAX_CONNECTIONS: int = 20
+    # Financials of filed reports rarely change, so they're cached in memory &
+    # in the kvstore table, which is shared by all workers
+    POLYGON_IO_CACHE_SIZE: int = 1024
+    POLYGON_IO_CACHE_TTL_SECONDS: int = 7 * 24 * 60 * 60
+    POLYGON_IO_CACHE_POSTGRES_ENABLED: bool = True
+    # Streamed tokens & sub-process updates of a message are batched into one SSE
+    # event per interval, or as soon as this much content is pending. 0 sends an
+    # event per update. See scripts/loadtest_message_stream.py
+    MESSAGE_STREAM_FLUSH_INTERVAL_MS: float = 50.0
+    MESSAGE_STREAM_FLUSH_MAX_BYTES: int = 1024
+    # The chat history given to the chat engine is the latest successful messages
+    # of the conversation, up to this many tokens, out of at most this many messages
+    CHAT_HISTORY_TOKEN_BUDGET: int = 4000
+    CHAT_HISTORY_MAX_MESSAGES: int = 100
+    # LlamaIndex callback event types (CBEventType values) that are streamed as
+    # sub-processes of a message. The UI only shows sub-questions, so the other
+    # events of a chat turn are ignored rather than sent
+    CHAT_CALLBACK_EVENT_TYPES: List[str] = ["sub_question"]
+    # Max number of callback events of a message waiting to be streamed. Events
+    # past it are dropped, since the callbacks can't wait
+    CHAT_CALLBACK_QUEUE_SIZE: int = 256
 
     # BACKEND_CORS_ORIGINS is a JSON-formatted list of origins
     # e.g: '["http://localhost", "http://localhost:4200", "http://localhost:3000", \
@@ -114,6 +226,53 @@ class Settings(PreviewPrefixedSettings):
             raise ValueError("Invalid log level: " + str(v))
         return v
 
+    @field_validator("PDF_PARSER_BACKEND", mode='before')
+    def assemble_pdf_parser_backend(cls, v: str) -> str:
+        """Preprocesses the PDF parser backend to ensure its validity."""
+        v = v.strip().lower()
+        if v not in ["pypdf", "pymupdf", "pdfium"]:
+            raise ValueError("Invalid PDF parser backend: " + str(v))
+        return v
+
+    @field_validator("VECTOR_INDEX_TYPE", mode='before')
+    def assemble_vector_index_type(cls, v: str) -> str:
+        """Preprocesses the vector index type to ensure its validity."""
+        v = v.strip().lower()
+        if v not in ["hnsw", "ivfflat"]:
+            raise ValueError("Invalid vector index type: " + str(v))
+        return v
+
+    @field_validator("VECTOR_INDEX_QUANTIZATION", mode='before')
+    def assemble_vector_index_quantization(cls, v: str) -> str:
+        """Preprocesses the vector index quantization to ensure its validity."""
+        v = v.strip().lower()
+        if v not in ["none", "halfvec", "binary"]:
+            raise ValueError("Invalid vector index quantization: " + str(v))
+        return v
+
+    @field_validator("QUANTITATIVE_ENGINE_MODE", mode='before')
+    def assemble_quantitative_engine_mode(cls, v: str) -> str:
+        """Preprocesses the quantitative engine mode to ensure its validity."""
+        v = v.strip().lower()
+        if v not in ["direct", "agent"]:
+            raise ValueError("Invalid quantitative engine mode: " + str(v))
+        return v
+
+    @field_validator("CHAT_CALLBACK_EVENT_TYPES", mode='before')
+    def assemble_chat_callback_event_types(
+        cls, v: Union[str, List[str]]
+    ) -> List[str]:
+        """Preprocesses the callback event types to ensure their validity."""
+        from llama_index.core.callbacks.schema import CBEventType
+
+        if isinstance(v, str):
+            v = [i for i in v.split(",") if i.strip()]
+        event_types = [i.strip().lower() for i in v]
+        for event_type in event_types:
+            if event_type not in CBEventType._value2member_map_:
+                raise ValueError("Invalid callback event type: " + str(event_type))
+        return event_types
+
     @field_validator("IS_PULL_REQUEST", mode='before')
     def assemble_is_pull_request(cls, v: str) -> bool:
         """Preprocesses the IS_PULL_REQUEST flag.
@@ -20,6 +20,8 @@ from app.loader_io import loader_io_router
 from contextlib import asynccontextmanager
 from app.chat.pg_vector import get_vector_store_singleton, CustomPGVectorStore
 from app.llama_index_settings import _setup_llama_index_settings
+from app.chat.ingestion import shutdown_pdf_process_pool
+from app.chat.polygon_client import close_polygon_io_client
 
 logger = logging.getLogger(__name__)
 
@@ -97,6 +99,8 @@ async def lifespan(app: FastAPI):
     yield
     # This section is run on app shutdown
     await vector_store.close()
+    await close_polygon_io_client()
+    shutdown_pdf_process_pool()
 
 
 app = FastAPI(
@@ -1,6 +1,17 @@
-from sqlalchemy import Column, String, Enum, ForeignKey
+from sqlalchemy import (
+    Column,
+    Date,
+    Float,
+    String,
+    Integer,
+    Enum,
+    ForeignKey,
+    Index,
+    UniqueConstraint,
+)
 from sqlalchemy.dialects.postgresql import UUID, ENUM, JSONB
 from sqlalchemy.orm import relationship
+from pgvector.sqlalchemy import Vector
 from enum import Enum
 from llama_index.core.callbacks.schema import CBEventType
 from app.models.base import Base
@@ -22,6 +33,29 @@ class MessageSubProcessStatusEnum(str, Enum):
     FINISHED = "FINISHED"
 
 
+class IngestionStageEnum(str, Enum):
+    """
+    The stages a document goes through to be ingested, in order
+    """
+
+    DOWNLOADED = "DOWNLOADED"
+    UPLOADED = "UPLOADED"
+    PARSED = "PARSED"
+    EMBEDDED = "EMBEDDED"
+    INDEXED = "INDEXED"
+
+
+class FinancialStatementEnum(str, Enum):
+    """
+    The financial statements of a filing, named like polygon.io's stock financials
+    """
+
+    INCOME_STATEMENT = "income_statement"
+    BALANCE_SHEET = "balance_sheet"
+    CASH_FLOW_STATEMENT = "cash_flow_statement"
+    COMPREHENSIVE_INCOME = "comprehensive_income"
+
+
 # python doesn't allow enums to be extended, so we have to do this
 additional_message_subprocess_fields = {
     "CONSTRUCTED_QUERY_ENGINE": "constructed_query_engine",
@@ -78,15 +112,18 @@ class Message(Base):
     A message in a conversation
     """
 
-    conversation_id = Column(
-        UUID(as_uuid=True), ForeignKey("conversation.id"), index=True
-    )
+    conversation_id = Column(UUID(as_uuid=True), ForeignKey("conversation.id"))
     content = Column(String)
     role = Column(to_pg_enum(MessageRoleEnum))
     status = Column(to_pg_enum(MessageStatusEnum), default=MessageStatusEnum.PENDING)
     conversation = relationship("Conversation", back_populates="messages")
     sub_processes = relationship("MessageSubProcess", back_populates="message")
 
+    # for reading the latest messages of a conversation, e.g. its chat history
+    __table_args__ = (
+        Index("ix_message_conversation_id_created_at", "conversation_id", "created_at"),
+    )
+
 
 class MessageSubProcess(Base):
     """
@@ -102,3 +139,73 @@ class MessageSubProcess(Base):
         nullable=False,
     )
     metadata_map = Column(JSONB, nullable=True)
+
+
+class KVStoreEntry(Base):
+    """
+    A single key-value pair from the key-value store backing the LlamaIndex docstore
+    & index store
+    """
+
+    __table_args__ = (UniqueConstraint("collection", "key"),)
+
+    collection = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    value = Column(JSONB, nullable=False)
+
+
+class EmbeddingCacheEntry(Base):
+    """
+    A cached embedding of a piece of text, keyed by the embedding model and the text's
+    SHA-256
+    """
+
+    __table_args__ = (UniqueConstraint("model", "dimensions", "text_hash"),)
+
+    model = Column(String, nullable=False)
+    # 0 for the model's native number of dimensions
+    dimensions = Column(Integer, nullable=False)
+    text_hash = Column(String, nullable=False)
+    embedding = Column(Vector(), nullable=False)
+
+
+class IngestionManifestEntry(Base):
+    """
+    The last ingestion stage a document completed, keyed by the document's URL
+    """
+
+    url = Column(String, nullable=False, unique=True)
+    document_id = Column(
+        UUID(as_uuid=True), ForeignKey("document.id"), nullable=True, index=True
+    )
+    stage = Column(to_pg_enum(IngestionStageEnum), nullable=False)
+    # SHA-256 of the source the document was generated from, e.g. an SEC
+    # filing's full-submission.txt. A new hash means the document changed.
+    source_sha256 = Column(String, nullable=True)
+    # SHA-256 of the document's file
+    content_sha256 = Column(String, nullable=True)
+    # Error of the last attempt at the stage after `stage`
+    error = Column(String, nullable=True)
+
+
+class DocumentFinancialFact(Base):
+    """
+    A financial figure of a SEC document, extracted from the XBRL data of its filing
+    """
+
+    __table_args__ = (UniqueConstraint("document_id", "statement", "concept"),)
+
+    document_id = Column(
+        UUID(as_uuid=True), ForeignKey("document.id"), nullable=False, index=True
+    )
+    statement = Column(to_pg_enum(FinancialStatementEnum), nullable=False)
+    # polygon.io's name for the figure, e.g. "revenues"
+    concept = Column(String, nullable=False)
+    # the XBRL concept it was reported as, e.g. "us-gaap:Revenues"
+    xbrl_concept = Column(String, nullable=False)
+    label = Column(String, nullable=False)
+    value = Column(Float, nullable=False)
+    unit = Column(String, nullable=False)
+    # null for figures at an instant, like those of the balance sheet
+    start_date = Column(Date, nullable=True)
+    end_date = Column(Date, nullable=False)
@@ -3,13 +3,15 @@ Pydantic Schemas for the API
 """
 from pydantic import BaseModel, Field, validator
 from enum import Enum
-from typing import List, Optional, Dict, Union, Any
+from typing import List, Literal, Optional, Dict, Union, Any
 from uuid import UUID
-from datetime import datetime
+from datetime import date, datetime
 from llama_index.core.schema import BaseNode, NodeWithScore
 from llama_index.core.callbacks.schema import EventPayload
 from llama_index.core.query_engine.sub_question_query_engine import SubQuestionAnswerPair
 from app.models.db import (
+    FinancialStatementEnum,
+    IngestionStageEnum,
     MessageRoleEnum,
     MessageStatusEnum,
     MessageSubProcessSourceEnum,
@@ -119,12 +121,85 @@ class UserMessageCreate(BaseModel):
     content: str
 
 
+class MessageStreamProtocolEnum(str, Enum):
+    """
+    Enum for the protocols of the SSE stream of an assistant message
+    """
+
+    # every event is the whole message generated so far
+    CUMULATIVE = "cumulative"
+    # events are content deltas & sub-process patches, ending with the whole message
+    DELTA = "delta"
+
+
+MESSAGE_STREAM_DELTA_VERSION = 1
+
+
+class MessageStreamEventTypeEnum(str, Enum):
+    START = "start"
+    PATCH = "patch"
+    SNAPSHOT = "snapshot"
+
+
+class MessageStreamEvent(BaseModel):
+    """
+    An event of the delta protocol's SSE stream of an assistant message
+    """
+
+    version: int = MESSAGE_STREAM_DELTA_VERSION
+    type: MessageStreamEventTypeEnum
+
+
+class MessageStreamStart(MessageStreamEvent):
+    """
+    The message before any content or sub-process was generated
+    """
+
+    type: Literal[MessageStreamEventTypeEnum.START] = MessageStreamEventTypeEnum.START
+    message: Message
+
+
+class MessageSubProcessPatch(BaseModel):
+    """
+    The sub-process of a callback event, which replaces any earlier sub-process
+    of the same event ID, or else is appended to the message's sub-processes
+    """
+
+    event_id: str
+    sub_process: MessageSubProcess
+
+
+class MessageStreamPatch(MessageStreamEvent):
+    """
+    The updates of the message since the previous event: text to append to its
+    content & its added or replaced sub-processes
+    """
+
+    type: Literal[MessageStreamEventTypeEnum.PATCH] = MessageStreamEventTypeEnum.PATCH
+    delta: str = ""
+    sub_processes: List[MessageSubProcessPatch] = []
+
+
+class MessageStreamSnapshot(MessageStreamEvent):
+    """
+    The whole message once it's been generated & saved, which replaces the
+    message built from the earlier events
+    """
+
+    type: Literal[
+        MessageStreamEventTypeEnum.SNAPSHOT
+    ] = MessageStreamEventTypeEnum.SNAPSHOT
+    message: Message
+
+
 class DocumentMetadataKeysEnum(str, Enum):
     """
     Enum for the keys of the metadata map for a document
     """
 
     SEC_DOCUMENT = "sec_document"
+    # hex SHA-256 of the document's file, used to look up its cached page text
+    CONTENT_SHA256 = "content_sha256"
 
 
 class SecDocumentTypeEnum(str, Enum):
@@ -161,6 +236,27 @@ class Document(Base):
     metadata_map: Optional[DocumentMetadataMap] = None
 
 
+class IngestionManifestEntry(Base):
+    url: str
+    document_id: Optional[UUID] = None
+    stage: IngestionStageEnum
+    source_sha256: Optional[str] = None
+    content_sha256: Optional[str] = None
+    error: Optional[str] = None
+
+
+class DocumentFinancialFact(Base):
+    document_id: Optional[UUID] = None
+    statement: FinancialStatementEnum
+    concept: str
+    xbrl_concept: str
+    label: str
+    value: float
+    unit: str
+    start_date: Optional[date] = None
+    end_date: date
+
+
 class Conversation(Base):
     messages: List[Message]
     documents: List[Document]
@@ -0,0 +1,106 @@
+from typing import Any, Dict, List, Optional
+import asyncio
+import statistics
+import time
+from fire import Fire
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.callbacks.schema import CBEventType
+from app.db.session import SessionLocal
+from app.api import crud
+from app import schema
+from app.chat.engine import (
+    get_chat_engine,
+    get_chat_engine_cache_stats,
+    clear_chat_engine_cache,
+)
+from app.llama_index_settings import _setup_llama_index_settings
+
+
+class NoOpCallbackHandler(BaseCallbackHandler):
+    def __init__(self):
+        super().__init__([], [])
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        """No-op."""
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        """No-op."""
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        """No-op."""
+
+
+async def time_get_chat_engine(conversation: schema.Conversation) -> float:
+    start_time = time.perf_counter()
+    await get_chat_engine(NoOpCallbackHandler(), conversation)
+    return time.perf_counter() - start_time
+
+
+async def async_benchmark_chat_engine(
+    document_ids: Optional[List[str]] = None, num_docs: int = 5, iterations: int = 10
+):
+    _setup_llama_index_settings()
+    async with SessionLocal() as db:
+        if document_ids:
+            docs = await crud.fetch_documents(db, ids=document_ids)
+        else:
+            docs = await crud.fetch_documents(db, limit=num_docs)
+    conversation = schema.Conversation(messages=[], documents=docs)
+
+    cold_timings = []
+    for _ in range(iterations):
+        clear_chat_engine_cache()
+        cold_timings.append(await time_get_chat_engine(conversation))
+
+    clear_chat_engine_cache()
+    await time_get_chat_engine(conversation)
+    warm_timings = [
+        await time_get_chat_engine(conversation) for _ in range(iterations)
+    ]
+
+    print(f"Chat engine construction for {len(docs)} documents:")
+    for label, timings in (("cold", cold_timings), ("warm", warm_timings)):
+        print(
+            f"\t- {label}: median={statistics.median(timings) * 1000:.1f}ms "
+            f"max={max(timings) * 1000:.1f}ms"
+        )
+    stats = get_chat_engine_cache_stats()
+    print(f"\t- cache: hits={stats.hits} misses={stats.misses}")
+
+
+def benchmark_chat_engine(
+    document_ids: Optional[List[str]] = None, num_docs: int = 5, iterations: int = 10
+):
+    """
+    Compare the cost of building a chat engine with a cold and a warm tool graph cache.
+
+    :param document_ids: IDs of the documents to build the engine for. Defaults to
+        the first num_docs documents.
+    :param num_docs: Number of documents to use when document_ids isn't given.
+    :param iterations: Number of timed constructions per mode.
+    """
+    asyncio.run(async_benchmark_chat_engine(document_ids, num_docs, iterations))
+
+
+if __name__ == "__main__":
+    Fire(benchmark_chat_engine)
@@ -0,0 +1,130 @@
+from typing import List, Optional
+import asyncio
+import statistics
+import time
+from fire import Fire
+from llama_index.core import Settings
+from llama_index.core.vector_stores.types import (
+    ExactMatchFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+)
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.api import crud
+from app.chat.constants import DB_DOC_ID_KEY
+from app.chat.pg_vector import get_vector_store_singleton
+from app.llama_index_settings import _setup_llama_index_settings
+
+DEFAULT_QUESTIONS = [
+    "Was there a goodwill impairment charge?",
+    "What was the effective tax rate?",
+    "How much was spent on share repurchases?",
+    "What are the main risk factors?",
+]
+
+
+async def async_benchmark_hybrid_retrieval(
+    document_ids: Optional[List[str]] = None,
+    num_docs: int = 5,
+    questions: Optional[List[str]] = None,
+    iterations: int = 10,
+    top_k: int = 3,
+    candidates: int = settings.VECTOR_QUERY_HYBRID_CANDIDATES,
+):
+    _setup_llama_index_settings()
+    async with SessionLocal() as db:
+        if document_ids:
+            docs = await crud.fetch_documents(db, ids=document_ids)
+        else:
+            docs = await crud.fetch_documents(db, limit=num_docs)
+    vector_store = await get_vector_store_singleton()
+
+    questions = questions or DEFAULT_QUESTIONS
+    embeddings = await Settings.embed_model.aget_text_embedding_batch(questions)
+    queries_by_mode = {
+        mode: [
+            VectorStoreQuery(
+                query_embedding=embedding,
+                query_str=question,
+                # the vector search's own top k, or its candidates for the fusion
+                similarity_top_k=(
+                    top_k if mode == VectorStoreQueryMode.DEFAULT else candidates
+                ),
+                sparse_top_k=candidates,
+                hybrid_top_k=top_k,
+                mode=mode,
+                filters=MetadataFilters(
+                    filters=[ExactMatchFilter(key=DB_DOC_ID_KEY, value=str(doc.id))]
+                ),
+            )
+            for question, embedding in zip(questions, embeddings)
+            for doc in docs
+        ]
+        for mode in (VectorStoreQueryMode.DEFAULT, VectorStoreQueryMode.HYBRID)
+    }
+
+    results_by_mode = {}
+    print(f"{len(questions)} questions over {len(docs)} documents, top {top_k}:")
+    for mode, queries in queries_by_mode.items():
+        timings = []
+        for _ in range(iterations):
+            results = []
+            for query in queries:
+                start_time = time.perf_counter()
+                results.append(await vector_store.aquery(query, exact_search=True))
+                timings.append(time.perf_counter() - start_time)
+        results_by_mode[mode] = results
+        timings.sort()
+        print(
+            f"\t- {mode.value}: p50={statistics.median(timings) * 1000:.1f}ms "
+            f"p99={timings[int(len(timings) * 0.99)] * 1000:.1f}ms"
+        )
+
+    # chunks that only the hybrid search found, e.g. by an exact term
+    num_new_chunks = sum(
+        len(set(hybrid.ids or []) - set(dense.ids or []))
+        for dense, hybrid in zip(
+            results_by_mode[VectorStoreQueryMode.DEFAULT],
+            results_by_mode[VectorStoreQueryMode.HYBRID],
+        )
+    )
+    num_chunks = sum(
+        len(result.ids or [])
+        for result in results_by_mode[VectorStoreQueryMode.HYBRID]
+    )
+    print(
+        f"\t- hybrid results not found by vector search: {num_new_chunks}/{num_chunks}"
+    )
+
+
+def benchmark_hybrid_retrieval(
+    document_ids: Optional[List[str]] = None,
+    num_docs: int = 5,
+    questions: Optional[List[str]] = None,
+    iterations: int = 10,
+    top_k: int = 3,
+    candidates: int = settings.VECTOR_QUERY_HYBRID_CANDIDATES,
+):
+    """
+    Compare the latency of per-document hybrid (full-text + vector) search with
+    vector-only search, and count the chunks only the hybrid search retrieves.
+
+    :param document_ids: IDs of the documents to query. Defaults to the first
+        num_docs documents.
+    :param num_docs: Number of documents to use when document_ids isn't given.
+    :param questions: Questions to ask of every document.
+    :param iterations: Number of timed runs per mode.
+    :param top_k: Number of chunks retrieved per document.
+    :param candidates: Number of candidates each search contributes to a hybrid search.
+    """
+    asyncio.run(
+        async_benchmark_hybrid_retrieval(
+            document_ids, num_docs, questions, iterations, top_k, candidates
+        )
+    )
+
+
+if __name__ == "__main__":
+    Fire(benchmark_hybrid_retrieval)
@@ -0,0 +1,151 @@
+from typing import List, Optional, Union
+import time
+from uuid import uuid4
+from fire import Fire
+from app import schema
+from app.chat.messaging import (
+    StreamedMessage,
+    StreamedMessageBuilder,
+    StreamedMessageSubProcess,
+    get_message_stream_encoder,
+)
+from app.models.db import (
+    Message,
+    MessageRoleEnum,
+    MessageStatusEnum,
+    MessageSubProcessSourceEnum,
+)
+
+DEFAULT_PROTOCOLS = [protocol.value for protocol in schema.MessageStreamProtocolEnum]
+
+
+def make_streamed_answer(
+    num_tokens: int,
+    num_sub_questions: int,
+    num_citations: int,
+    citation_length: int,
+) -> List[Union[StreamedMessage, StreamedMessageSubProcess]]:
+    """
+    Make the objects streamed by handle_chat_message for an answer: the
+    sub-questions with their citations, then the tokens of the answer.
+    """
+    streamed_answer = [
+        StreamedMessageSubProcess(
+            source=MessageSubProcessSourceEnum.CONSTRUCTED_QUERY_ENGINE,
+            has_ended=True,
+            event_id=str(uuid4()),
+        )
+    ]
+    for i in range(num_sub_questions):
+        event_id = str(uuid4())
+        question = f"What was the revenue of company {i} in the last fiscal year?"
+        citations = [
+            {
+                "document_id": str(uuid4()),
+                "text": ("Total net sales were $383,285 million. " * citation_length)[
+                    :citation_length
+                ],
+                "page_number": 20 + j,
+                "score": 0.8,
+            }
+            for j in range(num_citations)
+        ]
+        streamed_answer += [
+            StreamedMessageSubProcess(
+                source=MessageSubProcessSourceEnum.SUB_QUESTION,
+                has_ended=False,
+                event_id=event_id,
+                metadata_map={"sub_question": {"question": question}},
+            ),
+            StreamedMessageSubProcess(
+                source=MessageSubProcessSourceEnum.SUB_QUESTION,
+                has_ended=True,
+                event_id=event_id,
+                metadata_map={
+                    "sub_question": {
+                        "question": question,
+                        "answer": "The revenue was $383 billion.",
+                        "citations": citations,
+                    }
+                },
+            ),
+        ]
+    streamed_answer += [StreamedMessage(delta=f" token{i}") for i in range(num_tokens)]
+    return streamed_answer
+
+
+def get_sse_size(data: str) -> int:
+    # "data: ...\r\n\r\n", as sent by sse_starlette
+    return len(f"data: {data}\r\n\r\n".encode())
+
+
+def stream_answer(
+    protocol: schema.MessageStreamProtocolEnum,
+    streamed_answer: List[Union[StreamedMessage, StreamedMessageSubProcess]],
+) -> List[str]:
+    encoder = get_message_stream_encoder(protocol)
+    message = Message(
+        id=str(uuid4()),
+        conversation_id=str(uuid4()),
+        content="",
+        role=MessageRoleEnum.assistant,
+        status=MessageStatusEnum.PENDING,
+        sub_processes=[],
+    )
+    builder = StreamedMessageBuilder(message)
+    events = [encoder.encode_start(message)]
+    for message_obj in streamed_answer:
+        builder.add(message_obj)
+        events.append(builder.flush(encoder))
+    message.status = MessageStatusEnum.SUCCESS
+    events.append(encoder.encode_final(schema.Message.from_orm(message)))
+    return [event for event in events if event is not None]
+
+
+def benchmark_message_stream(
+    num_tokens: int = 500,
+    num_sub_questions: int = 4,
+    num_citations: int = 3,
+    citation_length: int = 2000,
+    iterations: int = 5,
+    protocols: Optional[List[str]] = None,
+):
+    """
+    Compare the bytes sent & the CPU time spent encoding the SSE stream of an
+    assistant message with each stream protocol of the /message endpoint, for a
+    synthetic answer, with an event per update. Doesn't need the database or
+    the OpenAI API. See scripts/loadtest_message_stream.py for the batching of
+    updates into fewer events.
+
+    :param num_tokens: Number of streamed tokens of the answer.
+    :param num_sub_questions: Number of sub-questions of the answer.
+    :param num_citations: Number of citations of each sub-question.
+    :param citation_length: Number of characters of each citation.
+    :param iterations: Number of times the answer is streamed per protocol.
+    :param protocols: Protocols to compare, of "cumulative" & "delta".
+    """
+    streamed_answer = make_streamed_answer(
+        num_tokens, num_sub_questions, num_citations, citation_length
+    )
+    print(
+        f"Streaming an answer of {num_tokens} tokens & {num_sub_questions} "
+        f"sub-questions with {num_citations} citations of {citation_length} "
+        f"characters each, {iterations} times:"
+    )
+    for protocol in protocols or DEFAULT_PROTOCOLS:
+        protocol = schema.MessageStreamProtocolEnum(protocol)
+        cpu_times = []
+        for _ in range(iterations):
+            start_time = time.process_time()
+            events = stream_answer(protocol, streamed_answer)
+            cpu_times.append(time.process_time() - start_time)
+        num_bytes = sum(map(get_sse_size, events))
+        print(
+            f"\t- {protocol.value}: {len(events)} events, "
+            f"{num_bytes / 1024:.1f} KiB, "
+            f"{min(cpu_times) * 1000:.1f}ms CPU per answer"
+        )
+
+
+if __name__ == "__main__":
+    Fire(benchmark_message_stream)
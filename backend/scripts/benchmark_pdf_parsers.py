@@ -0,0 +1,76 @@
+from typing import List, Optional
+from pathlib import Path
+import multiprocessing
+import resource
+import time
+from fire import Fire
+from app.chat.pdf_parsing import PdfParserBackendEnum, get_pdf_text_extractor
+
+DEFAULT_FIXTURE_DIR = "data/"
+
+
+def _parse_fixtures(backend: str, file_paths: List[str], result_queue) -> None:
+    """
+    Parse every fixture with the given backend. Run in its own process so that
+    peak RSS is measured per backend.
+    """
+    try:
+        extractor = get_pdf_text_extractor(backend)
+        num_pages = 0
+        num_chars = 0
+        start_time = time.perf_counter()
+        for file_path in file_paths:
+            page_count = extractor.count_pages(file_path)
+            pages = extractor.extract_page_range(file_path, 0, page_count)
+            num_pages += len(pages)
+            num_chars += sum(len(text) for _, text in pages)
+        seconds = time.perf_counter() - start_time
+        # ru_maxrss is reported in kilobytes on linux
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        result_queue.put((backend, num_pages, num_chars, seconds, peak_rss_mb, None))
+    except Exception as e:
+        result_queue.put((backend, 0, 0, 0.0, 0.0, repr(e)))
+
+
+def benchmark_pdf_parsers(
+    fixture_dir: str = DEFAULT_FIXTURE_DIR,
+    backends: Optional[List[str]] = None,
+    limit: Optional[int] = None,
+):
+    """
+    Report pages/sec and peak RSS of each PDF text extraction backend.
+
+    :param fixture_dir: Directory that is searched recursively for PDFs, e.g. the
+        output_dir of download_sec_pdf.py.
+    :param backends: Backends to benchmark. Defaults to all of them.
+    :param limit: Max number of PDFs to parse.
+    """
+    file_paths = sorted(str(path) for path in Path(fixture_dir).rglob("*.pdf"))[:limit]
+    if not file_paths:
+        print(f"No PDFs found in {Path(fixture_dir).absolute()}")
+        return
+    backends = backends or [backend.value for backend in PdfParserBackendEnum]
+    print(f"Parsing {len(file_paths)} PDFs from {Path(fixture_dir).absolute()}")
+
+    ctx = multiprocessing.get_context("spawn")
+    for backend in backends:
+        result_queue = ctx.Queue()
+        process = ctx.Process(
+            target=_parse_fixtures, args=(backend, file_paths, result_queue)
+        )
+        process.start()
+        _, num_pages, num_chars, seconds, peak_rss_mb, error = result_queue.get()
+        process.join()
+        if error is not None:
+            print(f"- {backend}: failed with {error}")
+            continue
+        print(
+            f"- {backend}: {num_pages} pages in {seconds:.1f}s "
+            f"({num_pages / seconds:.1f} pages/sec), "
+            f"{num_chars / max(num_pages, 1):.0f} chars/page, "
+            f"peak RSS {peak_rss_mb:.0f}MB"
+        )
+
+
+if __name__ == "__main__":
+    Fire(benchmark_pdf_parsers)
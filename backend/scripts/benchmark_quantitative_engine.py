@@ -0,0 +1,107 @@
+from typing import List, Optional
+import asyncio
+import statistics
+import time
+import tiktoken
+from fire import Fire
+from llama_index.core import Settings
+from llama_index.core.callbacks import CallbackManager, TokenCountingHandler
+from app.db.session import SessionLocal
+from app.api import crud
+from app.chat.engine import build_quantitative_question_engine
+from app.chat.qa_response_synth import get_custom_response_synth
+from app.llama_index_settings import _setup_llama_index_settings
+
+DEFAULT_MODES = ["agent", "direct"]
+DEFAULT_QUESTIONS = [
+    "What was the revenue?",
+    "What was the net income, and how does it compare with the revenue?",
+    "How much cash was generated from operating activities?",
+]
+
+
+async def async_benchmark_quantitative_engine(
+    document_ids: Optional[List[str]],
+    num_docs: int,
+    questions: List[str],
+    modes: List[str],
+    iterations: int,
+):
+    _setup_llama_index_settings()
+    async with SessionLocal() as db:
+        if document_ids:
+            docs = await crud.fetch_documents(db, ids=document_ids)
+        else:
+            docs = await crud.fetch_documents(db, limit=num_docs)
+
+    # count the tokens of every LLM call, including the sub-question generator's
+    token_counter = TokenCountingHandler(
+        tokenizer=tiktoken.encoding_for_model("gpt-4o").encode
+    )
+    callback_manager = CallbackManager([token_counter])
+    Settings.callback_manager = callback_manager
+    Settings.llm.callback_manager = callback_manager
+
+    print(
+        f"Quantitative question engine over {len(docs)} documents, "
+        f"{len(questions)} questions x {iterations} iterations:"
+    )
+    for mode in modes:
+        engine = build_quantitative_question_engine(
+            docs,
+            callback_manager,
+            get_custom_response_synth(callback_manager, docs),
+            mode=mode,
+        )
+        latencies = []
+        token_counter.reset_counts()
+        for _ in range(iterations):
+            for question in questions:
+                start_time = time.perf_counter()
+                await engine.aquery(question)
+                latencies.append(time.perf_counter() - start_time)
+        num_queries = len(latencies)
+        print(
+            f"\t- {mode}: median={statistics.median(latencies):.2f}s "
+            f"max={max(latencies):.2f}s, per question: "
+            f"{len(token_counter.llm_token_counts) / num_queries:.1f} LLM calls, "
+            f"{token_counter.prompt_llm_token_count / num_queries:.0f} prompt & "
+            f"{token_counter.completion_llm_token_count / num_queries:.0f} "
+            "completion tokens"
+        )
+
+
+def benchmark_quantitative_engine(
+    document_ids: Optional[List[str]] = None,
+    num_docs: int = 2,
+    questions: Optional[List[str]] = None,
+    modes: Optional[List[str]] = None,
+    iterations: int = 3,
+):
+    """
+    Compare the latency & LLM token usage of the quantitative question engine's
+    modes: a per-document agent calling the financial data function ("agent"),
+    or the sub-question engine calling it directly ("direct"). Calls the
+    OpenAI API, and reads financials like the app does (see
+    QUANTITATIVE_ENGINE_MODE & the POLYGON_IO_* settings).
+
+    :param document_ids: IDs of the SEC documents to ask about. Defaults to the
+        first num_docs documents.
+    :param num_docs: Number of documents to use when document_ids isn't given.
+    :param questions: Quantitative questions to ask about all the documents.
+    :param modes: Modes to compare, of "agent" & "direct".
+    :param iterations: Number of times each question is asked per mode.
+    """
+    asyncio.run(
+        async_benchmark_quantitative_engine(
+            document_ids,
+            num_docs,
+            questions or DEFAULT_QUESTIONS,
+            modes or DEFAULT_MODES,
+            iterations,
+        )
+    )
+
+
+if __name__ == "__main__":
+    Fire(benchmark_quantitative_engine)
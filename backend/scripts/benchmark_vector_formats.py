@@ -0,0 +1,298 @@
+from typing import List, Optional, Tuple
+import asyncio
+import time
+import asyncpg
+import numpy as np
+from fire import Fire
+from pgvector.asyncpg import register_vector
+from app.core.config import settings
+from app.chat.pg_vector import QUANTIZATION_OPERATORS
+from benchmark_vector_index import (
+    LOAD_BATCH_SIZE,
+    get_asyncpg_dsn,
+    make_clustered_vectors,
+    normalize,
+    percentile,
+)
+
+DEFAULT_TABLE_PREFIX = "vector_format_benchmark"
+DEFAULT_DIMENSIONS = [1536, 768, 512, 256]
+DEFAULT_QUANTIZATIONS = ["none", "halfvec", "binary"]
+# the compact representation of an embedding expression, for each quantization
+QUANTIZED_EXPRESSIONS = {
+    "none": "{expression}",
+    "halfvec": "({expression})::halfvec({dim})",
+    "binary": "binary_quantize({expression})::bit({dim})",
+}
+
+
+def shorten(vectors: np.ndarray, dim: int) -> np.ndarray:
+    # what the dimensions parameter of the embedding API does to text-embedding-3
+    # embeddings
+    return normalize(vectors[:, :dim]).astype(np.float32)
+
+
+async def load_vector_store_corpus(
+    conn: asyncpg.Connection, num_vectors: int, num_queries: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    A random sample of the vector store's embeddings, split into the corpus &
+    held out queries.
+    """
+    rows = await conn.fetch(
+        f"SELECT embedding FROM data_{settings.VECTOR_STORE_TABLE_NAME} "
+        "ORDER BY random() LIMIT $1",
+        num_vectors + num_queries,
+    )
+    vectors = np.array([row["embedding"] for row in rows], dtype=np.float32)
+    vectors = normalize(vectors)
+    return vectors[num_queries:], vectors[:num_queries]
+
+
+def exact_top_k(corpus: np.ndarray, queries: np.ndarray, top_k: int) -> List[set]:
+    """
+    The IDs of each query's top_k neighbours, by full precision & full
+    dimension cosine similarity.
+    """
+    similarities = queries @ corpus.T
+    top_indices = np.argsort(-similarities, axis=1)[:, :top_k]
+    # table IDs are the corpus row numbers, starting at 1
+    return [set((indices + 1).tolist()) for indices in top_indices]
+
+
+async def load_table(
+    conn: asyncpg.Connection, table_name: str, vectors: np.ndarray
+) -> None:
+    await conn.execute(f"DROP TABLE IF EXISTS {table_name}")
+    await conn.execute(
+        f"CREATE TABLE {table_name} "
+        f"(id BIGINT PRIMARY KEY, embedding vector({vectors.shape[1]}) NOT NULL)"
+    )
+    for start in range(0, len(vectors), LOAD_BATCH_SIZE):
+        batch = vectors[start : start + LOAD_BATCH_SIZE]
+        await conn.copy_records_to_table(
+            table_name,
+            records=[(start + i + 1, vector) for i, vector in enumerate(batch)],
+            columns=["id", "embedding"],
+        )
+    await conn.execute(f"ANALYZE {table_name}")
+
+
+async def build_index(
+    conn: asyncpg.Connection,
+    table_name: str,
+    dim: int,
+    quantization: str,
+    hnsw_m: int,
+    hnsw_ef_construction: int,
+    maintenance_work_mem: str,
+) -> float:
+    """
+    Build the HNSW index of the quantization, returning the build time.
+    """
+    index_name = f"{table_name}_embedding_idx"
+    _, operator_class = QUANTIZATION_OPERATORS[quantization]
+    expression = QUANTIZED_EXPRESSIONS[quantization].format(
+        expression="embedding", dim=dim
+    )
+    await conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+    await conn.execute(f"SET maintenance_work_mem = '{maintenance_work_mem}'")
+    start_time = time.perf_counter()
+    await conn.execute(
+        f"CREATE INDEX {index_name} ON {table_name} USING hnsw "
+        f"(({expression}) {operator_class}) "
+        f"WITH (m = {hnsw_m}, ef_construction = {hnsw_ef_construction})"
+    )
+    return time.perf_counter() - start_time
+
+
+def build_search_sql(table_name: str, dim: int, quantization: str) -> str:
+    """
+    A search through the index with $1 as the query embedding & $2 as top k,
+    whose candidates are rescored by full precision when the index is quantized.
+    """
+    if quantization == "none":
+        return f"SELECT id FROM {table_name} ORDER BY embedding <=> $1 LIMIT $2"
+    operator, _ = QUANTIZATION_OPERATORS[quantization]
+    expression = QUANTIZED_EXPRESSIONS[quantization]
+    quantized_distance = (
+        f"{expression.format(expression='embedding', dim=dim)} {operator} "
+        f"{expression.format(expression=f'$1::vector({dim})', dim=dim)}"
+    )
+    return (
+        f"SELECT id FROM ("
+        f"SELECT id, embedding FROM {table_name} "
+        f"ORDER BY {quantized_distance} LIMIT $3"
+        f") AS candidates ORDER BY embedding <=> $1 LIMIT $2"
+    )
+
+
+async def get_sizes(conn: asyncpg.Connection, table_name: str) -> Tuple[int, int]:
+    return await conn.fetchrow(
+        "SELECT pg_table_size($1::regclass), pg_relation_size($2::regclass)",
+        table_name,
+        f"{table_name}_embedding_idx",
+    )
+
+
+def format_size(num_bytes: int) -> str:
+    return f"{num_bytes / 1024**2:.0f}MB"
+
+
+async def async_benchmark_vector_formats(
+    dimensions: List[int],
+    quantizations: List[str],
+    source: str,
+    num_vectors: int,
+    num_clusters: int,
+    noise: float,
+    num_queries: int,
+    top_k: int,
+    rescore_factor: int,
+    ef_search: Optional[int],
+    hnsw_m: int,
+    hnsw_ef_construction: int,
+    maintenance_work_mem: str,
+    table_prefix: str,
+    seed: int,
+):
+    conn = await asyncpg.connect(get_asyncpg_dsn())
+    try:
+        await conn.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        await register_vector(conn)
+        if source == "vector_store":
+            corpus, queries = await load_vector_store_corpus(
+                conn, num_vectors, num_queries
+            )
+        else:
+            rng = np.random.default_rng(seed)
+            centers = normalize(rng.normal(size=(num_clusters, max(dimensions))))
+            corpus = make_clustered_vectors(rng, centers, num_vectors, noise)
+            queries = make_clustered_vectors(rng, centers, num_queries, noise)
+        exact_results = exact_top_k(corpus, queries, top_k)
+        print(
+            f"{len(corpus)} {source} vectors, {len(queries)} queries, k={top_k}, "
+            f"rescoring {top_k * rescore_factor} candidates. Recall is against "
+            f"full precision search over all {corpus.shape[1]} dimensions:"
+        )
+
+        for dim in dimensions:
+            table_name = f"{table_prefix}_{dim}"
+            await load_table(conn, table_name, shorten(corpus, dim))
+            dim_queries = shorten(queries, dim)
+            for quantization in quantizations:
+                build_time = await build_index(
+                    conn,
+                    table_name,
+                    dim,
+                    quantization,
+                    hnsw_m,
+                    hnsw_ef_construction,
+                    maintenance_work_mem,
+                )
+                table_size, index_size = await get_sizes(conn, table_name)
+                search_sql = build_search_sql(table_name, dim, quantization)
+                num_candidates = top_k * rescore_factor
+                recalls = []
+                latencies = []
+                start_time = time.perf_counter()
+                for query, exact_ids in zip(dim_queries, exact_results):
+                    async with conn.transaction():
+                        # HNSW returns at most ef_search candidates
+                        await conn.execute(
+                            "SELECT set_config('hnsw.ef_search', $1, true)",
+                            str(ef_search or max(40, num_candidates)),
+                        )
+                        query_start_time = time.perf_counter()
+                        args = [query, top_k]
+                        if quantization != "none":
+                            args.append(num_candidates)
+                        rows = await conn.fetch(search_sql, *args)
+                        latencies.append(time.perf_counter() - query_start_time)
+                    recalls.append(
+                        len(exact_ids.intersection(row["id"] for row in rows)) / top_k
+                    )
+                qps = len(dim_queries) / (time.perf_counter() - start_time)
+                print(
+                    f"\t- {dim} dimensions, {quantization} index: "
+                    f"table {format_size(table_size)}, "
+                    f"index {format_size(index_size)} (built in {build_time:.1f}s), "
+                    f"recall@{top_k}={np.mean(recalls):.3f} qps={qps:.0f} "
+                    f"p50={percentile(latencies, 50) * 1000:.1f}ms "
+                    f"p99={percentile(latencies, 99) * 1000:.1f}ms"
+                )
+            await conn.execute(f"DROP TABLE {table_name}")
+    finally:
+        await conn.close()
+
+
+def benchmark_vector_formats(
+    dimensions: Optional[List[int]] = None,
+    quantizations: Optional[List[str]] = None,
+    source: str = "synthetic",
+    num_vectors: int = 50_000,
+    num_clusters: int = 1000,
+    noise: float = 0.05,
+    num_queries: int = 200,
+    top_k: int = 3,
+    rescore_factor: int = settings.VECTOR_QUERY_RESCORE_FACTOR,
+    ef_search: Optional[int] = None,
+    hnsw_m: int = settings.VECTOR_INDEX_HNSW_M,
+    hnsw_ef_construction: int = settings.VECTOR_INDEX_HNSW_EF_CONSTRUCTION,
+    maintenance_work_mem: str = "2GB",
+    table_prefix: str = DEFAULT_TABLE_PREFIX,
+    seed: int = 0,
+):
+    """
+    Compare the table size, index size, recall@k & QPS of each storage format
+    of the embeddings: every combination of a number of dimensions and an
+    index quantization. Quantized indices are searched like the vector store
+    does, by rescoring over-fetched candidates with full precision. Needs
+    pgvector 0.7+ for the halfvec & binary quantizations.
+
+    Each format gets its own table of the DATABASE_URL database, which is
+    dropped once it's measured. QPS is of sequential searches on one connection.
+    Use the results to pick the EMBEDDING_DIMENSIONS, VECTOR_INDEX_QUANTIZATION
+    & VECTOR_QUERY_RESCORE_FACTOR settings.
+
+    :param dimensions: Numbers of dimensions the embeddings are shortened to.
+    :param quantizations: Index quantizations, of "none", "halfvec" & "binary".
+    :param source: "synthetic" for clustered random vectors, or "vector_store" to
+        sample the vector store's embeddings.
+    :param num_vectors: Size of the corpus.
+    :param num_clusters: Number of clusters synthetic vectors are scattered around.
+    :param noise: Standard deviation of each synthetic vector's distance to its
+        cluster center.
+    :param num_queries: Number of queries timed per format.
+    :param top_k: Number of neighbours each query retrieves.
+    :param rescore_factor: Candidates fetched through a quantized index per result.
+    :param ef_search: The HNSW index's ef_search. Defaults to enough for the candidates.
+    :param hnsw_m: The HNSW index's m.
+    :param hnsw_ef_construction: The HNSW index's ef_construction.
+    :param maintenance_work_mem: Memory for building each index.
+    :param table_prefix: Prefix of the tables holding each format's corpus.
+    :param seed: Random seed of the synthetic corpus & queries.
+    """
+    asyncio.run(
+        async_benchmark_vector_formats(
+            dimensions or DEFAULT_DIMENSIONS,
+            quantizations or DEFAULT_QUANTIZATIONS,
+            source,
+            num_vectors,
+            num_clusters,
+            noise,
+            num_queries,
+            top_k,
+            rescore_factor,
+            ef_search,
+            hnsw_m,
+            hnsw_ef_construction,
+            maintenance_work_mem,
+            table_prefix,
+            seed,
+        )
+    )
+
+
+if __name__ == "__main__":
+    Fire(benchmark_vector_formats)
@@ -0,0 +1,269 @@
+from typing import List, Optional, Tuple
+import asyncio
+import statistics
+import time
+import asyncpg
+import numpy as np
+from fire import Fire
+from pgvector.asyncpg import register_vector
+from sqlalchemy.engine import make_url
+from app.core.config import settings
+
+DEFAULT_TABLE_NAME = "vector_index_benchmark"
+DEFAULT_EF_SEARCH_VALUES = [10, 20, 40, 80, 160, 320]
+DEFAULT_PROBES_VALUES = [1, 2, 5, 10, 20, 50]
+LOAD_BATCH_SIZE = 10_000
+
+
+def get_asyncpg_dsn() -> str:
+    url = make_url(settings.DATABASE_URL).set(drivername="postgresql")
+    return url.render_as_string(hide_password=False)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_clustered_vectors(
+    rng: np.random.Generator, centers: np.ndarray, num_vectors: int, noise: float
+) -> np.ndarray:
+    """
+    Unit vectors scattered around random cluster centers, which resemble real
+    embeddings far more than uniformly random vectors do.
+    """
+    assignments = rng.integers(0, len(centers), size=num_vectors)
+    vectors = centers[assignments] + rng.normal(
+        scale=noise, size=(num_vectors, centers.shape[1])
+    )
+    return normalize(vectors).astype(np.float32)
+
+
+async def load_corpus(
+    conn: asyncpg.Connection,
+    table_name: str,
+    centers: np.ndarray,
+    num_vectors: int,
+    noise: float,
+    rng: np.random.Generator,
+) -> None:
+    dim = centers.shape[1]
+    await conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {table_name} "
+        f"(id BIGSERIAL PRIMARY KEY, embedding vector({dim}) NOT NULL)"
+    )
+    if await conn.fetchval(f"SELECT count(*) FROM {table_name}") == num_vectors:
+        print(f"Reusing the {num_vectors} vectors in {table_name}")
+        return
+
+    await conn.execute(f"TRUNCATE {table_name}")
+    start_time = time.perf_counter()
+    for start in range(0, num_vectors, LOAD_BATCH_SIZE):
+        batch = make_clustered_vectors(
+            rng, centers, min(LOAD_BATCH_SIZE, num_vectors - start), noise
+        )
+        await conn.copy_records_to_table(
+            table_name, records=[(vector,) for vector in batch], columns=["embedding"]
+        )
+    await conn.execute(f"ANALYZE {table_name}")
+    print(
+        f"Loaded {num_vectors} vectors of {dim} dimensions in "
+        f"{time.perf_counter() - start_time:.1f}s"
+    )
+
+
+async def build_index(
+    conn: asyncpg.Connection,
+    table_name: str,
+    index_type: str,
+    hnsw_m: int,
+    hnsw_ef_construction: int,
+    ivfflat_lists: int,
+    maintenance_work_mem: str,
+) -> None:
+    index_name = f"{table_name}_embedding_idx"
+    if index_type == "ivfflat":
+        index_params = f"lists = {ivfflat_lists}"
+    else:
+        index_params = f"m = {hnsw_m}, ef_construction = {hnsw_ef_construction}"
+    await conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+    await conn.execute(f"SET maintenance_work_mem = '{maintenance_work_mem}'")
+    start_time = time.perf_counter()
+    await conn.execute(
+        f"CREATE INDEX {index_name} ON {table_name} "
+        f"USING {index_type} (embedding vector_cosine_ops) WITH ({index_params})"
+    )
+    index_size = await conn.fetchval(
+        "SELECT pg_size_pretty(pg_relation_size($1::regclass))", index_name
+    )
+    print(
+        f"Built {index_type} index ({index_params}) in "
+        f"{time.perf_counter() - start_time:.1f}s, size {index_size}"
+    )
+
+
+async def search(
+    conn: asyncpg.Connection,
+    table_name: str,
+    query: np.ndarray,
+    top_k: int,
+    parameter: Optional[Tuple[str, int]],
+) -> Tuple[List[int], float]:
+    """
+    Run a similarity search, returning the IDs found & the latency. Without a
+    search parameter the search is exact.
+    """
+    async with conn.transaction():
+        if parameter is None:
+            await conn.execute("SET LOCAL enable_indexscan = off")
+        else:
+            await conn.execute(f"SET LOCAL {parameter[0]} = {parameter[1]}")
+        start_time = time.perf_counter()
+        rows = await conn.fetch(
+            f"SELECT id FROM {table_name} ORDER BY embedding <=> $1 LIMIT $2",
+            query,
+            top_k,
+        )
+        latency = time.perf_counter() - start_time
+    return [row["id"] for row in rows], latency
+
+
+def percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(values, q))
+
+
+async def async_benchmark_vector_index(
+    index_type: str,
+    num_vectors: int,
+    dim: int,
+    num_clusters: int,
+    noise: float,
+    num_queries: int,
+    top_k: int,
+    search_values: Optional[List[int]],
+    hnsw_m: int,
+    hnsw_ef_construction: int,
+    ivfflat_lists: int,
+    maintenance_work_mem: str,
+    table_name: str,
+    seed: int,
+):
+    rng = np.random.default_rng(seed)
+    centers = normalize(rng.normal(size=(num_clusters, dim)))
+    conn = await asyncpg.connect(get_asyncpg_dsn())
+    try:
+        await conn.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        await register_vector(conn)
+        await load_corpus(conn, table_name, centers, num_vectors, noise, rng)
+        queries = make_clustered_vectors(rng, centers, num_queries, noise)
+
+        print(f"Computing exact top {top_k} neighbours of {num_queries} queries")
+        exact_results = []
+        exact_latencies = []
+        for query in queries:
+            ids, latency = await search(conn, table_name, query, top_k, None)
+            exact_results.append(set(ids))
+            exact_latencies.append(latency)
+
+        await build_index(
+            conn,
+            table_name,
+            index_type,
+            hnsw_m,
+            hnsw_ef_construction,
+            ivfflat_lists,
+            maintenance_work_mem,
+        )
+        if index_type == "ivfflat":
+            parameter_name = "ivfflat.probes"
+            search_values = search_values or DEFAULT_PROBES_VALUES
+        else:
+            parameter_name = "hnsw.ef_search"
+            search_values = search_values or DEFAULT_EF_SEARCH_VALUES
+
+        print(f"Search over {num_vectors} vectors, {num_queries} queries, k={top_k}:")
+        print(
+            f"\t- exact: recall@{top_k}=1.000 "
+            f"p50={percentile(exact_latencies, 50) * 1000:.1f}ms "
+            f"p99={percentile(exact_latencies, 99) * 1000:.1f}ms"
+        )
+        for value in search_values:
+            recalls = []
+            latencies = []
+            for query, exact_ids in zip(queries, exact_results):
+                ids, latency = await search(
+                    conn, table_name, query, top_k, (parameter_name, value)
+                )
+                recalls.append(len(exact_ids.intersection(ids)) / top_k)
+                latencies.append(latency)
+            print(
+                f"\t- {parameter_name}={value}: "
+                f"recall@{top_k}={statistics.mean(recalls):.3f} "
+                f"p50={percentile(latencies, 50) * 1000:.1f}ms "
+                f"p99={percentile(latencies, 99) * 1000:.1f}ms"
+            )
+    finally:
+        await conn.close()
+
+
+def benchmark_vector_index(
+    index_type: str = settings.VECTOR_INDEX_TYPE,
+    num_vectors: int = 1_000_000,
+    dim: int = 1536,
+    num_clusters: int = 1000,
+    noise: float = 0.05,
+    num_queries: int = 200,
+    top_k: int = 3,
+    search_values: Optional[List[int]] = None,
+    hnsw_m: int = settings.VECTOR_INDEX_HNSW_M,
+    hnsw_ef_construction: int = settings.VECTOR_INDEX_HNSW_EF_CONSTRUCTION,
+    ivfflat_lists: int = settings.VECTOR_INDEX_IVFFLAT_LISTS,
+    maintenance_work_mem: str = "2GB",
+    table_name: str = DEFAULT_TABLE_NAME,
+    seed: int = 0,
+):
+    """
+    Measure the recall@k and latency of an ANN index against exact search, on a
+    synthetic corpus in its own table of the DATABASE_URL database.
+
+    The corpus is kept between runs with the same number of vectors, so
+    comparing index types & parameters only rebuilds the index. Use the
+    results to pick the VECTOR_INDEX_* and VECTOR_QUERY_* settings.
+
+    :param index_type: "hnsw" or "ivfflat".
+    :param num_vectors: Size of the synthetic corpus.
+    :param dim: Dimensions of each vector. 1536 matches the OpenAI embeddings.
+    :param num_clusters: Number of clusters the vectors are scattered around.
+    :param noise: Standard deviation of each vector's distance to its cluster center.
+    :param num_queries: Number of queries timed per search parameter value.
+    :param top_k: Number of neighbours each query retrieves.
+    :param search_values: Values of hnsw.ef_search or ivfflat.probes to sweep.
+    :param hnsw_m: The HNSW index's m.
+    :param hnsw_ef_construction: The HNSW index's ef_construction.
+    :param ivfflat_lists: The IVFFlat index's number of lists.
+    :param maintenance_work_mem: Memory for building the index. The build is much
+        slower when the index doesn't fit.
+    :param table_name: Table to hold the synthetic corpus.
+    :param seed: Random seed of the corpus & queries.
+    """
+    asyncio.run(
+        async_benchmark_vector_index(
+            index_type,
+            num_vectors,
+            dim,
+            num_clusters,
+            noise,
+            num_queries,
+            top_k,
+            search_values,
+            hnsw_m,
+            hnsw_ef_construction,
+            ivfflat_lists,
+            maintenance_work_mem,
+            table_name,
+            seed,
+        )
+    )
+
+
+if __name__ == "__main__":
+    Fire(benchmark_vector_index)
@@ -0,0 +1,122 @@
+from typing import List, Optional
+import asyncio
+import statistics
+import time
+from fire import Fire
+from llama_index.core import Settings
+from llama_index.core.vector_stores.types import (
+    ExactMatchFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.api import crud
+from app.chat.constants import DB_DOC_ID_KEY
+from app.chat.pg_vector import get_vector_store_singleton
+from app.chat.retrieval import VectorStoreQueryBatcher
+from app.llama_index_settings import _setup_llama_index_settings
+
+DEFAULT_QUESTIONS = [
+    "What are the main risk factors?",
+    "How did revenue change compared to the prior year?",
+    "What does management say about liquidity?",
+]
+
+
+def result_key(result: VectorStoreQueryResult) -> list:
+    return list(zip(result.ids or [], result.similarities or []))
+
+
+async def async_benchmark_vector_retrieval(
+    document_ids: Optional[List[str]] = None,
+    num_docs: int = 5,
+    questions: Optional[List[str]] = None,
+    iterations: int = 10,
+    top_k: int = 3,
+):
+    _setup_llama_index_settings()
+    async with SessionLocal() as db:
+        if document_ids:
+            docs = await crud.fetch_documents(db, ids=document_ids)
+        else:
+            docs = await crud.fetch_documents(db, limit=num_docs)
+    vector_store = await get_vector_store_singleton()
+
+    questions = questions or DEFAULT_QUESTIONS
+    embeddings = await Settings.embed_model.aget_text_embedding_batch(questions)
+    # a sub-question per (question, document), as the SubQuestionQueryEngine issues them
+    queries = [
+        VectorStoreQuery(
+            query_embedding=embedding,
+            similarity_top_k=top_k,
+            filters=MetadataFilters(
+                filters=[ExactMatchFilter(key=DB_DOC_ID_KEY, value=str(doc.id))]
+            ),
+        )
+        for embedding in embeddings
+        for doc in docs
+    ]
+
+    async def run_per_document() -> List[VectorStoreQueryResult]:
+        return await asyncio.gather(*(vector_store.aquery(query) for query in queries))
+
+    batcher = VectorStoreQueryBatcher(
+        vector_store,
+        window_seconds=settings.VECTOR_QUERY_BATCH_WINDOW_MS / 1000,
+        max_batch_size=settings.VECTOR_QUERY_MAX_BATCH_SIZE,
+    )
+
+    async def run_batched() -> List[VectorStoreQueryResult]:
+        return await asyncio.gather(*(batcher.aquery(query) for query in queries))
+
+    expected = [result_key(result) for result in await run_per_document()]
+    actual = [result_key(result) for result in await run_batched()]
+    if actual != expected:
+        raise AssertionError("Batched retrieval returned different results")
+
+    print(f"{len(queries)} concurrent queries over {len(docs)} documents:")
+    for label, run in (("per-document", run_per_document), ("batched", run_batched)):
+        batcher.num_round_trips = 0
+        timings = []
+        for _ in range(iterations):
+            start_time = time.perf_counter()
+            await run()
+            timings.append(time.perf_counter() - start_time)
+        round_trips = (
+            batcher.num_round_trips / iterations if label == "batched" else len(queries)
+        )
+        print(
+            f"\t- {label}: median={statistics.median(timings) * 1000:.1f}ms "
+            f"max={max(timings) * 1000:.1f}ms round trips={round_trips:g}"
+        )
+
+
+def benchmark_vector_retrieval(
+    document_ids: Optional[List[str]] = None,
+    num_docs: int = 5,
+    questions: Optional[List[str]] = None,
+    iterations: int = 10,
+    top_k: int = 3,
+):
+    """
+    Compare running each document's similarity search separately against
+    batching them into a single round trip, and check both give the same results.
+
+    :param document_ids: IDs of the documents to query. Defaults to the first
+        num_docs documents.
+    :param num_docs: Number of documents to use when document_ids isn't given.
+    :param questions: Questions to ask of every document.
+    :param iterations: Number of timed runs per mode.
+    :param top_k: Number of chunks retrieved per document.
+    """
+    asyncio.run(
+        async_benchmark_vector_retrieval(
+            document_ids, num_docs, questions, iterations, top_k
+        )
+    )
+
+
+if __name__ == "__main__":
+    Fire(benchmark_vector_retrieval)
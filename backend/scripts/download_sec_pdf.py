@@ -1,6 +1,7 @@
 from pathlib import Path
-from typing import List, Optional
+from typing import Collection, List, Optional
 
+import httpx
 import pdfkit
 from file_utils import filing_exists
 from fire import Fire
@@ -45,6 +46,7 @@ DEFAULT_FILING_TYPES = [
     "10-K",
     "10-Q",
 ]
+SEC_SUBMISSIONS_URL = "https://data.sec.gov/submissions/CIK{cik}.json"
 
 
 def _download_filing(
@@ -54,6 +56,49 @@ def _download_filing(
     dl.get(filing_type, cik, limit=limit, before=before, after=after, download_details=True)
 
 
+def get_latest_accession_numbers(
+    cik: str, filing_type: str, limit: int
+) -> Optional[List[str]]:
+    """
+    The accession numbers of the latest filings that _download_filing would
+    download without a date range, or None if they can't be listed.
+    """
+    try:
+        response = httpx.get(
+            SEC_SUBMISSIONS_URL.format(cik=cik.zfill(10)),
+            headers={
+                "User-Agent": (
+                    f"{settings.SEC_EDGAR_COMPANY_NAME} {settings.SEC_EDGAR_EMAIL}"
+                )
+            },
+            timeout=settings.DOCUMENT_DOWNLOAD_TIMEOUT_SECONDS,
+        )
+        response.raise_for_status()
+        submissions = response.json()["filings"]
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        print(f"Error listing filings for cik={cik}: {e}")
+        return None
+    recent = submissions["recent"]
+    accession_numbers = [
+        accession_number
+        for accession_number, form in zip(recent["accessionNumber"], recent["form"])
+        if form == filing_type
+    ][:limit]
+    if len(accession_numbers) < limit and submissions["files"]:
+        # the rest are on pages of older filings
+        return None
+    return accession_numbers
+
+
+def _are_latest_filings_in(
+    cik: str, filing_type: str, limit: int, accession_numbers: Collection[str]
+) -> bool:
+    latest_accession_numbers = get_latest_accession_numbers(cik, filing_type, limit)
+    return latest_accession_numbers is not None and set(
+        latest_accession_numbers
+    ).issubset(accession_numbers)
+
+
 def _convert_to_pdf(output_dir: str):
     """Converts all html files in a directory to pdf files."""
 
@@ -67,6 +112,9 @@ def _convert_to_pdf(output_dir: str):
     # │   │   │   │   ├── primary-document.pdf   <-- this is what we want
 
     data_dir = Path(output_dir) / "sec-edgar-filings"
+    if not data_dir.exists():
+        # nothing was downloaded
+        return
 
     for cik_dir in data_dir.iterdir():
         for filing_type_dir in cik_dir.iterdir():
@@ -94,7 +142,13 @@ def main(
     after: Optional[str] = None,
     limit: Optional[int] = 3,
     convert_to_pdf: bool = True,
+    skip_accession_numbers: Collection[str] = (),
 ):
+    """
+    :param skip_accession_numbers: Filings that were already ingested. A company's
+        filings of a type aren't downloaded if all of its latest ones are among
+        them, since EDGAR filings don't change once filed.
+    """
     print('Downloading filings to "{}"'.format(Path(output_dir).absolute()))
     print("File Types: {}".format(file_types))
     if convert_to_pdf:
@@ -108,6 +162,15 @@ def main(
         try:
             if filing_exists(symbol, file_type, output_dir):
                 print(f"- Filing for {symbol} {file_type} already exists, skipping")
+            elif (
+                skip_accession_numbers
+                and limit
+                and not (before or after)
+                and _are_latest_filings_in(
+                    symbol, file_type, limit, skip_accession_numbers
+                )
+            ):
+                print(f"- Filings for {symbol} {file_type} already ingested, skipping")
             else:
                 print(f"- Downloading filing for {symbol} {file_type}")
                 _download_filing(symbol, file_type, output_dir, limit, before, after)
@@ -117,6 +117,8 @@ def parse_ticker_symbol_from_full_submission_txt(
 def get_available_filings(output_dir: str) -> List[Filing]:
     data_dir = Path(output_dir) / "sec-edgar-filings"
     filings = []
+    if not data_dir.exists():
+        return filings
     for cik_dir in data_dir.iterdir():
         for filing_type_dir in cik_dir.iterdir():
             for filing_dir in filing_type_dir.iterdir():
@@ -0,0 +1,217 @@
+from typing import List, Optional, Union
+import asyncio
+import multiprocessing
+import time
+from uuid import uuid4
+import anyio
+import httpx
+import uvicorn
+from fastapi import FastAPI
+from fire import Fire
+from sse_starlette.sse import EventSourceResponse
+from app import schema
+from app.core.config import settings
+from app.chat.messaging import (
+    StreamedMessage,
+    StreamedMessageBuilder,
+    StreamedMessageSubProcess,
+    astream_message_events,
+    get_message_stream_encoder,
+    get_message_stream_stats,
+    reset_message_stream_stats,
+)
+from app.models.db import Message, MessageRoleEnum, MessageStatusEnum
+from benchmark_message_stream import make_streamed_answer
+
+HOST = "127.0.0.1"
+
+
+def make_stream_app(
+    streamed_answer: List[Union[StreamedMessage, StreamedMessageSubProcess]],
+    token_interval_ms: float,
+) -> FastAPI:
+    """
+    Make an app that streams a synthetic answer like the /message endpoint does,
+    with its tokens generated at the given pace, and that reports its CPU time.
+    """
+    app = FastAPI()
+
+    @app.get("/message")
+    async def message(
+        protocol: schema.MessageStreamProtocolEnum,
+        flush_interval_ms: float,
+        flush_max_bytes: int,
+    ) -> EventSourceResponse:
+        send_chan, recv_chan = anyio.create_memory_object_stream(100)
+
+        async def generate_answer():
+            async with send_chan:
+                for message_obj in streamed_answer:
+                    await send_chan.send(message_obj)
+                    if isinstance(message_obj, StreamedMessage):
+                        await asyncio.sleep(token_interval_ms / 1000)
+
+        async def event_publisher():
+            task = asyncio.create_task(generate_answer())
+            message = Message(
+                id=str(uuid4()),
+                conversation_id=str(uuid4()),
+                content="",
+                role=MessageRoleEnum.assistant,
+                status=MessageStatusEnum.PENDING,
+                sub_processes=[],
+            )
+            async for event in astream_message_events(
+                recv_chan,
+                StreamedMessageBuilder(message),
+                get_message_stream_encoder(protocol),
+                flush_interval_ms=flush_interval_ms,
+                flush_max_bytes=flush_max_bytes,
+            ):
+                yield event
+            await task
+
+        return EventSourceResponse(event_publisher())
+
+    @app.get("/stats")
+    async def stats() -> dict:
+        message_stream_stats = get_message_stream_stats()
+        reset_message_stream_stats()
+        return {
+            "cpu_time": time.process_time(),
+            "events_per_message": message_stream_stats.events_per_message,
+        }
+
+    return app
+
+
+def serve_stream_app(
+    port: int,
+    streamed_answer: List[Union[StreamedMessage, StreamedMessageSubProcess]],
+    token_interval_ms: float,
+):
+    uvicorn.run(
+        make_stream_app(streamed_answer, token_interval_ms),
+        host=HOST,
+        port=port,
+        log_level="warning",
+    )
+
+
+async def aget_stats(client: httpx.AsyncClient) -> dict:
+    response = await client.get("/stats")
+    response.raise_for_status()
+    return response.json()
+
+
+async def astream_answer(client: httpx.AsyncClient, params: dict) -> int:
+    num_bytes = 0
+    async with client.stream("GET", "/message", params=params) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            num_bytes += len(chunk)
+    return num_bytes
+
+
+async def aloadtest_message_stream(
+    port: int,
+    num_streams: int,
+    protocols: List[str],
+    flush_intervals_ms: List[float],
+    flush_max_bytes: int,
+):
+    async with httpx.AsyncClient(
+        base_url=f"http://{HOST}:{port}",
+        limits=httpx.Limits(max_connections=num_streams),
+        timeout=None,
+    ) as client:
+        for _ in range(100):
+            try:
+                await aget_stats(client)
+                break
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+        for protocol in protocols:
+            for flush_interval_ms in flush_intervals_ms:
+                params = {
+                    "protocol": protocol,
+                    "flush_interval_ms": flush_interval_ms,
+                    "flush_max_bytes": flush_max_bytes,
+                }
+                start_stats = await aget_stats(client)
+                start_time = time.perf_counter()
+                stream_sizes = await asyncio.gather(
+                    *[astream_answer(client, params) for _ in range(num_streams)]
+                )
+                elapsed = time.perf_counter() - start_time
+                end_stats = await aget_stats(client)
+                cpu_time = end_stats["cpu_time"] - start_stats["cpu_time"]
+                print(
+                    f"\t- {protocol} protocol, flush every {flush_interval_ms:g}ms: "
+                    f"{end_stats['events_per_message']:.0f} events & "
+                    f"{sum(stream_sizes) / num_streams / 1024:.1f} KiB per answer, "
+                    f"server CPU of {cpu_time / num_streams * 1000:.1f}ms per "
+                    f"stream, {cpu_time / elapsed:.0%} of a core"
+                )
+
+
+def loadtest_message_stream(
+    num_streams: int = 100,
+    num_tokens: int = 500,
+    num_sub_questions: int = 4,
+    token_interval_ms: float = 10.0,
+    flush_intervals_ms: Optional[List[float]] = None,
+    flush_max_bytes: int = settings.MESSAGE_STREAM_FLUSH_MAX_BYTES,
+    protocols: Optional[List[str]] = None,
+    port: int = 8765,
+):
+    """
+    Stream synthetic answers from a uvicorn server to many concurrent clients,
+    and compare the server's CPU time per stream when it sends an SSE event per
+    streamed update with when it batches them (see the MESSAGE_STREAM_FLUSH_*
+    settings). Doesn't need the database or the OpenAI API.
+
+    :param num_streams: Number of answers streamed concurrently.
+    :param num_tokens: Number of streamed tokens of each answer.
+    :param num_sub_questions: Number of sub-questions of each answer.
+    :param token_interval_ms: Time between the tokens of an answer, like an LLM
+        streams them.
+    :param flush_intervals_ms: Flush intervals to compare. 0 sends an event per
+        update. Defaults to 0 & MESSAGE_STREAM_FLUSH_INTERVAL_MS.
+    :param flush_max_bytes: Pending content that an event is sent at before the
+        flush interval.
+    :param protocols: Protocols to compare, of "cumulative" & "delta". Defaults to
+        "delta".
+    :param port: Local port to run the server on.
+    """
+    streamed_answer = make_streamed_answer(
+        num_tokens, num_sub_questions, num_citations=3, citation_length=2000
+    )
+    server = multiprocessing.Process(
+        target=serve_stream_app,
+        args=(port, streamed_answer, token_interval_ms),
+        daemon=True,
+    )
+    server.start()
+    print(
+        f"Streaming {num_streams} concurrent answers of {num_tokens} tokens, "
+        f"one per {token_interval_ms:g}ms:"
+    )
+    try:
+        asyncio.run(
+            aloadtest_message_stream(
+                port,
+                num_streams,
+                protocols or [schema.MessageStreamProtocolEnum.DELTA.value],
+                flush_intervals_ms
+                or [0, settings.MESSAGE_STREAM_FLUSH_INTERVAL_MS],
+                flush_max_bytes,
+            )
+        )
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == "__main__":
+    Fire(loadtest_message_stream)
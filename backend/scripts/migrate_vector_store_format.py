@@ -0,0 +1,153 @@
+from typing import List, Optional, Tuple
+import asyncio
+from fire import Fire
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.schema import CreateIndex
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.chat.constants import EMBEDDING_NATIVE_DIMENSIONS
+from app.chat.pg_vector import get_embedding_index_name, get_vector_store_singleton
+
+# first pgvector version with halfvec, binary_quantize, subvector & l2_normalize
+MIN_PGVECTOR_VERSION = (0, 7, 0)
+
+
+async def get_pgvector_version(db: AsyncSession) -> Tuple[int, ...]:
+    version = (
+        await db.execute(
+            text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        )
+    ).scalar()
+    return tuple(int(part) for part in version.split("."))
+
+
+async def get_embedding_dimensions(db: AsyncSession, table_name: str) -> Optional[int]:
+    # the type modifier of a vector column is its number of dimensions
+    return (
+        await db.execute(
+            text(
+                "SELECT atttypmod FROM pg_attribute "
+                "WHERE attrelid = to_regclass(:table_name) AND attname = 'embedding'"
+            ),
+            {"table_name": table_name},
+        )
+    ).scalar()
+
+
+def get_shortened_embedding_sql(column: str, dimensions: int) -> str:
+    # text-embedding-3 embeddings keep their meaning when truncated & renormalized,
+    # which is what the API does for a smaller number of dimensions
+    return f"l2_normalize(subvector({column}, 1, {dimensions}))::vector({dimensions})"
+
+
+async def _async_migrate_vector_store_format(
+    dry_run: bool, maintenance_work_mem: str
+):
+    vector_store = await get_vector_store_singleton()
+    table = vector_store._table_class.__table__
+    table_name = f"{vector_store.schema_name}.{table.name}"
+    dimensions = settings.EMBEDDING_DIMENSIONS or EMBEDDING_NATIVE_DIMENSIONS
+    (embedding_index,) = [
+        index
+        for index in table.indexes
+        if index.name == get_embedding_index_name(table.name)
+    ]
+
+    async with SessionLocal() as db:
+        current_dimensions = await get_embedding_dimensions(db, table_name)
+        if current_dimensions is None:
+            print(f"{table_name} doesn't exist yet, and will be created as configured.")
+            return
+        if dimensions > current_dimensions:
+            print(
+                f"The embeddings have {current_dimensions} dimensions, so can't be "
+                f"lengthened to {dimensions}. Re-ingest the documents instead."
+            )
+            return
+        pgvector_version = await get_pgvector_version(db)
+        needs_new_pgvector = (
+            dimensions < current_dimensions
+            or settings.VECTOR_INDEX_QUANTIZATION != "none"
+        )
+        if needs_new_pgvector and pgvector_version < MIN_PGVECTOR_VERSION:
+            print(
+                f"pgvector {'.'.join(map(str, pgvector_version))} is installed, but "
+                f"{'.'.join(map(str, MIN_PGVECTOR_VERSION))}+ is needed. Upgrade the "
+                "server's pgvector and run ALTER EXTENSION vector UPDATE first."
+            )
+            return
+
+        statements: List[str] = [
+            f"DROP INDEX IF EXISTS {vector_store.schema_name}.{embedding_index.name}"
+        ]
+        if dimensions < current_dimensions:
+            statements.append(
+                f"ALTER TABLE {table_name} ALTER COLUMN embedding "
+                f"TYPE vector({dimensions}) "
+                f"USING {get_shortened_embedding_sql('embedding', dimensions)}"
+            )
+            # so that no chunk or question is sent to the embedding API again
+            statements.append(
+                "INSERT INTO embeddingcacheentry "
+                "(id, model, dimensions, text_hash, embedding) "
+                f"SELECT uuid_generate_v4(), model, {dimensions}, text_hash, "
+                f"{get_shortened_embedding_sql('embedding', dimensions)} "
+                "FROM embeddingcacheentry WHERE dimensions = 0 "
+                "ON CONFLICT (model, dimensions, text_hash) DO NOTHING"
+            )
+        statements.append(
+            str(CreateIndex(embedding_index).compile(dialect=postgresql.dialect()))
+        )
+
+        print(
+            f"Migrating {table_name} from {current_dimensions} to {dimensions} "
+            f"dimensions, with a {settings.VECTOR_INDEX_QUANTIZATION} "
+            f"{settings.VECTOR_INDEX_TYPE} index:"
+        )
+        for statement in statements:
+            print(f"\t{statement};")
+        if dry_run:
+            return
+
+        # Ask for confirmation before rewriting the table
+        confirmation = input(
+            "The table is locked until the migration finishes. Continue? (y/n) "
+        )
+        if confirmation.lower() != "y":
+            print("Aborted.")
+            return
+
+        await db.execute(
+            text("SELECT set_config('maintenance_work_mem', :value, true)"),
+            {"value": maintenance_work_mem},
+        )
+        for statement in statements:
+            await db.execute(text(statement))
+        await db.commit()
+        print("Migrated.")
+
+
+def migrate_vector_store_format(
+    dry_run: bool = False, maintenance_work_mem: str = "1GB"
+):
+    """
+    Migrate the vector store table to the EMBEDDING_DIMENSIONS &
+    VECTOR_INDEX_* settings, in a single transaction.
+
+    Shortening the embeddings rewrites them in place, as well as adding the
+    shortened embeddings of the embedding cache, so nothing is embedded again.
+    The ANN index is rebuilt on the VECTOR_INDEX_QUANTIZATION representation.
+    Run it with the new settings, before deploying them to the app. Flat vector
+    files of the old size are rebuilt on their next search.
+
+    :param dry_run: Only print the statements the migration would run.
+    :param maintenance_work_mem: Memory for building the index. The build is much
+        slower when the index doesn't fit.
+    """
+    asyncio.run(_async_migrate_vector_store_format(dry_run, maintenance_work_mem))
+
+
+if __name__ == "__main__":
+    Fire(migrate_vector_store_format)
@@ -1,20 +1,21 @@
-from typing import List
+from typing import Dict, List, Optional, Set
 import asyncio
 from tempfile import TemporaryDirectory
-from pathlib import Path
+from pathlib import Path, PurePosixPath
+from urllib.parse import urlparse
 from fire import Fire
 import s3fs
 from app.core.config import settings
+from app.chat.manifest import IngestionManifest, is_stage_done
+from app.models.db import IngestionStageEnum
+from file_utils import get_available_filings, Filing
 import upsert_db_sec_documents
 import download_sec_pdf
 from download_sec_pdf import DEFAULT_CIKS, DEFAULT_FILING_TYPES
 import seed_storage_context
 
 
-def copy_to_s3(dir_path: str, s3_bucket: str = settings.S3_ASSET_BUCKET_NAME):
-    """
-    Copy all files in dir_path to S3.
-    """
+def get_s3_fs(s3_bucket: str) -> s3fs.S3FileSystem:
     s3 = s3fs.S3FileSystem(
         key=settings.AWS_KEY,
         secret=settings.AWS_SECRET,
@@ -23,28 +24,75 @@ def copy_to_s3(dir_path: str, s3_bucket: str = settings.S3_ASSET_BUCKET_NAME):
 
     if not (settings.RENDER or s3.exists(s3_bucket)):
         s3.mkdir(s3_bucket)
+    return s3
 
-    s3.put(dir_path, s3_bucket, recursive=True)
+
+async def copy_filings_to_s3(
+    filings_by_url: Dict[str, Filing],
+    doc_dir: str,
+    manifest: IngestionManifest,
+    s3_bucket: str = settings.S3_ASSET_BUCKET_NAME,
+):
+    """
+    Copy the directories of the given filings to S3, recording each one in the
+    ingestion manifest once it's uploaded.
+    """
+    s3 = get_s3_fs(s3_bucket)
+    for url, filing in filings_by_url.items():
+        filing_dir = Path(filing.file_path).parent
+        s3_path = f"{s3_bucket}/{filing_dir.relative_to(Path(doc_dir).absolute())}"
+        # trailing slashes so a re-upload overwrites the files instead of nesting them
+        s3.put(f"{filing_dir}/", f"{s3_path}/", recursive=True)
+        await manifest.arecord_stage(url, IngestionStageEnum.UPLOADED)
+
+
+async def aget_uploaded_accession_numbers(manifest: IngestionManifest) -> Set[str]:
+    """
+    The accession numbers of the filings that are past the download stage, which
+    don't need to be downloaded again.
+    """
+    entries = await manifest.aget_entries()
+    # e.g. ".../sec-edgar-filings/AAPL/10-K/0000320193-20-000096/primary-document.pdf"
+    return {
+        PurePosixPath(urlparse(url).path).parent.name
+        for url, entry in entries.items()
+        if is_stage_done(entry, IngestionStageEnum.UPLOADED)
+    }
 
 
 async def async_seed_db(
-    ciks: List[str] = DEFAULT_CIKS, filing_types: List[str] = DEFAULT_FILING_TYPES
+    ciks: List[str] = DEFAULT_CIKS,
+    filing_types: List[str] = DEFAULT_FILING_TYPES,
+    output_dir: Optional[str] = None,
 ):
+    manifest = IngestionManifest()
     with TemporaryDirectory() as temp_dir:
-        print("Downloading SEC filings")
+        # with a persistent output_dir, filings downloaded by a previous run are reused
+        doc_dir = output_dir or temp_dir
+        print("Downloading new SEC filings")
         download_sec_pdf.main(
-            output_dir=temp_dir,
+            output_dir=doc_dir,
             ciks=ciks,
             file_types=filing_types,
+            skip_accession_numbers=await aget_uploaded_accession_numbers(manifest),
+        )
+
+        print("Recording downloaded SEC filings in the ingestion manifest")
+        filings = get_available_filings(doc_dir)
+        filings_to_upload = await upsert_db_sec_documents.record_downloaded_filings(
+            manifest, filings, doc_dir, settings.CDN_BASE_URL
         )
 
-        print("Copying downloaded SEC filings to S3")
-        copy_to_s3(str(Path(temp_dir) / "sec-edgar-filings"))
+        print(
+            f"Copying {len(filings_to_upload)} new or changed SEC filings "
+            f"of {len(filings)} to S3"
+        )
+        await copy_filings_to_s3(filings_to_upload, doc_dir, manifest)
 
         print("Upserting records of downloaded SEC filings into database")
         await upsert_db_sec_documents.async_upsert_documents_from_filings(
             url_base=settings.CDN_BASE_URL,
-            doc_dir=temp_dir,
+            doc_dir=doc_dir,
         )
 
         print("Seeding storage context")
@@ -60,9 +108,20 @@ Done! 🏁
 
 
 def seed_db(
-    ciks: List[str] = DEFAULT_CIKS, filing_types: List[str] = DEFAULT_FILING_TYPES
+    ciks: List[str] = DEFAULT_CIKS,
+    filing_types: List[str] = DEFAULT_FILING_TYPES,
+    output_dir: Optional[str] = None,
 ):
-    asyncio.run(async_seed_db(ciks, filing_types))
+    """
+    Download, upload, upsert & index SEC filings. Only new or changed filings
+    are processed, and filings that failed part way resume at the failed stage.
+    Companies whose latest filings were all uploaded before aren't downloaded
+    from EDGAR again.
+
+    :param output_dir: Directory to keep downloaded filings in between runs.
+        Defaults to a temporary directory.
+    """
+    asyncio.run(async_seed_db(ciks, filing_types, output_dir))
 
 
 if __name__ == "__main__":
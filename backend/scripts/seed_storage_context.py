@@ -1,26 +1,93 @@
-from tqdm import tqdm
+from typing import cast
+import time
 from fire import Fire
 import asyncio
+from app.core.config import settings
 from app.db.session import SessionLocal
 from app.api import crud
+from llama_index.core import Settings
 from llama_index.core.callbacks import CallbackManager
+from app.llama_index_settings import _setup_llama_index_settings
+from app.chat.embedding_cache import CachedEmbedding
 from app.chat.engine import (
-    build_doc_id_to_index_map,
     get_s3_fs,
+    get_storage_context,
 )
+from app.chat.ingestion import IngestionPipeline
+from app.chat.manifest import IngestionManifest
+from app.models.db import IngestionStageEnum
+from app.chat.pg_vector import get_vector_store_singleton
+from app.chat.storage import (
+    CachedIndexStore,
+    PostgresKVStore,
+    migrate_legacy_persist_dir,
+)
+
+
+async def migrate_storage_context_from_s3() -> None:
+    """
+    Copy the docstore.json & index_store.json that used to live in the
+    S3_BUCKET_NAME bucket into Postgres.
+    """
+    num_entries = await migrate_legacy_persist_dir(
+        get_s3_fs(), settings.S3_BUCKET_NAME, PostgresKVStore()
+    )
+    print(f"Migrated {num_entries} entries from the S3 storage context")
 
 
-async def async_main_seed_storage_context():
-    fs = get_s3_fs()
+async def async_main_seed_storage_context(migrate_from_s3: bool = False):
+    # embed with the same (cached) model that the app queries with
+    _setup_llama_index_settings()
+    if migrate_from_s3:
+        await migrate_storage_context_from_s3()
     async with SessionLocal() as db:
         docs = await crud.fetch_documents(db)
-    callback_manager = CallbackManager([])
-    for doc in tqdm(docs, desc="Seeding storage with DB documents"):
-        await build_doc_id_to_index_map(callback_manager, [doc], fs=fs)
+    vector_store = await get_vector_store_singleton()
+    storage_context = get_storage_context(vector_store)
+    index_store = cast(CachedIndexStore, storage_context.index_store)
+    index_structs = await index_store.aget_index_structs([str(doc.id) for doc in docs])
+    manifest = IngestionManifest()
+    entries = await manifest.aget_entries()
+    # documents tracked by the manifest are ingested until they're indexed,
+    # which also covers documents whose content changed since their last ingestion
+    missing_docs = [
+        doc
+        for doc in docs
+        if (
+            entries[doc.url].stage != IngestionStageEnum.INDEXED
+            if doc.url in entries
+            else str(doc.id) not in index_structs
+        )
+    ]
+    num_resumed = sum(
+        1 for doc in missing_docs if doc.url in entries and entries[doc.url].error
+    )
+    print(
+        f"Seeding storage with {len(missing_docs)} of {len(docs)} DB documents "
+        f"that aren't indexed yet, resuming {num_resumed} that failed before"
+    )
+
+    start_time = time.perf_counter()
+    pipeline = IngestionPipeline(
+        storage_context, CallbackManager([]), manifest=manifest
+    )
+    indices = await pipeline.run(missing_docs)
+    print(
+        f"Built {len(indices)} indices in {time.perf_counter() - start_time:.1f}s\n"
+        + pipeline.format_stats()
+    )
+    if isinstance(Settings.embed_model, CachedEmbedding):
+        print(Settings.embed_model.get_stats())
+
 
+def main_seed_storage_context(migrate_from_s3: bool = False):
+    """
+    Build indices for any documents that don't have one yet.
 
-def main_seed_storage_context():
-    asyncio.run(async_main_seed_storage_context())
+    :param migrate_from_s3: First do a one-shot copy of the storage context that
+        was previously persisted to S3 into Postgres.
+    """
+    asyncio.run(async_main_seed_storage_context(migrate_from_s3))
 
 
 if __name__ == "__main__":
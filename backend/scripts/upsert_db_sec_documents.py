@@ -1,4 +1,6 @@
+from typing import Dict, List
 from pathlib import Path
+from uuid import UUID
 from fire import Fire
 from tqdm import tqdm
 import asyncio
@@ -16,16 +18,89 @@ from app.schema import (
 )
 from app.db.session import SessionLocal
 from app.api import crud
+from app.chat.page_cache import sha256_file
+from app.chat.manifest import IngestionManifest, is_stage_done
+from app.chat.financials import (
+    aget_document_ids_with_financials,
+    areplace_document_financials,
+    extract_financials,
+)
+from app.models.db import IngestionStageEnum
 
 DEFAULT_URL_BASE = "https://dl94gqvzlh4k8.cloudfront.net"
 DEFAULT_DOC_DIR = "data/"
 
 
-async def upsert_document(doc_dir: str, stock: Stock, filing: Filing, url_base: str):
+def get_filing_url(doc_dir: str, filing: Filing, url_base: str) -> str:
     # construct a string for just the document's sub-path after the doc_dir
     # e.g. "sec-edgar-filings/AAPL/10-K/0000320193-20-000096/primary-document.pdf"
-    doc_path = Path(filing.file_path).relative_to(doc_dir)
-    url_path = url_base.rstrip("/") + "/" + str(doc_path).lstrip("/")
+    doc_path = Path(filing.file_path).relative_to(Path(doc_dir).absolute())
+    return url_base.rstrip("/") + "/" + str(doc_path).lstrip("/")
+
+
+def get_filing_source_sha256(filing: Filing) -> str:
+    """
+    Hash of the filing as downloaded from EDGAR. The PDF converted from it isn't
+    byte-for-byte reproducible, so it can't be used to tell if a filing changed.
+    """
+    return sha256_file(Path(filing.file_path).parent / "full-submission.txt")
+
+
+async def record_downloaded_filings(
+    manifest: IngestionManifest, filings: List[Filing], doc_dir: str, url_base: str
+) -> Dict[str, Filing]:
+    """
+    Add new filings to the ingestion manifest and start changed ones over.
+
+    Returns the filings that haven't been uploaded yet, by URL.
+    """
+    filings_by_url = {
+        get_filing_url(doc_dir, filing, url_base): filing for filing in filings
+    }
+    entries = await manifest.aget_entries(list(filings_by_url.keys()))
+    filings_to_upload = {}
+    for url, filing in filings_by_url.items():
+        entry = entries.get(url)
+        source_sha256 = get_filing_source_sha256(filing)
+        if entry is None or entry.source_sha256 != source_sha256:
+            await manifest.arecord_downloaded(
+                url, source_sha256, sha256_file(Path(filing.file_path))
+            )
+            filings_to_upload[url] = filing
+        elif not is_stage_done(entry, IngestionStageEnum.UPLOADED):
+            filings_to_upload[url] = filing
+    return filings_to_upload
+
+
+async def upsert_document_financials(filing: Filing, document_id: UUID) -> None:
+    """
+    Extract the financials of a filing from the XBRL data of its
+    full-submission.txt, for the quantitative tool to read instead of polygon.io
+    """
+    full_submission_path = Path(filing.file_path).parent / "full-submission.txt"
+    try:
+        financials = extract_financials(
+            full_submission_path.read_text(errors="replace"),
+            filing.period_of_report_date.date(),
+            is_annual=filing.filing_type == "10-K",
+        )
+        await areplace_document_financials(document_id, financials)
+    except Exception as e:
+        print(f"Error extracting financials from {full_submission_path}: {e}")
+        return
+    if not financials:
+        print(f"No XBRL financials found in {full_submission_path}")
+
+
+async def upsert_document(
+    doc_dir: str,
+    stock: Stock,
+    filing: Filing,
+    url_base: str,
+    manifest: IngestionManifest,
+):
+    url_path = get_filing_url(doc_dir, filing, url_base)
+    content_sha256 = sha256_file(Path(filing.file_path))
     doc_type = (
         SecDocumentTypeEnum.TEN_K
         if filing.filing_type == "10-K"
@@ -46,26 +121,58 @@ async def upsert_document(doc_dir: str, stock: Stock, filing: Filing, url_base:
     metadata_map: DocumentMetadataMap = {
         DocumentMetadataKeysEnum.SEC_DOCUMENT: jsonable_encoder(
             sec_doc_metadata.dict(exclude_none=True)
-        )
+        ),
+        DocumentMetadataKeysEnum.CONTENT_SHA256: content_sha256,
     }
     doc = Document(url=str(url_path), metadata_map=metadata_map)
     async with SessionLocal() as db:
-        await crud.upsert_document_by_url(db, doc)
+        upserted_doc = await crud.upsert_document_by_url(db, doc)
+    await manifest.arecord_stage(
+        url_path,
+        IngestionStageEnum.UPLOADED,
+        document_id=upserted_doc.id,
+        source_sha256=get_filing_source_sha256(filing),
+        content_sha256=content_sha256,
+    )
+    await upsert_document_financials(filing, upserted_doc.id)
 
 
 async def async_upsert_documents_from_filings(url_base: str, doc_dir: str):
     """
-    Upserts SEC documents into the database based on what has been downloaded to the filesystem.
+    Upserts SEC documents into the database based on what has been downloaded to the
+    filesystem, along with the financials extracted from their XBRL data.
+
+    Filings that were already upserted & haven't changed since are skipped.
     """
     filings = get_available_filings(doc_dir)
+    manifest = IngestionManifest()
+    entries = await manifest.aget_entries(
+        [get_filing_url(doc_dir, filing, url_base) for filing in filings]
+    )
+    document_ids_with_financials = await aget_document_ids_with_financials(
+        [entry.document_id for entry in entries.values() if entry.document_id]
+    )
     stocks_data = PyTickerSymbols()
     stocks_dict = get_stocks_by_symbol(stocks_data.get_all_indices())
+    num_skipped = 0
     for filing in tqdm(filings, desc="Upserting docs from filings"):
+        entry = entries.get(get_filing_url(doc_dir, filing, url_base))
+        if (
+            entry is not None
+            and entry.document_id is not None
+            and entry.source_sha256 == get_filing_source_sha256(filing)
+        ):
+            # documents upserted before financials were extracted at ingestion
+            if entry.document_id not in document_ids_with_financials:
+                await upsert_document_financials(filing, entry.document_id)
+            num_skipped += 1
+            continue
         if filing.symbol not in stocks_dict:
             print(f"Symbol {filing.symbol} not found in stocks_dict. Skipping.")
             continue
         stock = stocks_dict[filing.symbol]
-        await upsert_document(doc_dir, stock, filing, url_base)
+        await upsert_document(doc_dir, stock, filing, url_base, manifest)
+    print(f"Skipped {num_skipped} unchanged docs that were already upserted")
 
 
 def main_upsert_documents_from_filings(
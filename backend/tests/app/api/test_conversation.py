@@ -0,0 +1,189 @@
+from typing import List
+import asyncio
+import json
+from uuid import uuid4
+import anyio
+import httpx
+import pytest
+from anyio.streams.memory import MemoryObjectSendStream
+from fastapi import FastAPI
+from app import schema
+from app.api import crud
+from app.api.api import api_router
+from app.api.deps import get_db, get_session_factory
+from app.api.endpoints import conversation as conversation_endpoints
+from app.chat.messaging import StreamedMessage
+from app.db.session import engine
+
+# pool_size + max_overflow of the app's engine
+NUM_CONNECTIONS = engine.pool.size() + engine.pool._max_overflow
+NUM_STREAMS = NUM_CONNECTIONS + 4
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class ConnectionPoolStandIn:
+    """
+    Stands in for the app's connection pool, with a session holding one of its
+    connections from when it's opened until it's closed.
+    """
+
+    def __init__(self, num_connections: int):
+        self._connections = asyncio.Semaphore(num_connections)
+        self.saved: List[object] = []
+
+    def __call__(self) -> "SessionStandIn":
+        return SessionStandIn(self)
+
+
+class SessionStandIn:
+    def __init__(self, pool: ConnectionPoolStandIn):
+        self._pool = pool
+        self._added: List[object] = []
+
+    async def __aenter__(self) -> "SessionStandIn":
+        await self._pool._connections.acquire()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        self._pool._connections.release()
+
+    def add(self, instance: object) -> None:
+        self._added.append(instance)
+
+    async def commit(self) -> None:
+        self._pool.saved += self._added
+        self._added = []
+
+
+class ChatStandIn:
+    """
+    Streams an answer once it's released, like an LLM that takes its time.
+    """
+
+    def __init__(self):
+        self.num_streaming = 0
+        self.released = asyncio.Event()
+
+    async def handle_chat_message(
+        self,
+        conversation: schema.Conversation,
+        user_message: schema.UserMessageCreate,
+        send_chan: MemoryObjectSendStream,
+    ) -> None:
+        async with send_chan:
+            self.num_streaming += 1
+            await self.released.wait()
+            await send_chan.send(StreamedMessage(delta="An answer"))
+
+
+@pytest.fixture
+def pool(monkeypatch) -> ConnectionPoolStandIn:
+    pool = ConnectionPoolStandIn(NUM_CONNECTIONS)
+
+    async def fetch_conversation_for_chat(db, conversation_id, max_messages):
+        return schema.Conversation(id=conversation_id, messages=[], documents=[])
+
+    async def fetch_message_with_sub_processes(db, message_id):
+        (message,) = [
+            instance
+            for instance in pool.saved
+            if getattr(instance, "id", None) == message_id
+        ]
+        return schema.Message.from_orm(message)
+
+    async def fetch_documents(db, **kwargs):
+        return [schema.Document(id=uuid4(), url="https://example.com/10-K.pdf")]
+
+    monkeypatch.setattr(
+        crud, "fetch_conversation_for_chat", fetch_conversation_for_chat
+    )
+    monkeypatch.setattr(
+        crud, "fetch_message_with_sub_processes", fetch_message_with_sub_processes
+    )
+    monkeypatch.setattr(crud, "fetch_documents", fetch_documents)
+    return pool
+
+
+@pytest.fixture
+def chat(monkeypatch) -> ChatStandIn:
+    chat = ChatStandIn()
+    monkeypatch.setattr(
+        conversation_endpoints, "handle_chat_message", chat.handle_chat_message
+    )
+    return chat
+
+
+@pytest.fixture
+def client(pool) -> httpx.AsyncClient:
+    app = FastAPI()
+    app.include_router(api_router, prefix="/api")
+
+    async def get_db_stand_in():
+        async with pool() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = get_db_stand_in
+    app.dependency_overrides[get_session_factory] = lambda: pool
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://test"
+    )
+
+
+async def astream_message(
+    client: httpx.AsyncClient, conversation_id: str, **params: str
+) -> dict:
+    response = await client.get(
+        f"/api/conversation/{conversation_id}/message",
+        params={"user_message": "What was the revenue?", **params},
+    )
+    events = [
+        json.loads(line[len("data: ") :])
+        for line in response.text.splitlines()
+        if line.startswith("data: ")
+    ]
+    return events[-1]
+
+
+@pytest.mark.anyio
+async def test_streams_dont_hold_db_connections(client, pool, chat):
+    async with client:
+        streams = [
+            asyncio.create_task(
+                astream_message(client, str(uuid4()), stream_protocol="delta")
+            )
+            for _ in range(NUM_STREAMS)
+        ]
+        with anyio.fail_after(5):
+            while chat.num_streaming < NUM_STREAMS:
+                await asyncio.sleep(0.01)
+
+        # more answers are being streamed than there are connections
+        with anyio.fail_after(5):
+            response = await client.get("/api/document/")
+        assert response.status_code == 200
+
+        chat.released.set()
+        with anyio.fail_after(5):
+            snapshots = await asyncio.gather(*streams)
+    assert all(snapshot["type"] == "snapshot" for snapshot in snapshots)
+    assert [snapshot["message"]["status"] for snapshot in snapshots] == [
+        "SUCCESS"
+    ] * NUM_STREAMS
+    assert snapshots[0]["message"]["content"] == "An answer"
+    # the user's & assistant's messages of each stream
+    assert len(pool.saved) == 2 * NUM_STREAMS
+
+
+@pytest.mark.anyio
+async def test_message_stream_defaults_to_whole_messages(client, pool, chat):
+    chat.released.set()
+    async with client:
+        with anyio.fail_after(5):
+            message = await astream_message(client, str(uuid4()))
+    assert "type" not in message
+    assert message["status"] == "SUCCESS"
+    assert message["content"] == "An answer"
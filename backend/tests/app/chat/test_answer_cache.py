@@ -0,0 +1,198 @@
+from typing import List
+from unittest.mock import MagicMock
+import pytest
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.base.response.schema import Response
+from llama_index.core.callbacks import CallbackManager, LlamaDebugHandler
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.query_engine import SubQuestionQueryEngine
+from llama_index.core.question_gen.types import SubQuestion
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+from llama_index.core.tools import QueryEngineTool, ToolMetadata
+from app.chat.answer_cache import (
+    SubQuestionAnswerCache,
+    SubQuestionAnswerCacheQueryEngine,
+    normalize_question,
+)
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class KeywordEmbedding(BaseEmbedding):
+    """
+    Embeds a text by which of a few keywords it contains, so that questions
+    about the same things are similar.
+    """
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "KeywordEmbedding"
+
+    def _embed(self, text: str) -> List[float]:
+        keywords = ["risk", "revenue", "supply", "growth"]
+        return [float(keyword in text) for keyword in keywords] + [0.1]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class FakeDocumentQueryEngine(BaseQueryEngine):
+    def __init__(self):
+        super().__init__(callback_manager=None)
+        self.queries: List[QueryBundle] = []
+
+    def _get_prompt_modules(self) -> dict:
+        return {}
+
+    async def _aquery(self, query_bundle: QueryBundle) -> Response:
+        self.queries.append(query_bundle)
+        node = TextNode(text="Risk factors include ...", metadata={"page_label": "12"})
+        return Response(
+            response=f"Answer {len(self.queries)}",
+            source_nodes=[NodeWithScore(node=node, score=0.8)],
+        )
+
+    def _query(self, query_bundle: QueryBundle) -> Response:
+        raise NotImplementedError
+
+
+def make_cache(timer=None, max_entries: int = 10) -> SubQuestionAnswerCache:
+    return SubQuestionAnswerCache(
+        similarity_threshold=0.95,
+        ttl_seconds=60,
+        max_entries=max_entries,
+        timer=timer or FakeTimer(),
+    )
+
+
+def test_normalize_question():
+    assert normalize_question("  What are the  main risks?\n") == (
+        "what are the main risks"
+    )
+
+
+class TestSubQuestionAnswerCache:
+    """
+    Test the similarity threshold, TTL & size limit of the answer cache.
+    """
+
+    def test_similarity_threshold(self):
+        cache = make_cache()
+        cache.put("doc-1", "risks", [1.0, 0.0, 0.1], "Answer", [])
+        assert cache.get("doc-1", [0.99, 0.01, 0.1]).answer == "Answer"
+        assert cache.get("doc-1", [0.5, 0.5, 0.1]) is None
+        # answers aren't shared between documents
+        assert cache.get("doc-2", [1.0, 0.0, 0.1]) is None
+        assert (cache.stats.hits, cache.stats.misses) == (1, 2)
+
+    def test_entries_expire(self):
+        timer = FakeTimer()
+        cache = make_cache(timer)
+        cache.put("doc-1", "risks", [1.0, 0.0], "Answer", [])
+        timer.now = 59
+        assert cache.get_exact("doc-1", "risks") is not None
+        timer.now = 60
+        assert cache.get_exact("doc-1", "risks") is None
+        assert len(cache) == 0
+
+    def test_evicts_least_recently_used_entries(self):
+        cache = make_cache(max_entries=2)
+        cache.put("doc-1", "risks", [1.0, 0.0], "Risks", [])
+        cache.put("doc-2", "revenue", [0.0, 1.0], "Revenue", [])
+        assert cache.get("doc-1", [1.0, 0.0]) is not None
+
+        cache.put("doc-3", "growth", [1.0, 1.0], "Growth", [])
+        assert cache.get("doc-2", [0.0, 1.0]) is None
+        assert cache.get("doc-1", [1.0, 0.0]) is not None
+        assert len(cache) == 2
+
+
+class TestSubQuestionAnswerCacheQueryEngine:
+    """
+    Test that cached answers go through the sub-question engine like any other.
+    """
+
+    @pytest.mark.anyio
+    async def test_cache_hit_emits_sub_question_event(self):
+        document_engine = FakeDocumentQueryEngine()
+        cache = make_cache()
+        handler = LlamaDebugHandler()
+        cached_engine = SubQuestionAnswerCacheQueryEngine(
+            document_engine, cache, "doc-1:sha", embed_model=KeywordEmbedding()
+        )
+        sub_question_engine = SubQuestionQueryEngine(
+            question_gen=MagicMock(),
+            response_synthesizer=MagicMock(),
+            query_engine_tools=[
+                QueryEngineTool(
+                    query_engine=cached_engine,
+                    metadata=ToolMetadata(name="doc-1", description="A 10-K"),
+                )
+            ],
+            callback_manager=CallbackManager([handler]),
+            verbose=False,
+        )
+
+        questions = [
+            "What are the main risk factors?",
+            "what are the main risk factors",
+            "Which risk factors are the main ones?",
+            "How did revenue change?",
+        ]
+        qa_pairs = [
+            await sub_question_engine._aquery_subq(
+                SubQuestion(sub_question=question, tool_name="doc-1")
+            )
+            for question in questions
+        ]
+        assert [qa_pair.answer for qa_pair in qa_pairs] == [
+            "Answer 1",
+            "Answer 1",
+            "Answer 1",
+            "Answer 2",
+        ]
+        assert len(document_engine.queries) == 2
+        # retrieval reuses the embedding of the sub-question
+        assert document_engine.queries[0].embedding is not None
+
+        end_events = [
+            end_event
+            for _, end_event in handler.get_event_pairs(CBEventType.SUB_QUESTION)
+        ]
+        assert len(end_events) == 4
+        cached_qa_pair = end_events[1].payload[EventPayload.SUB_QUESTION]
+        assert cached_qa_pair.sub_q.sub_question == questions[1]
+        assert cached_qa_pair.sources[0].node.metadata == {"page_label": "12"}
+
+    @pytest.mark.anyio
+    async def test_cache_miss_retrieves_with_the_embedding_of_the_question(self):
+        document_engine = FakeDocumentQueryEngine()
+        embed_model = KeywordEmbedding()
+        cached_engine = SubQuestionAnswerCacheQueryEngine(
+            document_engine, make_cache(), "doc-1:sha", embed_model=embed_model
+        )
+
+        # normalizing would lowercase "Revenue" into a keyword
+        question = "How did Revenue change?"
+        await cached_engine.aquery(question)
+        (query_bundle,) = document_engine.queries
+        assert query_bundle.query_str == question
+        assert query_bundle.embedding == embed_model.get_query_embedding(question)
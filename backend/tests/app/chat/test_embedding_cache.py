@@ -0,0 +1,94 @@
+from typing import Dict, List
+import pytest
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from app.chat.embedding_cache import BaseEmbeddingCacheStore, CachedEmbedding
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class InMemoryEmbeddingCacheStore(BaseEmbeddingCacheStore):
+    def __init__(self):
+        self.entries: Dict[tuple, Embedding] = {}
+
+    async def aget_many(
+        self, model: str, dimensions: int, text_hashes: List[str]
+    ) -> Dict[str, Embedding]:
+        return {
+            text_hash: self.entries[(model, dimensions, text_hash)]
+            for text_hash in text_hashes
+            if (model, dimensions, text_hash) in self.entries
+        }
+
+    async def aput_many(
+        self, model: str, dimensions: int, embeddings: Dict[str, Embedding]
+    ) -> None:
+        for text_hash, embedding in embeddings.items():
+            self.entries[(model, dimensions, text_hash)] = embedding
+
+
+class CountingEmbedding(BaseEmbedding):
+    """
+    Fake embedding that records every text sent to it & embeds it by length.
+    """
+
+    embed_dim: int
+    embedded_texts: List[str] = []
+
+    def _count_and_embed(self, text: str) -> Embedding:
+        self.embedded_texts.append(text)
+        return [float(len(text))] * self.embed_dim
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._count_and_embed(text)
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._count_and_embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return self._count_and_embed(query)
+
+
+class TestCachedEmbedding:
+    """
+    Test that cached texts aren't embedded again.
+    """
+
+    @pytest.mark.anyio
+    async def test_text_embeddings_are_cached(self):
+        inner = CountingEmbedding(embed_dim=4, embedded_texts=[])
+        store = InMemoryEmbeddingCacheStore()
+        embed_model = CachedEmbedding(inner, store=store)
+
+        texts = ["revenue", "goodwill", "revenue"]
+        embeddings = await embed_model.aget_text_embedding_batch(texts)
+        assert embeddings == [[7.0] * 4, [8.0] * 4, [7.0] * 4]
+        # the repeated text is only embedded once
+        assert inner.embedded_texts == ["revenue", "goodwill"]
+        assert (embed_model.get_stats().hits, embed_model.get_stats().misses) == (1, 2)
+
+        # a fresh wrapper around the same store, e.g. a re-seed, embeds nothing
+        embed_model = CachedEmbedding(inner, store=store)
+        assert await embed_model.aget_text_embedding_batch(texts) == embeddings
+        assert embed_model.get_text_embedding("goodwill") == [8.0] * 4
+        assert inner.embedded_texts == ["revenue", "goodwill"]
+        assert embed_model.get_stats().hit_rate == 1.0
+
+    @pytest.mark.anyio
+    async def test_query_embeddings_are_cached_in_memory(self):
+        inner = CountingEmbedding(embed_dim=4, embedded_texts=[])
+        store = InMemoryEmbeddingCacheStore()
+        embed_model = CachedEmbedding(inner, store=store, query_cache_size=1)
+        assert await embed_model.aget_query_embedding("net income?") == [11.0] * 4
+        assert await embed_model.aget_query_embedding("net income?") == [11.0] * 4
+        assert inner.embedded_texts == ["net income?"]
+        assert (embed_model.get_stats().hits, embed_model.get_stats().misses) == (1, 1)
+        # user questions don't grow the persistent cache
+        assert store.entries == {}
+
+        # past the cache size, the least recently used query is evicted
+        await embed_model.aget_query_embedding("revenue?")
+        await embed_model.aget_query_embedding("net income?")
+        assert inner.embedded_texts == ["net income?", "revenue?", "net income?"]
@@ -1,10 +1,21 @@
 from typing import List, Tuple, Optional
 from uuid import UUID, uuid4
 from datetime import datetime
-from llama_index.llms import ChatMessage
-from app.schema import Message
+import contextvars
+from unittest.mock import MagicMock, patch
+from llama_index.core.llms import ChatMessage
+from llama_index.core.callbacks.schema import CBEventType
+from llama_index.core.utils import get_tokenizer
+from app.schema import Message, Document, DocumentMetadataKeysEnum
 from app.models.db import MessageStatusEnum, MessageRoleEnum
-from app.chat.engine import get_chat_history
+from app.chat import engine
+from app.chat.engine import (
+    count_message_tokens,
+    get_chat_history,
+    get_tool_graph_cache_key,
+    bind_request_callback_handlers,
+    RequestScopedCallbackManager,
+)
 
 
 class MockMessage(Message):
@@ -171,6 +182,56 @@ class TestGetChatHistory:
         )
         assert get_chat_history(messages) == expected_result
 
+    def test_get_chat_history_token_budget(self):
+        messages = [
+            MockMessage(
+                content=content,
+                status=MessageStatusEnum.SUCCESS,
+                role=role,
+                created_at=datetime(2023, 1, 1, 12, minute),
+            )
+            for minute, (content, role) in enumerate(
+                [
+                    ("Tell me about the company " * 10, MessageRoleEnum.user),
+                    ("It makes phones " * 10, MessageRoleEnum.assistant),
+                    ("How are you?", MessageRoleEnum.user),
+                    ("Good, thank you", MessageRoleEnum.assistant),
+                ]
+            )
+        ]
+        expected_result = chat_tuples_to_chat_messages(
+            [("How are you?", "Good, thank you")]
+        )
+        # the latest messages that fit, without gaps
+        assert get_chat_history(messages, token_budget=20) == expected_result
+        assert len(get_chat_history(messages, token_budget=1000)) == 4
+        assert get_chat_history(messages, token_budget=0) == []
+
+    def test_get_chat_history_tokenizes_each_message_once(self):
+        messages = [
+            MockMessage(
+                content=f"Message {minute} about revenue",
+                status=MessageStatusEnum.SUCCESS,
+                role=MessageRoleEnum.user,
+                created_at=datetime(2023, 1, 1, 12, minute),
+            )
+            for minute in range(5)
+        ]
+        count_message_tokens.cache_clear()
+        tokenizer = MagicMock(side_effect=get_tokenizer())
+        with patch.object(engine, "get_tokenizer", return_value=tokenizer):
+            get_chat_history(messages, token_budget=1000)
+            messages.append(
+                MockMessage(
+                    content="And about goodwill?",
+                    status=MessageStatusEnum.SUCCESS,
+                    role=MessageRoleEnum.user,
+                    created_at=datetime(2023, 1, 1, 12, 5),
+                )
+            )
+            assert len(get_chat_history(messages, token_budget=1000)) == 6
+        assert tokenizer.call_count == 6
+
     def test_get_chat_history_strip_content(self):
         messages = [
             MockMessage(
@@ -214,3 +275,51 @@ class TestGetChatHistory:
             [("Hello", "Hi"), ("How are you?", None)]
         )
         assert get_chat_history(messages) == expected_result
+
+
+class TestRequestScopedCallbackManager:
+    """
+    Test that cached tool graphs dispatch events to the handlers of the current request.
+    """
+
+    def test_events_go_to_handlers_bound_in_current_context(self):
+        callback_manager = RequestScopedCallbackManager([])
+        handler_a = MagicMock(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        handler_b = MagicMock(event_starts_to_ignore=[], event_ends_to_ignore=[])
+
+        def emit_event(handler):
+            bind_request_callback_handlers(handler)
+            callback_manager.on_event_start(CBEventType.QUERY, event_id="event")
+
+        contextvars.copy_context().run(emit_event, handler_a)
+        contextvars.copy_context().run(emit_event, handler_b)
+
+        assert handler_a.on_event_start.call_count == 1
+        assert handler_b.on_event_start.call_count == 1
+
+    def test_no_handlers_outside_of_request(self):
+        callback_manager = RequestScopedCallbackManager([])
+        assert contextvars.Context().run(lambda: callback_manager.handlers) == []
+
+
+def test_tool_graph_cache_key_ignores_document_order():
+    doc_a = Document(id=uuid4(), url="https://example.com/a.pdf")
+    doc_b = Document(id=uuid4(), url="https://example.com/b.pdf")
+    assert get_tool_graph_cache_key([doc_a, doc_b]) == get_tool_graph_cache_key(
+        [doc_b, doc_a]
+    )
+
+
+def test_tool_graph_cache_key_changes_with_document_content():
+    doc_id = uuid4()
+    doc, reingested_doc = [
+        Document(
+            id=doc_id,
+            url="https://example.com/a.pdf",
+            metadata_map={DocumentMetadataKeysEnum.CONTENT_SHA256: sha256},
+        )
+        for sha256 in ["ab" * 32, "cd" * 32]
+    ]
+    assert get_tool_graph_cache_key([doc]) != get_tool_graph_cache_key(
+        [reingested_doc]
+    )
@@ -0,0 +1,198 @@
+import datetime
+from app.chat.financials import extract_financials
+from app.chat.tools import describe_document_financials
+from app.models.db import FinancialStatementEnum
+from app.schema import SecDocumentMetadata, SecDocumentTypeEnum
+
+CONTEXTS = """
+<xbrli:context id="c-1">
+  <xbrli:entity>
+    <xbrli:identifier scheme="http://www.sec.gov/CIK">0000320193</xbrli:identifier>
+  </xbrli:entity>
+  <xbrli:period>
+    <xbrli:startDate>2023-04-02</xbrli:startDate>
+    <xbrli:endDate>2023-07-01</xbrli:endDate>
+  </xbrli:period>
+</xbrli:context>
+<xbrli:context id="c-2">
+  <xbrli:entity>
+    <xbrli:identifier scheme="http://www.sec.gov/CIK">0000320193</xbrli:identifier>
+  </xbrli:entity>
+  <xbrli:period>
+    <xbrli:startDate>2022-09-25</xbrli:startDate>
+    <xbrli:endDate>2023-07-01</xbrli:endDate>
+  </xbrli:period>
+</xbrli:context>
+<xbrli:context id="c-3">
+  <xbrli:entity>
+    <xbrli:identifier scheme="http://www.sec.gov/CIK">0000320193</xbrli:identifier>
+  </xbrli:entity>
+  <xbrli:period><xbrli:instant>2023-07-01</xbrli:instant></xbrli:period>
+</xbrli:context>
+<xbrli:context id="c-4">
+  <xbrli:entity>
+    <xbrli:identifier scheme="http://www.sec.gov/CIK">0000320193</xbrli:identifier>
+    <xbrli:segment>
+      <xbrldi:explicitMember dimension="srt:ProductOrServiceAxis">
+        us-gaap:ProductMember
+      </xbrldi:explicitMember>
+    </xbrli:segment>
+  </xbrli:entity>
+  <xbrli:period>
+    <xbrli:startDate>2023-04-02</xbrli:startDate>
+    <xbrli:endDate>2023-07-01</xbrli:endDate>
+  </xbrli:period>
+</xbrli:context>
+<xbrli:context id="c-5">
+  <xbrli:entity>
+    <xbrli:identifier scheme="http://www.sec.gov/CIK">0000320193</xbrli:identifier>
+  </xbrli:entity>
+  <xbrli:period><xbrli:instant>2022-09-24</xbrli:instant></xbrli:period>
+</xbrli:context>
+<xbrli:unit id="usd"><xbrli:measure>iso4217:USD</xbrli:measure></xbrli:unit>
+<xbrli:unit id="usdPerShare">
+  <xbrli:divide>
+    <xbrli:unitNumerator>
+      <xbrli:measure>iso4217:USD</xbrli:measure>
+    </xbrli:unitNumerator>
+    <xbrli:unitDenominator>
+      <xbrli:measure>xbrli:shares</xbrli:measure>
+    </xbrli:unitDenominator>
+  </xbrli:divide>
+</xbrli:unit>
+"""
+
+INLINE_PRIMARY_DOCUMENT = f"""
+<html><body>
+<ix:header><ix:resources>{CONTEXTS}</ix:resources></ix:header>
+<td><ix:nonFraction unitRef="usd" contextRef="c-1" decimals="-6"
+  name="us-gaap:RevenueFromContractWithCustomerExcludingAssessedTax"
+  format="ixt:num-dot-decimal" scale="6" id="f-1">81,797</ix:nonFraction></td>
+<td><ix:nonFraction unitRef="usd" contextRef="c-2" decimals="-6"
+  name="us-gaap:RevenueFromContractWithCustomerExcludingAssessedTax"
+  format="ixt:num-dot-decimal" scale="6" id="f-2">304,182</ix:nonFraction></td>
+<td><ix:nonFraction unitRef="usd" contextRef="c-4" decimals="-6"
+  name="us-gaap:RevenueFromContractWithCustomerExcludingAssessedTax"
+  format="ixt:num-dot-decimal" scale="6" id="f-3">60,584</ix:nonFraction></td>
+<td><ix:nonFraction unitRef="usd" contextRef="c-1" decimals="-6"
+  name="us-gaap:NetIncomeLoss"
+  format="ixt:num-dot-decimal" scale="6" id="f-4">19,881</ix:nonFraction></td>
+<td><ix:nonFraction unitRef="usdPerShare" contextRef="c-1" decimals="2"
+  name="us-gaap:EarningsPerShareDiluted"
+  format="ixt:num-dot-decimal" scale="0" id="f-5">1.26</ix:nonFraction></td>
+<td><ix:nonFraction unitRef="usd" contextRef="c-2" decimals="-6"
+  name="us-gaap:NetCashProvidedByUsedInInvestingActivities"
+  format="ixt:num-dot-decimal" scale="6" sign="-" id="f-6">437</ix:nonFraction></td>
+<td><ix:nonFraction unitRef="usd" contextRef="c-3" decimals="-6"
+  name="us-gaap:Assets"
+  format="ixt:num-dot-decimal" scale="6" id="f-7">335,038</ix:nonFraction></td>
+<td><ix:nonFraction unitRef="usd" contextRef="c-5" decimals="-6"
+  name="us-gaap:Assets"
+  format="ixt:num-dot-decimal" scale="6" id="f-8">352,755</ix:nonFraction></td>
+<td><ix:nonFraction unitRef="usd" contextRef="c-3" decimals="-6"
+  name="us-gaap:Liabilities" xsi:nil="true" id="f-9"/></td>
+</body></html>
+"""
+
+
+def make_full_submission(*documents) -> str:
+    header = "<SEC-HEADER>\nCONFORMED PERIOD OF REPORT:\t20230701\n</SEC-HEADER>\n"
+    return header + "".join(
+        f"<DOCUMENT>\n<TYPE>{doc_type}\n<SEQUENCE>{i}\n<FILENAME>{filename}\n"
+        f"<TEXT>\n{text}\n</TEXT>\n</DOCUMENT>\n"
+        for i, (doc_type, filename, text) in enumerate(documents, start=1)
+    )
+
+
+def get_values(financials) -> dict:
+    return {(fact.statement, fact.concept): fact.value for fact in financials}
+
+
+class TestExtractFinancials:
+    """
+    Test the extraction of the reported period's figures from XBRL data.
+    """
+
+    def test_inline_xbrl(self):
+        full_submission = make_full_submission(
+            ("10-Q", "aapl-20230701.htm", INLINE_PRIMARY_DOCUMENT),
+            ("EX-31.1", "a10-qexhibit31107012023.htm", "<html></html>"),
+        )
+        financials = extract_financials(
+            full_submission, datetime.date(2023, 7, 1), is_annual=False
+        )
+        assert get_values(financials) == {
+            # the quarter's revenues, not the year to date or a segment's
+            (FinancialStatementEnum.INCOME_STATEMENT, "revenues"): 81_797e6,
+            (FinancialStatementEnum.INCOME_STATEMENT, "net_income_loss"): 19_881e6,
+            (
+                FinancialStatementEnum.INCOME_STATEMENT,
+                "diluted_earnings_per_share",
+            ): 1.26,
+            # only reported year to date
+            (
+                FinancialStatementEnum.CASH_FLOW_STATEMENT,
+                "net_cash_flow_from_investing_activities",
+            ): -437e6,
+            (FinancialStatementEnum.BALANCE_SHEET, "assets"): 335_038e6,
+        }
+        revenues = financials[0]
+        assert revenues.xbrl_concept == (
+            "us-gaap:RevenueFromContractWithCustomerExcludingAssessedTax"
+        )
+        assert (revenues.unit, revenues.start_date) == (
+            "USD",
+            datetime.date(2023, 4, 2),
+        )
+        assert {fact.unit for fact in financials} == {"USD", "USD / shares"}
+
+    def test_instance_document_is_preferred(self):
+        instance_document = f"""
+<xbrli:xbrl>{CONTEXTS}
+<us-gaap:Revenues contextRef="c-2" unitRef="usd" decimals="-6"
+  >304182000000</us-gaap:Revenues>
+<us-gaap:Assets contextRef="c-3" unitRef="usd" decimals="-6"
+  >335038000000</us-gaap:Assets>
+<dei:EntityCommonStockSharesOutstanding contextRef="c-3" unitRef="shares"
+  >15634232000</dei:EntityCommonStockSharesOutstanding>
+</xbrli:xbrl>
+"""
+        full_submission = make_full_submission(
+            ("10-K", "aapl-20230701.htm", INLINE_PRIMARY_DOCUMENT),
+            ("XML", "aapl-20230701_htm.xml", instance_document),
+        )
+        financials = extract_financials(
+            full_submission, datetime.date(2023, 7, 1), is_annual=True
+        )
+        assert get_values(financials) == {
+            (FinancialStatementEnum.INCOME_STATEMENT, "revenues"): 304_182e6,
+            (FinancialStatementEnum.BALANCE_SHEET, "assets"): 335_038e6,
+        }
+
+    def test_no_xbrl_data(self):
+        full_submission = make_full_submission(("10-K", "10k.htm", "<html></html>"))
+        financials = extract_financials(
+            full_submission, datetime.date(2023, 7, 1), is_annual=True
+        )
+        assert financials == []
+
+
+def test_describe_document_financials():
+    full_submission = make_full_submission(
+        ("10-Q", "aapl-20230701.htm", INLINE_PRIMARY_DOCUMENT)
+    )
+    financials = extract_financials(full_submission, datetime.date(2023, 7, 1), False)
+    sec_metadata = SecDocumentMetadata(
+        company_name="Apple Inc.",
+        company_ticker="AAPL",
+        doc_type=SecDocumentTypeEnum.TEN_Q,
+        year=2023,
+        quarter=3,
+        period_of_report_date=datetime.datetime(2023, 7, 1),
+    )
+    description = describe_document_financials(sec_metadata, financials)
+    assert description.startswith(
+        "For Apple Inc. in fiscal year 2023 covering the period Q3: "
+        "Revenues from 2023-04-02 to 2023-07-01: 81797000000.0 USD."
+    )
+    assert "Assets as of 2023-07-01: 335038000000.0 USD." in description
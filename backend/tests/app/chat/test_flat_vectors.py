@@ -0,0 +1,179 @@
+from typing import List
+import os
+from uuid import uuid4
+import numpy as np
+import pytest
+from fsspec.implementations.memory import MemoryFileSystem
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import (
+    ExactMatchFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from app.chat.constants import DB_DOC_ID_KEY
+from app.chat.flat_vectors import (
+    FlatVectorFileCache,
+    FlatVectorIndex,
+    FlatVectorStore,
+    encode_flat_vectors,
+)
+from tests.app.chat.test_pg_vector import get_vector_store
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+DOC_ID = "doc-1"
+SHA256 = "ab" * 32
+
+
+def make_rows(num_rows: int, dim: int = 8, seed: int = 0) -> List[dict]:
+    rng = np.random.default_rng(seed)
+    vector_store = get_vector_store()
+    nodes = [
+        TextNode(
+            text=f"Chunk {i}",
+            metadata={"page_label": str(i), DB_DOC_ID_KEY: DOC_ID},
+            embedding=rng.normal(size=dim).tolist(),
+        )
+        for i in range(num_rows)
+    ]
+    return vector_store.nodes_to_rows(nodes)
+
+
+def exact_top_k(rows: List[dict], query: List[float], top_k: int) -> List[str]:
+    matrix = np.array([row["embedding"] for row in rows])
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    similarities = matrix @ (np.array(query) / np.linalg.norm(query))
+    return [rows[i]["node_id"] for i in np.argsort(-similarities)[:top_k]]
+
+
+class TestFlatVectorIndex:
+    """
+    Test the flat vector file format & its exact search.
+    """
+
+    def test_round_trip_matches_exact_search(self, tmp_path):
+        rows = make_rows(50)
+        path = tmp_path / "doc.fvec"
+        path.write_bytes(encode_flat_vectors(rows))
+
+        index = FlatVectorIndex.from_file(path)
+        assert len(index) == 50
+        assert index.dim == 8
+        query = make_rows(1, seed=1)[0]["embedding"]
+        result = index.query(query, top_k=5)
+        assert result.ids == exact_top_k(rows, query, 5)
+        assert result.similarities == sorted(result.similarities, reverse=True)
+        assert [node.get_content() for node in result.nodes] == [
+            next(row["text"] for row in rows if row["node_id"] == node_id)
+            for node_id in result.ids
+        ]
+        assert result.nodes[0].metadata[DB_DOC_ID_KEY] == DOC_ID
+
+    def test_empty_document(self, tmp_path):
+        path = tmp_path / "doc.fvec"
+        path.write_bytes(encode_flat_vectors([]))
+        result = FlatVectorIndex.from_file(path).query([1.0, 0.0], top_k=3)
+        assert result.ids == []
+
+
+class TestFlatVectorFileCache:
+    """
+    Test the local & remote tiers of the flat vector file cache.
+    """
+
+    def test_remote_hit_is_copied_to_local_disk(self, tmp_path):
+        fs = MemoryFileSystem()
+        remote_root = f"/{uuid4()}/flat-vectors"
+        rows = make_rows(10)
+        FlatVectorFileCache(tmp_path / "worker_1", 2**20, fs, remote_root).put(
+            DOC_ID, SHA256, rows
+        )
+
+        cache = FlatVectorFileCache(tmp_path / "worker_2", 2**20, fs, remote_root)
+        assert cache.get(DOC_ID, "cd" * 32) is None
+        assert len(cache.get(DOC_ID, SHA256)) == 10
+        assert (tmp_path / "worker_2" / DOC_ID / f"{SHA256}.fvec").exists()
+
+    def test_evicts_least_recently_used_files(self, tmp_path):
+        file_size = len(encode_flat_vectors(make_rows(10)))
+        cache = FlatVectorFileCache(tmp_path, max_bytes=2 * file_size)
+        for i, doc_id in enumerate(["doc-1", "doc-2"]):
+            cache.put(doc_id, SHA256, make_rows(10))
+            os.utime(tmp_path / doc_id / f"{SHA256}.fvec", (i, i))
+        # reading doc-1 makes doc-2 the least recently used
+        assert FlatVectorFileCache(tmp_path, 2 * file_size).get("doc-1", SHA256)
+
+        cache.put("doc-3", SHA256, make_rows(10))
+        assert sorted(path.parent.name for path in tmp_path.glob("*/*.fvec")) == [
+            "doc-1",
+            "doc-3",
+        ]
+
+
+class FakeFallbackVectorStore:
+    def __init__(self, rows: List[dict]):
+        self.rows = rows
+        self.queries: List[VectorStoreQuery] = []
+        self.row_fetches = 0
+
+    async def aget_db_document_rows(self, db_document_id: str) -> List[dict]:
+        self.row_fetches += 1
+        return self.rows
+
+    async def aquery(self, query: VectorStoreQuery, **kwargs) -> VectorStoreQueryResult:
+        self.queries.append(query)
+        return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+
+
+def make_query(mode: VectorStoreQueryMode = VectorStoreQueryMode.DEFAULT):
+    return VectorStoreQuery(
+        query_embedding=make_rows(1, seed=1)[0]["embedding"],
+        query_str="revenue",
+        similarity_top_k=3,
+        mode=mode,
+        filters=MetadataFilters(
+            filters=[ExactMatchFilter(key=DB_DOC_ID_KEY, value=DOC_ID)]
+        ),
+    )
+
+
+class TestFlatVectorStore:
+    """
+    Test which searches are served from flat vector files.
+    """
+
+    @pytest.mark.anyio
+    async def test_builds_missing_file_from_postgres(self, tmp_path):
+        rows = make_rows(20)
+        fallback = FakeFallbackVectorStore(rows)
+        store = FlatVectorStore(fallback, FlatVectorFileCache(tmp_path, 2**20))
+
+        for _ in range(2):
+            result = await store.aquery(make_query(), content_sha256=SHA256)
+            assert result.ids == exact_top_k(rows, make_query().query_embedding, 3)
+        assert fallback.row_fetches == 1
+        assert fallback.queries == []
+
+    @pytest.mark.anyio
+    async def test_other_searches_go_to_postgres(self, tmp_path):
+        fallback = FakeFallbackVectorStore(make_rows(20))
+        store = FlatVectorStore(fallback, FlatVectorFileCache(tmp_path, 2**20))
+
+        await store.aquery(
+            make_query(VectorStoreQueryMode.HYBRID), content_sha256=SHA256
+        )
+        # without the document's version, a file may be stale
+        await store.aquery(make_query())
+        assert len(fallback.queries) == 2
+        assert fallback.row_fetches == 0
+
+        # the document has no rows yet
+        fallback.rows = []
+        await store.aquery(make_query(), content_sha256=SHA256)
+        assert len(fallback.queries) == 3
@@ -0,0 +1,231 @@
+from pathlib import Path
+from unittest.mock import patch
+from uuid import uuid4
+import time
+import anyio
+import pytest
+from pypdf import PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+from llama_index.core import MockEmbedding, Settings
+from llama_index.core.callbacks import CallbackManager
+from app.core.config import settings
+from app.schema import Document, DocumentMetadataKeysEnum
+from app.models.db import IngestionStageEnum
+from app.chat import ingestion
+from app.chat.constants import DB_DOC_ID_KEY
+from app.chat.manifest import IngestionManifest
+from app.chat.page_cache import PageTextCache
+from app.chat.pdf_parsing import PdfParserBackendEnum, get_pdf_text_extractor
+from app.chat.ingestion import (
+    IngestionPipeline,
+    PipelineStage,
+    run_pipeline,
+    read_document,
+    shutdown_pdf_process_pool,
+)
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(autouse=True, scope="module")
+def pdf_process_pool():
+    yield
+    shutdown_pdf_process_pool()
+
+
+class TestRunPipeline:
+    """
+    Test the run_pipeline function.
+    """
+
+    @pytest.mark.anyio
+    async def test_run_pipeline_happy_path(self):
+        async def add_one(x):
+            return x + 1
+
+        async def double(x):
+            return x * 2
+
+        stages = [PipelineStage("add_one", add_one, 2), PipelineStage("double", double)]
+        results = await run_pipeline(range(5), stages)
+        assert sorted(results) == [2, 4, 6, 8, 10]
+        assert [stage.stats.num_items for stage in stages] == [5, 5]
+
+    @pytest.mark.anyio
+    async def test_run_pipeline_respects_stage_concurrency(self):
+        in_flight = 0
+        max_in_flight = 0
+
+        async def slow_stage(x):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await anyio.sleep(0.01)
+            in_flight -= 1
+            return x
+
+        results = await run_pipeline(range(10), [PipelineStage("slow", slow_stage, 3)])
+        assert len(results) == 10
+        assert max_in_flight == 3
+
+    @pytest.mark.anyio
+    async def test_run_pipeline_drops_failed_items(self):
+        async def fail_on_odd(x):
+            if x % 2:
+                raise ValueError(x)
+            return x
+
+        stage = PipelineStage("fail_on_odd", fail_on_odd)
+        results = await run_pipeline(range(4), [stage])
+        assert sorted(results) == [0, 2]
+        assert stage.stats.num_errors == 2
+
+
+def write_text_pdf(file_path: Path, num_pages: int, lines_per_page: int = 40) -> None:
+    """
+    Write a PDF with num_pages pages of text, using only pypdf.
+    """
+    writer = PdfWriter()
+    font = writer._add_object(
+        DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Font"),
+                NameObject("/Subtype"): NameObject("/Type1"),
+                NameObject("/BaseFont"): NameObject("/Helvetica"),
+            }
+        )
+    )
+    for page_number in range(num_pages):
+        page = writer.add_blank_page(width=612, height=792)
+        page[NameObject("/Resources")] = DictionaryObject(
+            {
+                NameObject("/Font"): DictionaryObject({NameObject("/F1"): font}),
+            }
+        )
+        text_ops = "\n".join(
+            f"BT /F1 10 Tf 40 {760 - 18 * line} Td "
+            f"(Page {page_number} line {line} total revenue and goodwill impairment) "
+            "Tj ET"
+            for line in range(lines_per_page)
+        )
+        content = DecodedStreamObject()
+        content.set_data(text_ops.encode())
+        page[NameObject("/Contents")] = writer._add_object(content)
+    with open(file_path, "wb") as f:
+        writer.write(f)
+
+
+@pytest.mark.parametrize("backend", list(PdfParserBackendEnum))
+def test_pdf_text_extractors_agree_on_pages(backend, tmp_path):
+    file_path = tmp_path / "filing.pdf"
+    write_text_pdf(file_path, num_pages=5)
+    extractor = get_pdf_text_extractor(backend)
+    assert extractor.count_pages(str(file_path)) == 5
+    pages = extractor.extract_page_range(str(file_path), 1, 4)
+    assert [page_label for page_label, _ in pages] == ["2", "3", "4"]
+    assert "Page 3 line 39 total revenue" in pages[2][1]
+
+
+@pytest.mark.parametrize("backend", list(PdfParserBackendEnum))
+def test_pdf_text_extractors_agree_on_page_labels(backend, tmp_path):
+    file_path = tmp_path / "filing.pdf"
+    write_text_pdf(file_path, num_pages=5)
+    writer = PdfWriter(clone_from=str(file_path))
+    writer.set_page_label(0, 1, style="/r")
+    writer.set_page_label(2, 4, style="/D", prefix="A-")
+    writer.write(str(file_path))
+    pages = get_pdf_text_extractor(backend).extract_page_range(str(file_path), 0, 5)
+    assert [page_label for page_label, _ in pages] == ["i", "ii", "A-1", "A-2", "A-3"]
+
+
+class TestReadDocument:
+    """
+    Test that PDF parsing is offloaded from the event loop.
+    """
+
+    @pytest.mark.anyio
+    async def test_read_document_keeps_page_metadata(self, tmp_path):
+        file_path = tmp_path / "filing.pdf"
+        write_text_pdf(file_path, num_pages=30)
+        document = Document(id=uuid4(), url="https://example.com/filing.pdf")
+        with patch.object(settings, "PDF_PARSER_PAGES_PER_TASK", 7):
+            docs = await read_document(document, file_path)
+        assert [doc.metadata["page_label"] for doc in docs] == [
+            str(i + 1) for i in range(30)
+        ]
+        assert all(doc.metadata[DB_DOC_ID_KEY] == str(document.id) for doc in docs)
+        assert "Page 29 line 0" in docs[-1].text
+
+    @pytest.mark.anyio
+    async def test_event_loop_keeps_serving_while_parsing(self, tmp_path):
+        file_path = tmp_path / "large_filing.pdf"
+        write_text_pdf(file_path, num_pages=300)
+        document = Document(id=uuid4(), url="https://example.com/large_filing.pdf")
+
+        # stand-in for the other requests being served by the same worker
+        heartbeat_gaps = []
+
+        async def heartbeat(stop: anyio.Event):
+            last_beat = time.perf_counter()
+            while not stop.is_set():
+                await anyio.sleep(0.01)
+                now = time.perf_counter()
+                heartbeat_gaps.append(now - last_beat)
+                last_beat = now
+
+        stop = anyio.Event()
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(heartbeat, stop)
+            start_time = time.perf_counter()
+            docs = await read_document(document, file_path)
+            parse_seconds = time.perf_counter() - start_time
+            stop.set()
+
+        assert len(docs) == 300
+        # the parse takes far longer than any single pause of the event loop
+        assert max(heartbeat_gaps) < 0.25 < parse_seconds
+
+
+class RecordingManifest(IngestionManifest):
+    def __init__(self):
+        self.stages = []
+        self.errors = []
+
+    async def arecord_stage(self, url, stage, **kwargs):
+        self.stages.append((url, stage))
+
+    async def arecord_error(self, url, stage_name, error):
+        self.errors.append((url, stage_name))
+
+
+class TestIngestionPipeline:
+    """
+    Test that the ingestion pipeline records its progress in the manifest.
+    """
+
+    @pytest.mark.anyio
+    async def test_completed_stages_and_failure_are_recorded(self, tmp_path):
+        sha256 = "ab" * 32
+        cache = PageTextCache(tmp_path)
+        cache.put(sha256, settings.PDF_PARSER_BACKEND, [("1", "Total revenue grew")])
+        document = Document(
+            id=uuid4(),
+            url="https://example.com/filing.pdf",
+            metadata_map={DocumentMetadataKeysEnum.CONTENT_SHA256: sha256},
+        )
+        manifest = RecordingManifest()
+        # no storage context, so writing the index fails
+        pipeline = IngestionPipeline(None, CallbackManager([]), manifest=manifest)
+        with patch.object(
+            ingestion, "get_page_text_cache", return_value=cache
+        ), patch.object(Settings, "_embed_model", MockEmbedding(embed_dim=4)):
+            assert await pipeline.run([document]) == {}
+
+        assert manifest.stages == [
+            (document.url, IngestionStageEnum.PARSED),
+            (document.url, IngestionStageEnum.EMBEDDED),
+        ]
+        assert manifest.errors == [(document.url, "write")]
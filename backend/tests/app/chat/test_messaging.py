@@ -0,0 +1,345 @@
+from typing import List, Union
+import json
+from uuid import uuid4
+import anyio
+import pytest
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.query_engine.sub_question_query_engine import (
+    SubQuestionAnswerPair,
+)
+from llama_index.core.question_gen.types import SubQuestion
+from app import schema
+from app.chat.messaging import (
+    CallbackEventStats,
+    ChatCallbackHandler,
+    StreamedMessage,
+    StreamedMessageBuilder,
+    StreamedMessageSubProcess,
+    astream_message_events,
+    get_callback_event_stats,
+    get_message_stream_encoder,
+    get_message_stream_stats,
+    reset_callback_event_stats,
+    reset_message_stream_stats,
+)
+from app.models.db import (
+    Message,
+    MessageRoleEnum,
+    MessageStatusEnum,
+    MessageSubProcessSourceEnum,
+)
+
+
+MESSAGE_ID = str(uuid4())
+CONVERSATION_ID = str(uuid4())
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def make_message() -> Message:
+    return Message(
+        id=MESSAGE_ID,
+        conversation_id=CONVERSATION_ID,
+        content="",
+        role=MessageRoleEnum.assistant,
+        status=MessageStatusEnum.PENDING,
+        sub_processes=[],
+    )
+
+
+def make_stream() -> List[Union[StreamedMessage, StreamedMessageSubProcess]]:
+    sub_question = {
+        "question": "What was the revenue?",
+        "answer": "It was $383 billion.",
+        "citations": [
+            {
+                "document_id": str(uuid4()),
+                "text": "Total net sales were $383,285 million. " * 20,
+                "page_number": 21,
+                "score": 0.8,
+            }
+        ],
+    }
+    return [
+        StreamedMessageSubProcess(
+            source=MessageSubProcessSourceEnum.CONSTRUCTED_QUERY_ENGINE,
+            has_ended=True,
+            event_id="engine",
+        ),
+        StreamedMessageSubProcess(
+            source=MessageSubProcessSourceEnum.SUB_QUESTION,
+            has_ended=False,
+            event_id="sub-question",
+            metadata_map={"sub_question": {"question": "What was the revenue?"}},
+        ),
+        StreamedMessageSubProcess(
+            source=MessageSubProcessSourceEnum.SUB_QUESTION,
+            has_ended=True,
+            event_id="sub-question",
+            metadata_map={"sub_question": sub_question},
+        ),
+        *[StreamedMessage(delta=f"token{i} ") for i in range(50)],
+    ]
+
+
+async def astream_events(
+    stream: List[Union[StreamedMessage, StreamedMessageSubProcess]],
+    protocol: schema.MessageStreamProtocolEnum,
+    flush_interval_ms: float = 0,
+    flush_max_bytes: int = 1024,
+    delay_seconds: float = 0,
+) -> List[str]:
+    send_chan, recv_chan = anyio.create_memory_object_stream(100)
+
+    async def send_stream():
+        async with send_chan:
+            for message_obj in stream:
+                await send_chan.send(message_obj)
+                if delay_seconds:
+                    await anyio.sleep(delay_seconds)
+
+    events = []
+    async with anyio.create_task_group() as task_group:
+        task_group.start_soon(send_stream)
+        async for event in astream_message_events(
+            recv_chan,
+            StreamedMessageBuilder(make_message()),
+            get_message_stream_encoder(protocol),
+            flush_interval_ms=flush_interval_ms,
+            flush_max_bytes=flush_max_bytes,
+        ):
+            events.append(event)
+    return events
+
+
+def apply_delta_events(events: List[str]) -> dict:
+    """
+    Build the message from the events of the delta protocol, like a client does.
+    """
+    message = None
+    event_id_to_sub_process = {}
+    for event in map(json.loads, events):
+        assert event["version"] == schema.MESSAGE_STREAM_DELTA_VERSION
+        if event["type"] == "start":
+            message = event["message"]
+        elif event["type"] == "patch":
+            message["content"] += event["delta"]
+            for patch in event["sub_processes"]:
+                event_id_to_sub_process[patch["event_id"]] = patch["sub_process"]
+            message["sub_processes"] = list(event_id_to_sub_process.values())
+        elif event["type"] == "snapshot":
+            message = event["message"]
+    return message
+
+
+def without_created_at(message: dict) -> dict:
+    sub_processes = [
+        {**sub_process, "created_at": None} for sub_process in message["sub_processes"]
+    ]
+    return {**message, "sub_processes": sub_processes}
+
+
+@pytest.mark.anyio
+async def test_delta_events_build_the_streamed_message():
+    stream = make_stream()
+    cumulative_events = await astream_events(
+        stream, schema.MessageStreamProtocolEnum.CUMULATIVE
+    )
+    delta_events = await astream_events(stream, schema.MessageStreamProtocolEnum.DELTA)
+    # without batching, every update gets its own event
+    assert len(cumulative_events) == len(stream)
+    assert len(delta_events) == len(stream) + 1
+
+    message = apply_delta_events(delta_events)
+    cumulative_message = json.loads(cumulative_events[-1])
+    assert without_created_at(message) == without_created_at(cumulative_message)
+    assert message["content"].startswith("token0 token1 ")
+    assert [sub_process["status"] for sub_process in message["sub_processes"]] == [
+        "FINISHED",
+        "FINISHED",
+    ]
+    # the citations are sent once, rather than with every token
+    assert sum(map(len, delta_events)) * 10 < sum(map(len, cumulative_events))
+
+
+class TestMessageStreamBatching:
+    """
+    Test that the streamed updates are batched by time & content size.
+    """
+
+    @pytest.mark.anyio
+    async def test_batches_updates_until_the_stream_ends(self):
+        reset_message_stream_stats()
+        stream = make_stream()
+        events = await astream_events(
+            stream,
+            schema.MessageStreamProtocolEnum.DELTA,
+            flush_interval_ms=60_000,
+            flush_max_bytes=10_000,
+        )
+        assert [json.loads(event)["type"] for event in events] == ["start", "patch"]
+        patch = json.loads(events[1])
+        # the sub-question's start & end are sent as its latest state
+        assert [
+            (sub_process["event_id"], sub_process["sub_process"]["status"])
+            for sub_process in patch["sub_processes"]
+        ] == [("engine", "FINISHED"), ("sub-question", "FINISHED")]
+        assert apply_delta_events(events)["content"].endswith("token49 ")
+
+        stats = get_message_stream_stats()
+        assert (stats.num_messages, stats.num_updates, stats.num_events) == (
+            1,
+            len(stream),
+            2,
+        )
+
+    @pytest.mark.anyio
+    async def test_flushes_at_max_bytes(self):
+        stream = [StreamedMessage(delta="0123456789") for _ in range(9)]
+        events = await astream_events(
+            stream,
+            schema.MessageStreamProtocolEnum.DELTA,
+            flush_interval_ms=60_000,
+            flush_max_bytes=30,
+        )
+        assert [json.loads(event).get("delta") for event in events[1:]] == [
+            "0123456789" * 3
+        ] * 3
+
+    @pytest.mark.anyio
+    async def test_flushes_after_interval(self):
+        stream = [StreamedMessage(delta=f"token{i} ") for i in range(3)]
+        events = await astream_events(
+            stream,
+            schema.MessageStreamProtocolEnum.CUMULATIVE,
+            flush_interval_ms=10,
+            delay_seconds=0.1,
+        )
+        # each token is sent once the interval has passed, without waiting for
+        # the next one
+        assert [json.loads(event)["content"] for event in events] == [
+            "token0 ",
+            "token0 token1 ",
+            "token0 token1 token2 ",
+        ]
+
+
+def test_final_event():
+    message = schema.Message.from_orm(make_message())
+    cumulative_encoder = get_message_stream_encoder(
+        schema.MessageStreamProtocolEnum.CUMULATIVE
+    )
+    assert schema.Message.parse_raw(cumulative_encoder.encode_final(message)) == (
+        message
+    )
+
+    delta_encoder = get_message_stream_encoder(schema.MessageStreamProtocolEnum.DELTA)
+    snapshot = schema.MessageStreamSnapshot.parse_raw(
+        delta_encoder.encode_final(message)
+    )
+    assert snapshot.type == schema.MessageStreamEventTypeEnum.SNAPSHOT
+    assert snapshot.message == message
+
+
+def make_sub_question_payload(question: str) -> dict:
+    return {
+        EventPayload.SUB_QUESTION: SubQuestionAnswerPair(
+            sub_q=SubQuestion(sub_question=question, tool_name="doc-1"), sources=[]
+        )
+    }
+
+
+class TestChatCallbackHandler:
+    """
+    Test that the allowed callback events are streamed in order, through a
+    bounded queue.
+    """
+
+    @pytest.mark.anyio
+    async def test_streams_allowed_events_in_order(self):
+        send_chan, recv_chan = anyio.create_memory_object_stream(100)
+        handler = ChatCallbackHandler(send_chan, event_types=[CBEventType.SUB_QUESTION])
+        callback_manager = CallbackManager([handler])
+        async with send_chan:
+            async with handler.dispatcher:
+                llm_event_id = callback_manager.on_event_start(CBEventType.LLM)
+                event_ids = [
+                    callback_manager.on_event_start(
+                        CBEventType.SUB_QUESTION,
+                        payload=make_sub_question_payload(f"Question {i}"),
+                    )
+                    for i in range(3)
+                ]
+                callback_manager.on_event_end(CBEventType.LLM, event_id=llm_event_id)
+                for event_id in reversed(event_ids):
+                    callback_manager.on_event_end(
+                        CBEventType.SUB_QUESTION,
+                        payload=make_sub_question_payload("Question"),
+                        event_id=event_id,
+                    )
+        streamed = [message_obj async for message_obj in recv_chan]
+        assert [
+            (message_obj.event_id, message_obj.has_ended) for message_obj in streamed
+        ] == [(event_id, False) for event_id in event_ids] + [
+            (event_id, True) for event_id in reversed(event_ids)
+        ]
+        assert streamed[1].metadata_map["sub_question"]["question"] == "Question 1"
+        assert handler.dispatcher.stats == CallbackEventStats(num_dispatched=6)
+
+    @pytest.mark.anyio
+    async def test_overflowing_and_late_events_are_dropped(self):
+        reset_callback_event_stats()
+        # no buffer, so every send waits for the receiver
+        send_chan, recv_chan = anyio.create_memory_object_stream(0)
+        handler = ChatCallbackHandler(
+            send_chan, event_types=[CBEventType.SUB_QUESTION], max_queue_size=2
+        )
+        streamed = []
+
+        async def receive():
+            async for message_obj in recv_chan:
+                streamed.append(message_obj)
+
+        async with send_chan:
+            async with handler.dispatcher:
+                for i in range(5):
+                    handler.on_event_start(CBEventType.SUB_QUESTION, {}, f"event-{i}")
+                    # the dispatcher takes the first event, and waits to send it
+                    await anyio.sleep(0)
+                assert handler.dispatcher.stats.num_overflowed == 2
+                async with anyio.create_task_group() as task_group:
+                    task_group.start_soon(receive)
+                    await anyio.wait_all_tasks_blocked()
+                    task_group.cancel_scope.cancel()
+            handler.on_event_end(CBEventType.SUB_QUESTION, {}, "event-0")
+        assert [message_obj.event_id for message_obj in streamed] == [
+            "event-0",
+            "event-1",
+            "event-2",
+        ]
+        assert get_callback_event_stats() == CallbackEventStats(
+            num_dispatched=3, num_overflowed=2
+        )
+        assert handler.dispatcher.stats.num_dropped == 1
+
+    @pytest.mark.anyio
+    async def test_events_from_other_threads(self):
+        send_chan, recv_chan = anyio.create_memory_object_stream(100)
+        handler = ChatCallbackHandler(send_chan, event_types=[CBEventType.SUB_QUESTION])
+
+        def emit_events():
+            for i in range(3):
+                handler.on_event_end(CBEventType.SUB_QUESTION, {}, f"event-{i}")
+
+        async with send_chan:
+            async with handler.dispatcher:
+                await anyio.to_thread.run_sync(emit_events)
+        assert [message_obj.event_id async for message_obj in recv_chan] == [
+            "event-0",
+            "event-1",
+            "event-2",
+        ]
@@ -0,0 +1,87 @@
+from unittest.mock import patch
+from uuid import uuid4
+import pytest
+from fsspec.implementations.memory import MemoryFileSystem
+from app.core.config import settings
+from app.schema import Document, DocumentMetadataKeysEnum
+from app.chat import ingestion
+from app.chat.page_cache import PageTextCache, sha256_file
+from tests.app.chat.test_ingestion import write_text_pdf
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+PAGES = [("i", "Cover page"), ("1", "Total revenue was $1 billion")]
+SHA256 = "ab" * 32
+
+
+class TestPageTextCache:
+    """
+    Test the local & remote tiers of the page text cache.
+    """
+
+    def test_local_round_trip(self, tmp_path):
+        cache = PageTextCache(tmp_path)
+        assert cache.get(SHA256, "pypdf") is None
+        cache.put(SHA256, "pypdf", PAGES)
+        assert cache.get(SHA256, "pypdf") == PAGES
+        # text extracted by another backend is a different entry
+        assert cache.get(SHA256, "pdfium") is None
+
+    def test_remote_hit_is_copied_to_local_disk(self, tmp_path):
+        fs = MemoryFileSystem()
+        remote_root = f"/{uuid4()}/page-text"
+        PageTextCache(tmp_path / "worker_1", fs, remote_root).put(
+            SHA256, "pypdf", PAGES
+        )
+
+        cache = PageTextCache(tmp_path / "worker_2", fs, remote_root)
+        assert cache.get(SHA256, "pypdf") == PAGES
+        fs.rm(remote_root, recursive=True)
+        assert cache.get(SHA256, "pypdf") == PAGES
+
+
+class TestFetchAndReadDocument:
+    """
+    Test that cached documents are neither downloaded nor parsed.
+    """
+
+    @pytest.mark.anyio
+    async def test_cached_document_skips_download_and_parse(self, tmp_path):
+        pdf_path = tmp_path / "filing.pdf"
+        write_text_pdf(pdf_path, num_pages=3)
+        sha256 = sha256_file(pdf_path)
+        document = Document(id=uuid4(), url="https://example.com/filing.pdf")
+        downloads = []
+
+        async def fake_download(document, file_path):
+            downloads.append(document.url)
+            file_path.write_bytes(pdf_path.read_bytes())
+            return sha256
+
+        def contents(docs):
+            return [(doc.text, doc.metadata) for doc in docs]
+
+        cache = PageTextCache(tmp_path / "cache")
+        with patch.object(
+            ingestion, "get_page_text_cache", return_value=cache
+        ), patch.object(ingestion, "download_document", fake_download):
+            docs = await ingestion.fetch_and_read_document(document)
+            assert cache.get(sha256, settings.PDF_PARSER_BACKEND) is not None
+
+            # the hash isn't known up front, so the PDF is downloaded but not parsed
+            with patch.object(ingestion, "extract_pages") as extract_pages:
+                cached_docs = await ingestion.fetch_and_read_document(document)
+                assert contents(cached_docs) == contents(docs)
+                extract_pages.assert_not_called()
+            assert len(downloads) == 2
+
+            document.metadata_map = {DocumentMetadataKeysEnum.CONTENT_SHA256: sha256}
+            cached_docs = await ingestion.fetch_and_read_document(document)
+            assert contents(cached_docs) == contents(docs)
+            assert len(downloads) == 2
+
+        assert [doc.metadata["page_label"] for doc in docs] == ["1", "2", "3"]
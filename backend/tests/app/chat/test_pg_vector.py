@@ -0,0 +1,464 @@
+from typing import List
+from unittest.mock import MagicMock, patch
+import asyncio
+import pytest
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+from llama_index.core import MockEmbedding, QueryBundle, VectorStoreIndex
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import (
+    ExactMatchFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from app.core.config import settings
+from app.chat.constants import DB_DOC_ID_KEY
+from app.chat.engine import index_to_query_engine
+from app.chat.pg_vector import (
+    CustomPGVectorStore,
+    build_search_parameters_statement,
+    get_partition_name,
+)
+from app.chat.retrieval import VectorStoreQueryBatcher
+from app.chat.utils import hash_text
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def get_vector_store() -> CustomPGVectorStore:
+    return CustomPGVectorStore.from_params(
+        "localhost",
+        5432,
+        "db",
+        "user",
+        "password",
+        "pg_vector_store",
+        hybrid_search=True,
+    )
+
+
+def make_node(text: str, page_label: str, embedding_value: float) -> TextNode:
+    return TextNode(
+        text=text,
+        metadata={"page_label": page_label, DB_DOC_ID_KEY: "doc-1"},
+        embedding=[embedding_value] * 1536,
+    )
+
+
+class RecordingSession:
+    """
+    Stands in for an async session, recording the statements of each transaction.
+    """
+
+    def __init__(self, transactions: List[list], row_ids: List[int]):
+        self.statements = []
+        self._row_ids = row_ids
+        transactions.append(self.statements)
+
+    async def __aenter__(self) -> "RecordingSession":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        pass
+
+    def begin(self) -> "RecordingSession":
+        return self
+
+    async def execute(self, stmt) -> MagicMock:
+        self.statements.append(stmt)
+        result = MagicMock()
+        result.scalars.return_value.all.return_value = self._row_ids
+        return result
+
+
+class RecordingConnection:
+    """
+    Stands in for an async engine's connection, recording its statements.
+    """
+
+    def __init__(self, detach_pending):
+        self.statements = []
+        self.execution_options_set = {}
+        self._detach_pending = detach_pending
+
+    def connect(self) -> "RecordingConnection":
+        return self
+
+    async def __aenter__(self) -> "RecordingConnection":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        pass
+
+    async def execution_options(self, **options) -> "RecordingConnection":
+        self.execution_options_set.update(options)
+        return self
+
+    async def execute(self, stmt) -> MagicMock:
+        self.statements.append(str(stmt))
+        result = MagicMock()
+        result.scalar.return_value = self._detach_pending
+        return result
+
+
+class TestCustomPGVectorStore:
+    """
+    Test that vector store writes upsert on the content key.
+    """
+
+    def test_upsert_matches_content_key_index(self):
+        vector_store = get_vector_store()
+        table = vector_store._table_class.__table__
+        (index,) = [
+            index for index in table.indexes if index.name.endswith("content_key_idx")
+        ]
+        index_sql = str(CreateIndex(index).compile(dialect=postgresql.dialect()))
+        key_sql = index_sql[index_sql.index("(db_document_id") : -1]
+
+        rows = vector_store._nodes_to_upsert_rows([make_node("a", "1", 0.1)])
+        (stmt,) = vector_store._build_upsert_statements(rows)
+        stmt_sql = str(stmt.compile(dialect=postgresql.dialect()))
+        assert f"ON CONFLICT {key_sql}) DO UPDATE" in stmt_sql
+
+    def test_upsert_writes_text_search_vector(self):
+        vector_store = get_vector_store()
+        table = vector_store._table_class.__table__
+        assert table.c.text_search_tsv.computed is None
+
+        rows = vector_store._nodes_to_upsert_rows([make_node("a", "1", 0.1)])
+        (stmt,) = vector_store._build_upsert_statements(rows)
+        stmt_sql = str(stmt.compile(dialect=postgresql.dialect()))
+        assert "to_tsvector('english'::regconfig, %(to_tsvector_1)s)" in stmt_sql
+        assert "text_search_tsv = excluded.text_search_tsv" in stmt_sql
+
+    def test_upsert_collapses_duplicate_chunks(self):
+        vector_store = get_vector_store()
+        nodes = [
+            make_node("revenue", "1", 0.1),
+            make_node("revenue", "2", 0.2),
+            make_node("revenue", "1", 0.3),
+        ]
+        rows = vector_store._nodes_to_upsert_rows(nodes)
+        assert [
+            (row["metadata_"]["page_label"], row["embedding"][0], row["text_hash"])
+            for row in rows
+        ] == [("1", 0.3, hash_text("revenue")), ("2", 0.2, hash_text("revenue"))]
+
+    def test_batch_query_runs_each_query_unchanged(self):
+        vector_store = get_vector_store()
+        filters = MetadataFilters(
+            filters=[ExactMatchFilter(key=DB_DOC_ID_KEY, value="doc-1")]
+        )
+        queries = [
+            VectorStoreQuery(
+                query_embedding=[0.1] * 1536, similarity_top_k=3, filters=filters
+            ),
+            VectorStoreQuery(query_embedding=[0.2] * 1536, similarity_top_k=5),
+        ]
+        stmt_sql = str(
+            vector_store._build_batch_query(queries).compile(
+                dialect=postgresql.dialect()
+            )
+        )
+        assert stmt_sql.count("UNION ALL") == 1
+        # each query keeps its own ordering & limit
+        assert stmt_sql.count("ORDER BY distance asc") == 2
+        assert stmt_sql.count("LIMIT") == 2
+        assert stmt_sql.count("AS query_index") == 2
+
+    def test_rows_are_routed_to_their_document_partition(self):
+        vector_store = get_vector_store()
+        rows = vector_store._nodes_to_upsert_rows(
+            [make_node("a", "1", 0.1), make_node("b", "2", 0.2)]
+        )
+        assert {row["db_document_id"] for row in rows} == {"doc-1"}
+        (stmt,) = vector_store._build_create_partition_statements(rows)
+        partition_name = get_partition_name("data_pg_vector_store", "doc-1")
+        stmt_sql = " ".join(str(stmt).split())
+        # created on its own & attached, which doesn't block searches of the table
+        assert "PARTITION OF" not in stmt_sql
+        assert (
+            f"CREATE TABLE public.{partition_name} ( "
+            "LIKE public.data_pg_vector_store INCLUDING DEFAULTS INCLUDING GENERATED )"
+        ) in stmt_sql
+        assert (
+            "ALTER TABLE public.data_pg_vector_store "
+            f"ATTACH PARTITION public.{partition_name} FOR VALUES IN ('doc-1')"
+        ) in stmt_sql
+        assert get_partition_name(
+            "data_pg_vector_store", "9f1c2a9e-5a0e-4a39-8d5f-6b1f8bb1d5a1"
+        ) == ("data_pg_vector_store_9f1c2a9e5a0e4a398d5f6b1f8bb1d5a1")
+
+    @pytest.mark.anyio
+    async def test_replacing_a_document_deletes_stale_rows_in_one_transaction(self):
+        vector_store = get_vector_store()
+        transactions = []
+        with patch.object(CustomPGVectorStore, "_initialize"), patch.object(
+            vector_store,
+            "_async_session",
+            lambda: RecordingSession(transactions, row_ids=[7, 8]),
+            create=True,
+        ):
+            await vector_store.areplace_db_document(
+                "doc-1", [make_node("a", "1", 0.1), make_node("b", "2", 0.2)]
+            )
+
+        upsert, delete = transactions[-1]
+        assert "RETURNING public.data_pg_vector_store.id" in str(
+            upsert.compile(dialect=postgresql.dialect())
+        )
+        compiled = delete.compile(dialect=postgresql.dialect())
+        assert str(compiled) == (
+            "DELETE FROM public.data_pg_vector_store "
+            "WHERE public.data_pg_vector_store.db_document_id = "
+            "%(db_document_id_1)s "
+            "AND public.data_pg_vector_store.id != ALL (%(row_ids)s::BIGINT[])"
+        )
+        assert compiled.params == {"db_document_id_1": "doc-1", "row_ids": [7, 8]}
+
+    @pytest.mark.anyio
+    @pytest.mark.parametrize(
+        "detach_pending, detach_mode",
+        [(False, "CONCURRENTLY"), (True, "FINALIZE"), (None, None)],
+    )
+    async def test_deleting_a_document_drops_its_partition(
+        self, detach_pending, detach_mode
+    ):
+        vector_store = get_vector_store()
+        connection = RecordingConnection(detach_pending)
+        partition_name = get_partition_name("data_pg_vector_store", "doc-1")
+        with patch.object(CustomPGVectorStore, "_initialize"), patch.object(
+            vector_store, "_async_engine", connection, create=True
+        ):
+            await vector_store.adelete_db_document("doc-1")
+
+        assert connection.execution_options_set == {"isolation_level": "AUTOCOMMIT"}
+        expected_statements = [f"DROP TABLE IF EXISTS public.{partition_name}"]
+        if detach_mode is not None:
+            expected_statements.insert(
+                0,
+                "ALTER TABLE public.data_pg_vector_store "
+                f"DETACH PARTITION public.{partition_name} {detach_mode}",
+            )
+        assert connection.statements[1:] == expected_statements
+        assert not any("DELETE" in stmt for stmt in connection.statements)
+
+    def test_per_document_search_filters_on_partition_key(self):
+        vector_store = get_vector_store()
+        filters = MetadataFilters(
+            filters=[ExactMatchFilter(key=DB_DOC_ID_KEY, value="doc-1")]
+        )
+        stmt = vector_store._build_query([0.1] * 1536, 3, filters)
+        stmt_sql = str(stmt.compile(dialect=postgresql.dialect()))
+        assert "WHERE public.data_pg_vector_store.db_document_id = " in stmt_sql
+        # searches across documents scan every partition
+        stmt = vector_store._build_query([0.1] * 1536, 3, None)
+        assert "db_document_id" not in str(stmt.compile(dialect=postgresql.dialect()))
+
+    def test_hybrid_search_fuses_text_and_vector_search_in_one_query(self):
+        vector_store = get_vector_store()
+        query = VectorStoreQuery(
+            query_embedding=[0.1] * 1536,
+            query_str="goodwill impairment",
+            similarity_top_k=10,
+            sparse_top_k=5,
+            hybrid_top_k=3,
+            mode=VectorStoreQueryMode.HYBRID,
+            filters=MetadataFilters(
+                filters=[ExactMatchFilter(key=DB_DOC_ID_KEY, value="doc-1")]
+            ),
+        )
+        compiled = vector_store._build_hybrid_query(query).compile(
+            dialect=postgresql.dialect()
+        )
+        stmt_sql = str(compiled)
+        assert "FULL OUTER JOIN" in stmt_sql
+        assert "text_search_tsv @@ to_tsquery('english'::regconfig" in stmt_sql
+        assert (
+            "coalesce(1.0 / CAST((60 + dense_ranked.rank) AS NUMERIC), 0)" in stmt_sql
+        )
+        assert sorted(
+            value for key, value in compiled.params.items() if key.startswith("param_")
+        ) == [3, 5, 10]
+
+        batch_sql = str(
+            vector_store._build_batch_query([query, query]).compile(
+                dialect=postgresql.dialect()
+            )
+        )
+        assert batch_sql.count("FULL OUTER JOIN") == 2
+
+    def test_quantized_search_rescores_candidates_by_full_precision(self):
+        filters = MetadataFilters(
+            filters=[ExactMatchFilter(key=DB_DOC_ID_KEY, value="doc-1")]
+        )
+        with patch.object(settings, "VECTOR_INDEX_QUANTIZATION", "binary"):
+            vector_store = get_vector_store()
+            table = vector_store._table_class.__table__
+            (index,) = [
+                index for index in table.indexes if index.name.endswith("embedding_idx")
+            ]
+            index_sql = str(CreateIndex(index).compile(dialect=postgresql.dialect()))
+            assert (
+                "(CAST(binary_quantize(embedding) AS BIT(1536)) bit_hamming_ops)"
+                in index_sql
+            )
+
+            compiled = vector_store._build_query([0.1] * 1536, 3, filters).compile(
+                dialect=postgresql.dialect()
+            )
+            stmt_sql = str(compiled)
+            # ordered by the same expression the index is built on
+            assert (
+                "ORDER BY CAST(binary_quantize(public.data_pg_vector_store.embedding) "
+                "AS BIT(1536)) <~> "
+                "CAST(binary_quantize(CAST(%(param_1)s AS VECTOR(1536))) AS BIT(1536))"
+            ) in stmt_sql
+            assert "ORDER BY distance asc" in stmt_sql
+            # over-fetches 4 candidates per result
+            limits = [
+                value for value in compiled.params.values() if isinstance(value, int)
+            ]
+            assert sorted(limits) == [3, 12]
+
+            # an exact search is already full precision
+            stmt = vector_store._build_query(
+                [0.1] * 1536, 3, filters, exact_search=True
+            )
+            stmt_sql = str(stmt.compile(dialect=postgresql.dialect()))
+            assert "binary_quantize" not in stmt_sql
+
+    @pytest.mark.anyio
+    async def test_document_query_engine_reaches_quantized_search(self):
+        transactions = []
+        with patch.object(
+            settings, "VECTOR_INDEX_QUANTIZATION", "binary"
+        ), patch.object(CustomPGVectorStore, "_initialize"):
+            vector_store = get_vector_store()
+            index = VectorStoreIndex.from_vector_store(
+                vector_store, embed_model=MockEmbedding(embed_dim=1536)
+            )
+            query_engine = index_to_query_engine("doc-1", index)
+            with patch.object(
+                vector_store,
+                "_async_session",
+                lambda: RecordingSession(transactions, row_ids=[]),
+                create=True,
+            ):
+                await query_engine.aretrieve(QueryBundle("What was total revenue?"))
+
+        # no search parameters turn the index scan off
+        ((stmt,),) = transactions
+        assert "binary_quantize" in str(stmt.compile(dialect=postgresql.dialect()))
+
+    @pytest.mark.anyio
+    async def test_document_query_engine_defaults_to_vector_search(self):
+        transactions = []
+        with patch.object(CustomPGVectorStore, "_initialize"):
+            vector_store = get_vector_store()
+            index = VectorStoreIndex.from_vector_store(
+                vector_store, embed_model=MockEmbedding(embed_dim=1536)
+            )
+            query_engine = index_to_query_engine("doc-1", index)
+            with patch.object(
+                vector_store,
+                "_async_session",
+                lambda: RecordingSession(transactions, row_ids=[]),
+                create=True,
+            ):
+                await query_engine.aretrieve(QueryBundle("What was total revenue?"))
+
+        ((stmt,),) = transactions
+        stmt_sql = str(stmt.compile(dialect=postgresql.dialect()))
+        assert "<=>" in stmt_sql
+        assert "to_tsquery" not in stmt_sql
+
+    def test_search_parameters_are_local_to_the_transaction(self):
+        assert build_search_parameters_statement() is None
+        stmt = build_search_parameters_statement(hnsw_ef_search=80, exact_search=True)
+        assert str(stmt) == (
+            "SELECT set_config(:name_0, :value_0, true), "
+            "set_config(:name_1, :value_1, true)"
+        )
+        assert stmt.compile().params == {
+            "name_0": "hnsw.ef_search",
+            "value_0": "80",
+            "name_1": "enable_indexscan",
+            "value_1": "off",
+        }
+
+
+class FakeBatchVectorStore:
+    def __init__(self):
+        self.batches: List[List[VectorStoreQuery]] = []
+        self.batch_kwargs: List[dict] = []
+
+    async def aquery_batch(
+        self, queries: List[VectorStoreQuery], **kwargs
+    ) -> List[VectorStoreQueryResult]:
+        self.batches.append(queries)
+        self.batch_kwargs.append(kwargs)
+        return [
+            VectorStoreQueryResult(ids=[query.query_str], similarities=[1.0])
+            for query in queries
+        ]
+
+
+class TestVectorStoreQueryBatcher:
+    """
+    Test that concurrent vector store queries share a round trip.
+    """
+
+    @pytest.mark.anyio
+    async def test_concurrent_queries_are_batched(self):
+        vector_store = FakeBatchVectorStore()
+        batcher = VectorStoreQueryBatcher(
+            vector_store, window_seconds=0.01, max_batch_size=32
+        )
+        queries = [
+            VectorStoreQuery(query_str=f"question {i}", similarity_top_k=3)
+            for i in range(5)
+        ]
+        results = await asyncio.gather(*(batcher.aquery(query) for query in queries))
+        assert [result.ids for result in results] == [
+            [query.query_str] for query in queries
+        ]
+        assert len(vector_store.batches) == 1
+        assert (batcher.num_queries, batcher.num_round_trips) == (5, 1)
+
+    @pytest.mark.anyio
+    async def test_full_batch_is_sent_early(self):
+        vector_store = FakeBatchVectorStore()
+        batcher = VectorStoreQueryBatcher(
+            vector_store, window_seconds=60, max_batch_size=2
+        )
+        queries = [
+            VectorStoreQuery(query_str=f"question {i}", similarity_top_k=3)
+            for i in range(4)
+        ]
+        await asyncio.wait_for(
+            asyncio.gather(*(batcher.aquery(query) for query in queries)), timeout=5
+        )
+        assert [len(batch) for batch in vector_store.batches] == [2, 2]
+
+    @pytest.mark.anyio
+    async def test_search_parameters_split_batches(self):
+        vector_store = FakeBatchVectorStore()
+        batcher = VectorStoreQueryBatcher(
+            vector_store, window_seconds=0.01, max_batch_size=32
+        )
+        query = VectorStoreQuery(query_str="question", similarity_top_k=3)
+        await asyncio.gather(
+            batcher.aquery(query, exact_search=True),
+            batcher.aquery(query, exact_search=True),
+            batcher.aquery(query, hnsw_ef_search=80),
+        )
+        assert sorted(
+            (len(batch), kwargs)
+            for batch, kwargs in zip(vector_store.batches, vector_store.batch_kwargs)
+        ) == [(1, {"hnsw_ef_search": 80}), (2, {"exact_search": True})]
@@ -0,0 +1,170 @@
+from typing import Iterator, List
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import pytest
+from llama_index.core.storage.kvstore.simple_kvstore import SimpleKVStore
+from app.chat.polygon_client import PolygonIOClient
+from app.chat.tools import describe_financials
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def make_financials_result(ticker: str, period_of_report_date: str) -> dict:
+    return {
+        "cik": "0000320193",
+        "company_name": f"{ticker} Inc.",
+        "end_date": period_of_report_date,
+        "fiscal_period": "FY",
+        "fiscal_year": period_of_report_date[:4],
+        "financials": {
+            "income_statement": {
+                "revenues": {"label": "Revenues", "value": 383285e6, "unit": "USD"},
+            },
+        },
+    }
+
+
+class PolygonIOStandIn(ThreadingHTTPServer):
+    """
+    A local stand-in of the polygon.io stock financials endpoint, which records
+    the requests it gets & answers each after a delay.
+    """
+
+    def __init__(self, delay_seconds: float = 0.0):
+        self.delay_seconds = delay_seconds
+        self.requests: List[dict] = []
+        self.connections = set()
+        super().__init__(("127.0.0.1", 0), PolygonIOStandInHandler)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class PolygonIOStandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: PolygonIOStandIn
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.server.requests.append(params)
+        self.server.connections.add(self.client_address)
+        time.sleep(self.server.delay_seconds)
+        if url.path != "/vX/reference/financials":
+            body, status = {"status": "NOT_FOUND"}, 404
+        else:
+            result = make_financials_result(
+                params["ticker"], params["period_of_report_date"]
+            )
+            body, status = {"status": "OK", "results": [result]}, 200
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def polygon_io_stand_in() -> Iterator[PolygonIOStandIn]:
+    server = PolygonIOStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_client(base_url: str, **kwargs) -> PolygonIOClient:
+    kwargs = {"cache_size": 16, "cache_ttl_seconds": 60, **kwargs}
+    return PolygonIOClient(
+        api_key="xxx", base_url=base_url, max_connections=4, **kwargs
+    )
+
+
+class TestPolygonIOClient:
+    """
+    Test the connection pooling, caching & fetch deduplication of the client.
+    """
+
+    @pytest.mark.anyio
+    async def test_fetches_each_report_once(self, polygon_io_stand_in):
+        client = make_client(polygon_io_stand_in.base_url)
+        try:
+            for _ in range(3):
+                (financials,) = await client.aget_stock_financials("aapl", "2023-09-30")
+            assert "Revenues were Revenues: 383285000000.0 USD." in (
+                describe_financials(financials)
+            )
+            await client.aget_stock_financials("AAPL", "2022-09-24")
+        finally:
+            await client.aclose()
+        assert client.num_fetches == 2
+        assert [request["ticker"] for request in polygon_io_stand_in.requests] == [
+            "AAPL",
+            "AAPL",
+        ]
+        # both requests went over the same kept alive connection
+        assert len(polygon_io_stand_in.connections) == 1
+
+    @pytest.mark.anyio
+    async def test_concurrent_calls_share_a_fetch(self, polygon_io_stand_in):
+        polygon_io_stand_in.delay_seconds = 0.2
+        client = make_client(polygon_io_stand_in.base_url)
+        try:
+            results = await asyncio.gather(
+                *[client.aget_stock_financials("MSFT", "2023-06-30") for _ in range(5)]
+            )
+        finally:
+            await client.aclose()
+        assert len(polygon_io_stand_in.requests) == 1
+        assert all(result is results[0] for result in results)
+
+    @pytest.mark.anyio
+    async def test_kvstore_tier_outlives_the_memory_cache(self, polygon_io_stand_in):
+        kvstore = SimpleKVStore()
+        timer = FakeTimer()
+        for _ in range(2):
+            # a new client per worker or process, with an empty memory cache
+            client = make_client(
+                polygon_io_stand_in.base_url, kvstore=kvstore, timer=timer
+            )
+            await client.aget_stock_financials("NVDA", "2024-01-28")
+            await client.aclose()
+        assert len(polygon_io_stand_in.requests) == 1
+
+        timer.now += 60
+        client = make_client(polygon_io_stand_in.base_url, kvstore=kvstore, timer=timer)
+        await client.aget_stock_financials("NVDA", "2024-01-28")
+        await client.aclose()
+        assert len(polygon_io_stand_in.requests) == 2
+
+    @pytest.mark.anyio
+    async def test_failed_fetches_are_not_cached(self, polygon_io_stand_in):
+        client = make_client(f"{polygon_io_stand_in.base_url}/missing")
+        try:
+            for _ in range(2):
+                with pytest.raises(ValueError):
+                    await client.aget_stock_financials("AAPL", "2023-09-30")
+        finally:
+            await client.aclose()
+        assert client.num_fetches == 2
@@ -0,0 +1,81 @@
+from typing import Dict, List, Tuple
+import pytest
+from llama_index.core import MockEmbedding, StorageContext, VectorStoreIndex
+from llama_index.core.data_structs.data_structs import IndexDict
+from llama_index.core.storage.kvstore.types import DEFAULT_COLLECTION
+from llama_index.core.vector_stores import SimpleVectorStore
+from app.chat.storage import CachedIndexStore, PostgresKVStore
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class InMemoryKVStore(PostgresKVStore):
+    """
+    PostgresKVStore whose async methods read & write a dict instead of the
+    database, leaving its sync methods as they are.
+    """
+
+    def __init__(self):
+        self.data: Dict[Tuple[str, str], dict] = {}
+        self.num_writes = 0
+
+    async def aput_all(
+        self,
+        kv_pairs: List[Tuple[str, dict]],
+        collection: str = DEFAULT_COLLECTION,
+        batch_size: int = 1,
+    ) -> None:
+        self.num_writes += 1
+        for key, val in kv_pairs:
+            self.data[(collection, key)] = val
+
+    async def aget_many(
+        self, keys: List[str], collection: str = DEFAULT_COLLECTION
+    ) -> Dict[str, dict]:
+        return {
+            key: self.data[(collection, key)]
+            for key in keys
+            if (collection, key) in self.data
+        }
+
+    async def adelete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        return self.data.pop((collection, key), None) is not None
+
+
+@pytest.mark.anyio
+async def test_kvstore_sync_methods_raise_in_event_loop():
+    kvstore = InMemoryKVStore()
+    with pytest.raises(RuntimeError):
+        kvstore.put("doc", {"text": "Total revenue grew"})
+    with pytest.raises(RuntimeError):
+        kvstore.get("doc")
+    assert kvstore.num_writes == 0
+
+
+def test_kvstore_sync_methods_run_outside_event_loop():
+    kvstore = InMemoryKVStore()
+    kvstore.put("doc", {"text": "Total revenue grew"})
+    assert kvstore.get("doc") == {"text": "Total revenue grew"}
+
+
+@pytest.mark.anyio
+async def test_index_from_stored_struct_isnt_written_again():
+    kvstore = InMemoryKVStore()
+    await CachedIndexStore(kvstore).async_add_index_struct(IndexDict(index_id="doc"))
+    # a new index store, like another worker's, that reads the struct back
+    index_store = CachedIndexStore(kvstore)
+    index_structs = await index_store.aget_index_structs(["doc", "missing"])
+    assert list(index_structs) == ["doc"]
+
+    index = VectorStoreIndex(
+        index_struct=index_structs["doc"],
+        storage_context=StorageContext.from_defaults(
+            index_store=index_store, vector_store=SimpleVectorStore()
+        ),
+        embed_model=MockEmbedding(embed_dim=4),
+    )
+    assert index.index_id == "doc"
+    assert kvstore.num_writes == 1
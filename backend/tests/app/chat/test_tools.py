@@ -0,0 +1,58 @@
+import asyncio
+import pytest
+from llama_index.core.callbacks import CallbackManager, LlamaDebugHandler
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.chat_engine.types import AgentChatResponse
+from llama_index.core.tools import FunctionTool
+from app.chat.tools import AgentQueryEngine, FunctionToolQueryEngine
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.mark.anyio
+async def test_function_tool_query_engine_answers_with_tool_output():
+    async def extract_data(*args, **kwargs):
+        return ["Revenues were 1 USD.", "Net income was 2 USD."]
+
+    handler = LlamaDebugHandler()
+    tool = FunctionTool.from_defaults(
+        fn=lambda: None, async_fn=extract_data, name="extract", description="Data"
+    )
+    query_engine = FunctionToolQueryEngine(tool, CallbackManager([handler]))
+
+    response = await query_engine.aquery("What was the revenue?")
+    assert str(response) == "Revenues were 1 USD.\nNet income was 2 USD."
+    ((start_event, end_event),) = handler.get_event_pairs(CBEventType.FUNCTION_CALL)
+    assert start_event.payload[EventPayload.TOOL].name == "extract"
+    assert "Net income was 2 USD." in end_event.payload[EventPayload.FUNCTION_OUTPUT]
+
+
+@pytest.mark.anyio
+async def test_agent_query_engine_uses_an_agent_per_query():
+    agents = []
+
+    class AgentStandIn:
+        def __init__(self):
+            self.memory = []
+            agents.append(self)
+
+        async def achat(self, message: str) -> AgentChatResponse:
+            self.memory.append(message)
+            # lets the other query run in between
+            await asyncio.sleep(0)
+            return AgentChatResponse(response=" ".join(self.memory))
+
+    query_engine = AgentQueryEngine(AgentStandIn, CallbackManager([]))
+
+    responses = await asyncio.gather(
+        query_engine.aquery("What was the revenue?"),
+        query_engine.aquery("What was the net income?"),
+    )
+    assert [str(response) for response in responses] == [
+        "What was the revenue?",
+        "What was the net income?",
+    ]
+    assert len(agents) == 2
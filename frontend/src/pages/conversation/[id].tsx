@@ -5,7 +5,12 @@ import { PdfFocusProvider } from "~/context/pdf";
 import type { ChangeEvent } from "react";
 import DisplayMultiplePdfs from "~/components/pdf-viewer/DisplayMultiplePdfs";
 import { backendUrl } from "src/config";
-import { MESSAGE_STATUS, Message } from "~/types/conversation";
+import { MESSAGE_STATUS, MESSAGE_STREAM_VERSION } from "~/types/conversation";
+import type { MessageStreamEvent } from "~/types/conversation";
+import {
+  applyMessageStreamEvent,
+  createStreamedMessageState,
+} from "~/utils/messageStream";
 import useMessages from "~/hooks/useMessages";
 import { backendClient } from "~/api/backend";
 import { RenderConversations as RenderConversations } from "~/components/conversations/RenderConversations";
@@ -77,18 +82,32 @@ export default function Conversation() {
 
     const messageEndpoint =
       backendUrl + `api/conversation/${conversationId}/message`;
-    const url = messageEndpoint + `?user_message=${encodeURI(userMessage)}`;
+    const url =
+      messageEndpoint +
+      `?user_message=${encodeURI(userMessage)}&stream_protocol=delta`;
 
     const events = new EventSource(url);
+    const streamedMessageState = createStreamedMessageState();
     // eslint-disable-next-line @typescript-eslint/no-unsafe-assignment, @typescript-eslint/no-unsafe-argument
     events.onmessage = (event: MessageEvent) => {
       // eslint-disable-next-line @typescript-eslint/no-unsafe-assignment, @typescript-eslint/no-unsafe-argument
-      const parsedData: Message = JSON.parse(event.data);
-      systemSendMessage(parsedData);
+      const parsedData: MessageStreamEvent = JSON.parse(event.data);
+      if (parsedData.version !== MESSAGE_STREAM_VERSION) {
+        console.error("Unsupported message stream version", parsedData.version);
+        events.close();
+        setIsMessagePending(false);
+        return;
+      }
+      const message = applyMessageStreamEvent(streamedMessageState, parsedData);
+      if (!message) {
+        return;
+      }
+      systemSendMessage(message);
 
       if (
-        parsedData.status === MESSAGE_STATUS.SUCCESS ||
-        parsedData.status === MESSAGE_STATUS.ERROR
+        parsedData.type === "snapshot" &&
+        (message.status === MESSAGE_STATUS.SUCCESS ||
+          message.status === MESSAGE_STATUS.ERROR)
       ) {
         events.close();
         setIsMessagePending(false);
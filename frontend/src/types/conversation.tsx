@@ -69,3 +69,21 @@ export interface BackendCitation {
   score: number;
   text: string;
 }
+
+export const MESSAGE_STREAM_VERSION = 1;
+
+export interface MessageSubProcessPatch {
+  event_id: string;
+  sub_process: MessageSubProcess;
+}
+
+// Events of the "delta" protocol of the SSE stream of an assistant message
+export type MessageStreamEvent =
+  | { version: number; type: "start"; message: Message }
+  | {
+      version: number;
+      type: "patch";
+      delta: string;
+      sub_processes: MessageSubProcessPatch[];
+    }
+  | { version: number; type: "snapshot"; message: Message };
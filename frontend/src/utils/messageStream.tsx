@@ -0,0 +1,43 @@
+import type {
+  Message,
+  MessageStreamEvent,
+  MessageSubProcess,
+} from "~/types/conversation";
+
+// The assistant message being built from the events of its SSE stream
+export interface StreamedMessageState {
+  message: Message | null;
+  subProcessesByEventId: Map<string, MessageSubProcess>;
+}
+
+export const createStreamedMessageState = (): StreamedMessageState => ({
+  message: null,
+  subProcessesByEventId: new Map(),
+});
+
+export const applyMessageStreamEvent = (
+  state: StreamedMessageState,
+  event: MessageStreamEvent
+): Message | null => {
+  switch (event.type) {
+    case "start":
+    case "snapshot":
+      state.message = event.message;
+      break;
+    case "patch":
+      // sub-processes replace the earlier ones of the same event, keeping their
+      // position
+      event.sub_processes.forEach(({ event_id, sub_process }) =>
+        state.subProcessesByEventId.set(event_id, sub_process)
+      );
+      if (state.message) {
+        state.message = {
+          ...state.message,
+          content: state.message.content + event.delta,
+          sub_processes: Array.from(state.subProcessesByEventId.values()),
+        };
+      }
+      break;
+  }
+  return state.message;
+};